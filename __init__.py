@@ -7,13 +7,42 @@
 """
 from trytond.pool import Pool
 
-from party import Party, PartyMergeView, PartyMerge
+from party import Party, PartyMergeStaged, PartyMergeView, \
+    PartyMergePreview, PartyMergePreviewLine, PartyMergePlan, \
+    PartyMergeReport, PartyMerge
+from merge_request import PartyMergeRequest, PartyMergeRequestParty, \
+    PartyMergeRequestCheckpoint
+from merge_log import PartyMergeLog, PartyMergeLogParty, \
+    PartyMergeLogEntry, PartyMergeLogStatistic
+from merged import PartyMerged
+from cache import PartyMergeInvalidation
+from duplicate import PartyDuplicateKey, PartyDuplicateCluster, \
+    PartyDuplicateClusterMember, Address, ContactMechanism
 
 
 def register():
     Pool.register(
         Party,
+        PartyMergeStaged,
         PartyMergeView,
+        PartyMergePreview,
+        PartyMergePreviewLine,
+        PartyMergePlan,
+        PartyMergeReport,
+        PartyMergeRequest,
+        PartyMergeRequestParty,
+        PartyMergeRequestCheckpoint,
+        PartyMergeLog,
+        PartyMergeLogParty,
+        PartyMergeLogEntry,
+        PartyMergeLogStatistic,
+        PartyMerged,
+        PartyMergeInvalidation,
+        PartyDuplicateKey,
+        PartyDuplicateCluster,
+        PartyDuplicateClusterMember,
+        Address,
+        ContactMechanism,
         module='party_merge', type_='model'
     )
     Pool.register(
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+    cache.py
+
+    Eviction of the records rewritten by the merges from the caches of every
+    server process.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import datetime
+
+from sql.aggregate import Max
+
+from trytond.model import ModelSQL, fields
+from trytond.transaction import Transaction
+from trytond.pool import Pool
+from trytond.cache import Cache, LRUDict
+from trytond.tools import reduce_ids
+
+from merge_log import compress_ids, expand_ids
+from tools import bulk_insert
+
+__all__ = ['PartyMergeInvalidation']
+
+
+class DependentLRUDict(LRUDict):
+    """A LRUDict indexing its keys by the records they depend on.
+
+    The dependencies of the keys removed to respect the size limit are
+    pruned, and they go away with the dictionary when the cache is cleared.
+    """
+
+    def __init__(self, size_limit):
+        # The keys depending on a record and the records of a key
+        self.keys_of = {}
+        self.records_of = {}
+        super(DependentLRUDict, self).__init__(size_limit)
+
+    def _check_size_limit(self):
+        while len(self) > self.size_limit:
+            key, _ = self.popitem(last=False)
+            self.forget(key)
+
+    def depend(self, key, records):
+        "Make key depend on the (model name, id) records only"
+        self.forget(key)
+        if records:
+            self.records_of[key] = set(records)
+        for record in records:
+            self.keys_of.setdefault(record, set()).add(key)
+
+    def forget(self, key):
+        "Remove the dependencies of key"
+        for record in self.records_of.pop(key, ()):
+            keys = self.keys_of.get(record)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_of[record]
+
+    def evict(self, records):
+        "Remove the keys depending on the records"
+        for record in records:
+            for key in self.keys_of.pop(record, ()):
+                self.pop(key, None)
+                self.forget(key)
+
+
+class MergeCache(Cache):
+    """A Cache whose entries depend on records.
+
+    The entries set with the records they were computed from are evicted,
+    in every process, when a merge rewrites one of those records. The
+    other entries are kept, instead of clearing the whole cache.
+    """
+    _merge_instances = []
+    # Reset through ir_cache by the processes publishing invalidations
+    _merge_synced = Cache('party.merge.invalidation', context=False)
+    # The last invalidation read per database
+    _merge_last = {}
+    # The ids below the last one which were not committed yet when read, per
+    # database, with the time they were found missing
+    _merge_unread = {}
+
+    def __init__(self, name, size_limit=1024, context=True):
+        super(MergeCache, self).__init__(
+            name, size_limit=size_limit, context=context
+        )
+        self._merge_instances.append(self)
+
+    def get(self, key, default=None):
+        self.sync()
+        return super(MergeCache, self).get(key, default)
+
+    def set(self, key, value, records=None):
+        """Cache value for key, records is the list of (model name, id) from
+        which the value was computed.
+        """
+        dbname = Transaction().cursor.dbname
+        key = self._key(key)
+        with self._lock:
+            cache = self._cache.get(dbname)
+            if not isinstance(cache, DependentLRUDict):
+                # Replaced by Cache.clean or clear
+                cache = self._cache[dbname] = DependentLRUDict(
+                    self.size_limit
+                )
+            try:
+                cache[key] = value
+            except TypeError:
+                return value
+            cache.depend(key, records or [])
+        return value
+
+    def evict(self, records):
+        "Remove the entries computed from the (model name, id) records"
+        dbname = Transaction().cursor.dbname
+        with self._lock:
+            cache = self._cache.get(dbname)
+            if isinstance(cache, DependentLRUDict):
+                cache.evict(records)
+
+    @classmethod
+    def evict_all(cls, records):
+        for instance in cls._merge_instances:
+            instance.evict(records)
+
+    @classmethod
+    def sync(cls):
+        """Evict the records invalidated by the other processes since the
+        last call. The table of invalidations is read only when a process
+        published some.
+
+        The ids are taken from the sequence when the invalidations are
+        inserted, not when they are committed: the ids missing below the
+        last one read are read again until they show up or are older than
+        the retention of the invalidations.
+        """
+        if cls._merge_synced.get('synced'):
+            return
+        Invalidation = Pool().get('party.merge.invalidation')
+        table = Invalidation.__table__()
+        cursor = Transaction().cursor
+        dbname = cursor.dbname
+        now = datetime.datetime.now()
+
+        last = cls._merge_last.get(dbname)
+        unread = cls._merge_unread.setdefault(dbname, {})
+        if last is None:
+            # Nothing is cached yet
+            cursor.execute(*table.select(Max(table.id)))
+            last, = cursor.fetchone()
+        else:
+            where = table.id > last
+            if unread:
+                where |= reduce_ids(table.id, sorted(unread))
+            cursor.execute(*table.select(
+                table.id, table.model, table.ids,
+                where=where, order_by=table.id.asc
+            ))
+            for invalidation_id, model, ids in cursor.fetchall():
+                cls.evict_all([(model, i) for i in expand_ids(ids)])
+                unread.pop(invalidation_id, None)
+                if last:
+                    for missing_id in xrange(last + 1, invalidation_id):
+                        unread[missing_id] = now
+                last = max(last, invalidation_id)
+            for missing_id, date in unread.items():
+                if date < now - Invalidation._retention:
+                    # Rolled back
+                    del unread[missing_id]
+        cls._merge_last[dbname] = last or 0
+        cls._merge_synced.set('synced', True)
+
+
+class PartyMergeInvalidation(ModelSQL):
+    'Party Merge Invalidation'
+    __name__ = 'party.merge.invalidation'
+
+    model = fields.Char('Model', required=True)
+    ids = fields.Text('IDs', required=True)
+
+    #: How long the invalidations are kept for the processes to read them
+    _retention = datetime.timedelta(days=1)
+
+    @staticmethod
+    def evict_transaction(changes):
+        """Evict the records of changes, a dictionary of model name to ids,
+        from the record cache of the transaction only.
+        """
+        transaction = Transaction()
+        # The records already instantiated read their values again
+        transaction.counter += 1
+        for cache in transaction.cursor.cache.itervalues():
+            for model, ids in changes.iteritems():
+                if model not in cache:
+                    continue
+                for id_ in ids:
+                    cache[model].pop(id_, None)
+
+    @classmethod
+    def publish(cls, changes):
+        """Evict the records changed by a merge, a dictionary of model name
+        to ids, from the record cache of the transaction and from the
+        MergeCache of every process.
+        """
+        transaction = Transaction()
+        table = cls.__table__()
+
+        changes = dict((m, set(i)) for m, i in changes.iteritems() if i)
+        if not changes:
+            return
+        cls.evict_transaction(changes)
+        MergeCache.evict_all([
+            (m, i) for m, ids in changes.iteritems() for i in ids
+        ])
+
+        transaction.cursor.execute(*table.delete(
+            where=table.create_date <
+            datetime.datetime.now() - cls._retention
+        ))
+        bulk_insert(cls, [{
+            'model': model,
+            'ids': compress_ids(ids),
+        } for model, ids in sorted(changes.iteritems())])
+        # Notify the other processes through ir_cache
+        MergeCache._merge_synced.clear()
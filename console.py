@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+"""
+    console.py
+
+    Command line entry point of the party merge module.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import csv
+import json
+import time
+import logging
+import datetime
+import argparse
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+
+def parse_commandline(args=None):
+    parser = argparse.ArgumentParser(prog='trytond_party_merge')
+
+    parser.add_argument(
+        "-c", "--config", dest="configfile", metavar='FILE',
+        default=os.environ.get('TRYTOND_CONFIG'), help="specify config file"
+    )
+    parser.add_argument(
+        "-d", "--database", dest="database", required=True,
+        metavar='DATABASE', help="specify the database name"
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true",
+        dest="verbose", help="enable verbose mode"
+    )
+
+    subparsers = parser.add_subparsers(dest='command')
+
+    worker = subparsers.add_parser(
+        'worker', help="process the queued merge requests")
+    worker.add_argument(
+        "-n", "--processes", dest="processes", type=int,
+        default=1, help="number of worker processes"
+    )
+    worker.add_argument(
+        "--interval", dest="interval", type=float,
+        default=30, help="seconds to wait when the queue is empty"
+    )
+    worker.add_argument(
+        "--once", dest="once", action="store_true",
+        help="exit as soon as the queue is empty"
+    )
+
+    indexes = subparsers.add_parser(
+        'indexes', help="report the party columns lacking an index")
+    indexes.add_argument(
+        "--create", dest="create", action="store_true",
+        help="create the missing indexes"
+    )
+    indexes.add_argument(
+        "--no-concurrently", dest="concurrently", action="store_false",
+        help="do not build the indexes concurrently on PostgreSQL"
+    )
+
+    duplicates = subparsers.add_parser(
+        'duplicates', help="detect the duplicate parties")
+    duplicates.add_argument(
+        "--threshold", dest="threshold", type=float,
+        help="minimal score of a pair of duplicate parties"
+    )
+    duplicates.add_argument(
+        "--max-block-size", dest="max_block_size", type=int,
+        help="ignore the keys shared by more parties"
+    )
+    duplicates.add_argument(
+        "--rebuild", dest="rebuild", action="store_true",
+        help="rebuild the keys of all the parties first"
+    )
+
+    merge = subparsers.add_parser(
+        'merge', help="merge the parties of a mapping file")
+    merge.add_argument(
+        "mapping", metavar='FILE',
+        help="CSV of (duplicate id, target id) rows, JSON object of "
+        "duplicate id to target id or JSON lines of [duplicate id, target id]"
+    )
+    merge.add_argument(
+        "--format", dest="format", choices=['csv', 'json', 'jsonl'],
+        help="format of the mapping (guessed from the file extension)"
+    )
+    merge.add_argument(
+        "--batch-size", dest="batch_size", type=int, default=1000,
+        help="maximum number of duplicates merged together"
+    )
+    merge.add_argument(
+        "--commit-every", dest="commit_every", type=int, default=1,
+        help="number of batches merged per transaction"
+    )
+    merge.add_argument(
+        "--conflict-policy", dest="conflict_policy",
+        choices=['keep_target', 'keep_newest', 'delete_source'],
+        help="how to resolve the rows violating a unique constraint"
+    )
+    merge.add_argument(
+        "--check", dest="check", action="store_true",
+        help="only validate the mapping"
+    )
+
+    subparsers.add_parser(
+        'sweep', help="point the rows referencing merged parties to their "
+        "final target")
+
+    purge = subparsers.add_parser(
+        'purge', help="delete the merged parties no longer referenced")
+    purge.add_argument(
+        "--batch-size", dest="batch_size", type=int,
+        help="maximum number of parties deleted per transaction"
+    )
+    purge.add_argument(
+        "--days", dest="days", type=int,
+        help="purge only the parties merged for more days (90 by default)"
+    )
+
+    return parser.parse_args(args)
+
+
+def init(options):
+    "Configure trytond and load the pool of the database"
+    from trytond.config import config
+    config.update_etc(options.configfile)
+
+    from trytond.pool import Pool
+    Pool.start()
+    pool = Pool(options.database)
+    pool.init()
+    return pool
+
+
+def work(options):
+    "Process merge requests until the queue is empty (and --once is set)"
+    from trytond.transaction import Transaction
+    from trytond.cache import Cache
+
+    pool = init(options)
+    while True:
+        with Transaction().start(options.database, 0):
+            Cache.clean(options.database)
+            MergeRequest = pool.get('party.merge.request')
+            processed = MergeRequest.process(limit=1)
+            # Let the other processes evict what the merges changed
+            Cache.resets(options.database)
+        if not processed:
+            if options.once:
+                break
+            time.sleep(options.interval)
+
+
+def worker(options):
+    "Run a pool of worker processes"
+    processes = [
+        multiprocessing.Process(target=work, args=(options,))
+        for _ in range(options.processes)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+def indexes(options):
+    "Report (and create) the missing indexes of the merged columns"
+    from trytond.transaction import Transaction
+
+    pool = init(options)
+    with Transaction().start(options.database, 0) as transaction:
+        Party = pool.get('party.party')
+        for line in Party.merge_index_report():
+            sys.stdout.write('%-50s %-10s %s\n' % (
+                '%s.%s' % (line['table'], line['column']),
+                'history' if line['history'] else '',
+                'ok' if line['indexed'] else 'MISSING',
+            ))
+        if options.create:
+            for index_name in Party.merge_create_indexes(
+                    concurrently=options.concurrently):
+                sys.stdout.write('created %s\n' % index_name)
+            transaction.cursor.commit()
+
+
+def duplicates(options):
+    "Detect the duplicate parties and report the clusters found"
+    from trytond.transaction import Transaction
+
+    pool = init(options)
+    with Transaction().start(options.database, 0) as transaction:
+        Cluster = pool.get('party.duplicate.cluster')
+        clusters = Cluster.detect(
+            threshold=options.threshold,
+            max_block_size=options.max_block_size,
+            rebuild=options.rebuild,
+        )
+        transaction.cursor.commit()
+        sys.stdout.write('%s clusters of duplicate parties\n' % len(clusters))
+
+
+def read_mapping(path, format=None):
+    """Yield the (duplicate id, target id) pairs of the mapping file.
+
+    The CSV and JSON lines files are streamed, the rows which do not start
+    with an id (like a header) are skipped.
+    """
+    if format is None:
+        format = os.path.splitext(path)[1].lstrip('.').lower()
+        if format in ('ndjson', 'jsonl'):
+            format = 'jsonl'
+        elif format != 'json':
+            format = 'csv'
+    with open(path, 'rb') as mapping:
+        if format == 'json':
+            rows = json.load(mapping)
+            if isinstance(rows, dict):
+                rows = rows.iteritems()
+        elif format == 'jsonl':
+            rows = (json.loads(line) for line in mapping if line.strip())
+        else:
+            rows = csv.reader(mapping)
+        for row in rows:
+            try:
+                source_id, target_id = int(row[0]), int(row[1])
+            except (ValueError, TypeError, IndexError):
+                continue
+            yield source_id, target_id
+
+
+def merge(options):
+    "Merge the parties of a mapping file in batches"
+    from trytond.transaction import Transaction
+    from trytond.cache import Cache
+
+    pool = init(options)
+    with Transaction().start(options.database, 0) as transaction:
+        Party = pool.get('party.party')
+        mapping, errors = Party.check_merge_mapping(
+            read_mapping(options.mapping, options.format))
+        for error in errors:
+            sys.stderr.write('%s\n' % error)
+        if errors:
+            sys.exit(1)
+        total = sum(len(s) for s in mapping.itervalues())
+        sys.stdout.write('%s duplicates into %s parties\n' % (
+            total, len(mapping)))
+        if options.check:
+            return
+
+        start = time.time()
+        merged = batches = 0
+        for _, parties, _ in Party.merge_mapping(
+                mapping, batch_size=options.batch_size,
+                conflict_policy=options.conflict_policy):
+            merged += len(parties)
+            batches += 1
+            if batches % options.commit_every and merged < total:
+                continue
+            transaction.cursor.commit()
+            elapsed = time.time() - start
+            sys.stdout.write('%s/%s duplicates merged in %.1fs (%.1f/s)\n' % (
+                merged, total, elapsed, merged / elapsed if elapsed else 0))
+            Cache.resets(options.database)
+        transaction.cursor.commit()
+
+
+def sweep(options):
+    "Point the rows still referencing merged parties to their final target"
+    from trytond.transaction import Transaction
+    from trytond.cache import Cache
+
+    pool = init(options)
+    with Transaction().start(options.database, 0) as transaction:
+        Party = pool.get('party.party')
+        logs = Party.merge_sweep()
+        transaction.cursor.commit()
+        Cache.resets(options.database)
+        sys.stdout.write('%s rows pointed to %s parties\n' % (
+            sum(s.rows for log in logs for s in log.statistics
+                if s.kind == 'update'),
+            len(logs)))
+
+
+def purge(options):
+    "Delete the merged parties which are no longer referenced"
+    from trytond.transaction import Transaction
+    from trytond.cache import Cache
+
+    pool = init(options)
+    with Transaction().start(options.database, 0) as transaction:
+        Merged = pool.get('party.party.merged')
+        delay = None
+        if options.days is not None:
+            delay = datetime.timedelta(days=options.days)
+        total = Merged.purge_count(delay)
+        start = time.time()
+        purged = referenced = 0
+        for purged_ids, referenced_ids in Merged.purge_batches(
+                batch_size=options.batch_size, delay=delay):
+            transaction.cursor.commit()
+            Cache.resets(options.database)
+            purged += len(purged_ids)
+            referenced += len(referenced_ids)
+            elapsed = time.time() - start
+            sys.stdout.write(
+                '%s/%s parties purged, %s still referenced in %.1fs '
+                '(%.1f/s)\n' % (
+                    purged, total, referenced, elapsed,
+                    purged / elapsed if elapsed else 0))
+
+
+def main(args=None):
+    options = parse_commandline(args)
+    logging.basicConfig(
+        level=logging.DEBUG if options.verbose else logging.INFO,
+        format='[%(asctime)s] %(levelname)s:%(name)s:%(message)s',
+    )
+    {
+        'worker': worker,
+        'indexes': indexes,
+        'duplicates': duplicates,
+        'merge': merge,
+        'sweep': sweep,
+        'purge': purge,
+    }[options.command](options)
+
+
+if __name__ == '__main__':
+    main()
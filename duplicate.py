@@ -0,0 +1,605 @@
+# -*- coding: utf-8 -*-
+"""
+    duplicate.py
+
+    Detection of duplicate parties.
+
+    Parties are never compared pairwise: each party is reduced to a set of
+    blocking keys (normalized name, phonetic name, email, phone, VAT code,
+    address) stored in party.duplicate.key and only the parties sharing a
+    key are scored against each other.
+
+    The keys are kept up to date when parties, addresses and contact
+    mechanisms are created, modified or deleted.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import re
+import logging
+import unicodedata
+from collections import defaultdict
+from itertools import combinations
+
+from sql import Literal
+from sql.aggregate import Count
+
+from trytond import backend
+from trytond.model import Workflow, ModelView, ModelSQL, fields
+from trytond.transaction import Transaction
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval
+from trytond.tools import reduce_ids, grouped_slice
+
+__all__ = [
+    'PartyDuplicateKey', 'PartyDuplicateCluster',
+    'PartyDuplicateClusterMember', 'Address', 'ContactMechanism',
+]
+
+logger = logging.getLogger(__name__)
+
+#: The kinds of blocking keys with the score given to a pair of parties
+#: sharing a key of the kind.
+KEY_KINDS = [
+    ('vat', 'VAT Code', 1.0),
+    ('email', 'E-Mail', 0.9),
+    ('phone', 'Phone', 0.7),
+    ('name', 'Name', 0.6),
+    ('address', 'Address', 0.4),
+    ('phonetic', 'Phonetic Name', 0.3),
+]
+KEY_WEIGHTS = dict((kind, weight) for kind, _, weight in KEY_KINDS)
+
+# Legal forms which do not tell two companies apart
+_STOP_WORDS = set([
+    'co', 'company', 'corp', 'corporation', 'gmbh', 'inc', 'limited', 'llc',
+    'llp', 'ltd', 'plc', 'private', 'pvt', 'sa', 'sarl', 'the',
+])
+_RE_NON_WORD = re.compile(r'[\W_]+', re.UNICODE)
+_RE_NON_DIGIT = re.compile(r'\D+')
+
+_SOUNDEX_CODES = dict(
+    (letter, str(code))
+    for code, letters in enumerate(
+        ['aehiouwy', 'bfpv', 'cgjkqsxz', 'dt', 'l', 'mn', 'r'])
+    for letter in letters
+)
+
+
+def score(kinds):
+    "Return the score of a pair of parties sharing keys of kinds"
+    return round(min(1.0, sum(KEY_WEIGHTS[k] for k in kinds)), 2)
+
+
+def normalize(value):
+    "Return value lower-cased, without accents nor punctuation"
+    if not value:
+        return ''
+    if not isinstance(value, unicode):
+        value = value.decode('utf-8')
+    value = unicodedata.normalize('NFKD', value)
+    value = u''.join(c for c in value if not unicodedata.combining(c))
+    return _RE_NON_WORD.sub(u' ', value.lower()).strip()
+
+
+def tokens(value):
+    "Return the significant words of the name"
+    return [t for t in normalize(value).split() if t not in _STOP_WORDS]
+
+
+def soundex(word):
+    "Return the Soundex code of the word"
+    word = [c for c in word if c in _SOUNDEX_CODES]
+    if not word:
+        return ''
+    code = word[0].upper()
+    previous = _SOUNDEX_CODES[word[0]]
+    for letter in word[1:]:
+        digit = _SOUNDEX_CODES[letter]
+        if digit != '0' and digit != previous:
+            code += digit
+        if letter not in 'hw':
+            previous = digit
+    return (code + '000')[:4]
+
+
+class PartyDuplicateKey(ModelSQL):
+    'Party Duplicate Key'
+    __name__ = 'party.duplicate.key'
+
+    party = fields.Many2One(
+        'party.party', 'Party', required=True, select=True,
+        ondelete='CASCADE',
+    )
+    kind = fields.Selection(
+        [(kind, name) for kind, name, _ in KEY_KINDS], 'Kind',
+        required=True,
+    )
+    key = fields.Char('Key', required=True, select=True)
+
+    #: Number of parties read per query while building the keys
+    _batch_size = 5000
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        created = not TableHandler.table_exist(cursor, cls._table)
+
+        super(PartyDuplicateKey, cls).__register__(module_name)
+
+        # Index the existing parties, the keys are then maintained by
+        # the create, write and delete of the parties
+        if created:
+            cls.rebuild()
+
+    @classmethod
+    def get_keys(cls, parties, addresses, mechanisms):
+        """Return the set of (party id, kind, key) for the parties.
+
+        parties is a list of (id, name, vat code), addresses and mechanisms
+        are dictionaries of party id to the list of (street, zip) and
+        (type, value).
+        """
+        keys = set()
+        for party_id, name, vat_code in parties:
+            words = tokens(name)
+            if words:
+                keys.add((party_id, 'name', ' '.join(sorted(words))))
+                keys.add((party_id, 'phonetic', ' '.join(
+                    sorted(soundex(w) for w in words))))
+            if vat_code:
+                keys.add((party_id, 'vat', normalize(vat_code).replace(
+                    ' ', '')))
+            for street, zip_ in addresses.get(party_id, []):
+                street = normalize(street)
+                if street and zip_:
+                    keys.add((party_id, 'address', '%s %s' % (
+                        normalize(zip_).replace(' ', ''), street)))
+            for type_, value in mechanisms.get(party_id, []):
+                if type_ == 'email' and value:
+                    keys.add((party_id, 'email', value.strip().lower()))
+                elif type_ in ('phone', 'mobile', 'fax') and value:
+                    digits = _RE_NON_DIGIT.sub('', value)
+                    if len(digits) >= 6:
+                        # Ignore the international prefix
+                        keys.add((party_id, 'phone', digits[-9:]))
+        return set(k for k in keys if k[2])
+
+    @classmethod
+    def read_parties(cls, party_ids):
+        """Read the values used to build the keys of the parties with one
+        query per table. Return the arguments of get_keys.
+        """
+        pool = Pool()
+        Party = pool.get('party.party')
+        Address = pool.get('party.address')
+        ContactMechanism = pool.get('party.contact_mechanism')
+        cursor = Transaction().cursor
+
+        party = Party.__table__()
+        address = Address.__table__()
+        mechanism = ContactMechanism.__table__()
+
+        parties = []
+        addresses = defaultdict(list)
+        mechanisms = defaultdict(list)
+        for sub_ids in grouped_slice(party_ids):
+            sub_ids = list(sub_ids)
+            cursor.execute(*party.select(
+                party.id, party.name, party.vat_country, party.vat_number,
+                where=reduce_ids(party.id, sub_ids) & party.active
+            ))
+            parties.extend(
+                (id_, name, (country or '') + (number or ''))
+                for id_, name, country, number in cursor.fetchall()
+            )
+            cursor.execute(*address.select(
+                address.party, address.street, address.zip,
+                where=reduce_ids(address.party, sub_ids) & address.active
+            ))
+            for party_id, street, zip_ in cursor.fetchall():
+                addresses[party_id].append((street, zip_))
+            cursor.execute(*mechanism.select(
+                mechanism.party, mechanism.type, mechanism.value,
+                where=reduce_ids(mechanism.party, sub_ids) &
+                mechanism.active
+            ))
+            for party_id, type_, value in cursor.fetchall():
+                mechanisms[party_id].append((type_, value))
+        return parties, addresses, mechanisms
+
+    @classmethod
+    def insert_keys(cls, keys):
+        "Insert the (party id, kind, key) in bulk"
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        keys = sorted(keys)
+        for sub_keys in grouped_slice(keys):
+            cursor.execute(*table.insert(
+                columns=[table.party, table.kind, table.key],
+                values=[list(k) for k in sub_keys]
+            ))
+
+    @classmethod
+    def refresh(cls, party_ids):
+        "Replace the keys of the parties by keys built from their values"
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        party_ids = list(set(party_ids))
+        for sub_ids in grouped_slice(party_ids, cls._batch_size):
+            sub_ids = list(sub_ids)
+            for sub_sub_ids in grouped_slice(sub_ids):
+                cursor.execute(*table.delete(
+                    where=reduce_ids(table.party, list(sub_sub_ids))
+                ))
+            cls.insert_keys(cls.get_keys(*cls.read_parties(sub_ids)))
+
+    @classmethod
+    def match(cls, party_id, max_block_size):
+        """Return a dictionary of the parties sharing a key with the party
+        and the kinds of the shared keys.
+
+        Like for iter_blocks, the keys shared by more than max_block_size
+        parties are ignored.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        own = cls.__table__()
+        other = cls.__table__()
+
+        blocks = table.join(own, condition=(
+            (table.kind == own.kind) & (table.key == own.key)
+        )).select(
+            table.kind, table.key,
+            where=own.party == party_id,
+            group_by=[table.kind, table.key],
+            having=Count(Literal('*')) <= max_block_size
+        )
+        cursor.execute(*other.join(blocks, condition=(
+            (other.kind == blocks.kind) & (other.key == blocks.key)
+        )).select(
+            other.party, other.kind,
+            where=other.party != party_id
+        ))
+        kinds = defaultdict(set)
+        for other_id, kind in cursor.fetchall():
+            kinds[other_id].add(kind)
+        return kinds
+
+    @classmethod
+    def rebuild(cls):
+        """Rebuild the keys of all the active parties.
+
+        The party table is read in batches of _batch_size ids so the
+        memory used does not depend on the number of parties.
+        """
+        Party = Pool().get('party.party')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        party = Party.__table__()
+
+        cursor.execute(*table.delete())
+        last_id, count = 0, 0
+        while True:
+            cursor.execute(*party.select(
+                party.id,
+                where=(party.id > last_id) & party.active,
+                order_by=party.id.asc, limit=cls._batch_size
+            ))
+            party_ids = [i for i, in cursor.fetchall()]
+            if not party_ids:
+                break
+            cls.insert_keys(cls.get_keys(*cls.read_parties(party_ids)))
+            last_id = party_ids[-1]
+            count += len(party_ids)
+            logger.info('Built duplicate keys of %s parties', count)
+
+    @classmethod
+    def iter_pages(cls, max_block_size):
+        """Yield lists of (kind, key, list of party ids) for the keys shared
+        by more than one and at most max_block_size parties.
+
+        Larger blocks are skipped: a key shared by that many parties does
+        not identify anyone and would make the comparisons quadratic. The
+        keys are read by pages of _batch_size rows following the index on
+        the key (keyset pagination) so the memory used does not depend on
+        the number of keys.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        limit = max(cls._batch_size, max_block_size + 1)
+        last = None
+        while True:
+            where = None
+            if last:
+                last_key, last_kind = last
+                where = (table.key > last_key) | (
+                    (table.key == last_key) & (table.kind > last_kind)
+                )
+            cursor.execute(*table.select(
+                table.kind, table.key, table.party, where=where,
+                order_by=[table.key.asc, table.kind.asc], limit=limit
+            ))
+            rows = cursor.fetchall()
+            blocks = []
+            for kind, key_, party_id in rows:
+                if not blocks or blocks[-1][:2] != (kind, key_):
+                    blocks.append((kind, key_, []))
+                blocks[-1][2].append(party_id)
+            if len(rows) == limit and len(blocks) > 1:
+                # The last block may continue on the next page
+                blocks.pop()
+            if blocks:
+                last = blocks[-1][1], blocks[-1][0]
+            yield [
+                b for b in blocks if 1 < len(b[2]) <= max_block_size
+            ]
+            if len(rows) < limit:
+                break
+
+    @classmethod
+    def iter_blocks(cls, max_block_size):
+        """Yield (kind, list of party ids) for each key shared by more than
+        one and at most max_block_size parties (see iter_pages).
+        """
+        for blocks in cls.iter_pages(max_block_size):
+            for kind, _, party_ids in blocks:
+                yield kind, party_ids
+
+    @classmethod
+    def shared_keys(cls, party_ids, max_block_size):
+        """Return a dictionary of the parties to the set of (key, kind) they
+        share with more than one and at most max_block_size parties.
+
+        The size of the blocks of their keys is counted once per key before
+        joining the parties, so the oversized blocks are never expanded.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        own = cls.__table__()
+        counted = cls.__table__()
+
+        keys = defaultdict(set)
+        for sub_ids in grouped_slice(party_ids):
+            sub_ids = list(sub_ids)
+            own_keys = own.select(
+                own.kind, own.key,
+                where=reduce_ids(own.party, sub_ids),
+                group_by=[own.kind, own.key]
+            )
+            blocks = counted.join(own_keys, condition=(
+                (counted.kind == own_keys.kind) &
+                (counted.key == own_keys.key)
+            )).select(
+                counted.kind, counted.key,
+                group_by=[counted.kind, counted.key],
+                having=(Count(Literal('*')) > 1) &
+                (Count(Literal('*')) <= max_block_size)
+            )
+            cursor.execute(*table.join(blocks, condition=(
+                (table.kind == blocks.kind) & (table.key == blocks.key)
+            )).select(
+                table.party, table.kind, table.key,
+                where=reduce_ids(table.party, sub_ids)
+            ))
+            for party_id, kind, key_ in cursor.fetchall():
+                keys[party_id].add((key_, kind))
+        return keys
+
+
+class PartyDuplicateCluster(Workflow, ModelSQL, ModelView):
+    'Party Duplicate Cluster'
+    __name__ = 'party.duplicate.cluster'
+
+    members = fields.One2Many(
+        'party.duplicate.cluster.member', 'cluster', 'Members',
+        readonly=True,
+    )
+    score = fields.Float('Score', digits=(16, 2), readonly=True)
+    state = fields.Selection([
+        ('open', 'Open'),
+        ('merged', 'Merged'),
+        ('ignored', 'Ignored'),
+    ], 'State', required=True, readonly=True, select=True)
+
+    #: Pairs of parties with a score below the threshold are not duplicates
+    _threshold = 0.8
+    _max_block_size = 50
+
+    @classmethod
+    def __setup__(cls):
+        super(PartyDuplicateCluster, cls).__setup__()
+        cls._order.insert(0, ('score', 'DESC'))
+        cls._transitions |= set((
+            ('open', 'merged'),
+            ('open', 'ignored'),
+            ('ignored', 'open'),
+        ))
+        cls._buttons.update({
+            'ignore': {
+                'invisible': Eval('state') != 'open',
+            },
+            'reopen': {
+                'invisible': Eval('state') != 'ignored',
+            },
+            'merge': {
+                'invisible': Eval('state') != 'open',
+            },
+        })
+
+    @staticmethod
+    def default_state():
+        return 'open'
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('ignored')
+    def ignore(cls, clusters):
+        pass
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('open')
+    def reopen(cls, clusters):
+        pass
+
+    @classmethod
+    @ModelView.button_action('party_merge.wizard_party_merge')
+    def merge(cls, clusters):
+        pass
+
+    @classmethod
+    @Workflow.transition('merged')
+    def merged(cls, clusters):
+        pass
+
+    @classmethod
+    def score_pairs(cls, max_block_size=None):
+        """Yield the pairs of party ids sharing a blocking key with their
+        score.
+
+        The pairs are scored page by page of blocks (see
+        PartyDuplicateKey.iter_pages) and not accumulated: a pair sharing
+        several keys is yielded once, by the block of its smallest key.
+        """
+        Key = Pool().get('party.duplicate.key')
+
+        if max_block_size is None:
+            max_block_size = cls._max_block_size
+        for blocks in Key.iter_pages(max_block_size):
+            shared = Key.shared_keys(
+                set(p for _, _, party_ids in blocks for p in party_ids),
+                max_block_size
+            )
+            for kind, key_, party_ids in blocks:
+                for a, b in combinations(sorted(set(party_ids)), 2):
+                    common = shared[a] & shared[b]
+                    if min(common) != (key_, kind):
+                        continue
+                    yield (a, b), score(set(k for _, k in common))
+
+    @staticmethod
+    def clusterize(scores, threshold):
+        """Group the pairs of the iterable of (pair, score) with a score
+        above threshold into clusters. Return a list of (sorted party ids,
+        average score).
+        """
+        parent = {}
+
+        def find(party_id):
+            parent.setdefault(party_id, party_id)
+            while parent[party_id] != party_id:
+                parent[party_id] = parent[parent[party_id]]
+                party_id = parent[party_id]
+            return party_id
+
+        pairs = [(p, s) for p, s in scores if s >= threshold]
+        for (a, b), _ in pairs:
+            parent[find(a)] = find(b)
+
+        members = defaultdict(set)
+        pair_scores = defaultdict(list)
+        for (a, b), score in pairs:
+            root = find(a)
+            members[root].update((a, b))
+            pair_scores[root].append(score)
+        return [
+            (sorted(party_ids),
+                round(sum(pair_scores[r]) / len(pair_scores[r]), 2))
+            for r, party_ids in members.iteritems()
+        ]
+
+    @classmethod
+    def detect(cls, threshold=None, max_block_size=None, rebuild=False):
+        """Replace the open clusters by the newly detected ones. Return the
+        created clusters.
+
+        The blocking keys are maintained incrementally, rebuild them all
+        first only if rebuild is set (e.g. after importing parties with
+        SQL).
+        """
+        Key = Pool().get('party.duplicate.key')
+
+        if threshold is None:
+            threshold = cls._threshold
+        if rebuild:
+            Key.rebuild()
+        clusters = cls.clusterize(
+            cls.score_pairs(max_block_size=max_block_size), threshold
+        )
+        cls.delete(cls.search([('state', '=', 'open')]))
+
+        # Do not propose again what was already ignored
+        ignored = set(
+            tuple(sorted(m.party.id for m in c.members))
+            for c in cls.search([('state', '=', 'ignored')])
+        )
+        created = []
+        to_create = [{
+            'score': score,
+            'members': [('create', [{'party': p} for p in party_ids])],
+        } for party_ids, score in clusters if tuple(party_ids) not in ignored]
+        for sub_values in grouped_slice(to_create):
+            created.extend(cls.create(list(sub_values)))
+        logger.info('Detected %s clusters of duplicate parties', len(created))
+        return created
+
+
+class PartyDuplicateClusterMember(ModelSQL, ModelView):
+    'Party Duplicate Cluster Member'
+    __name__ = 'party.duplicate.cluster.member'
+
+    cluster = fields.Many2One(
+        'party.duplicate.cluster', 'Cluster', required=True, select=True,
+        ondelete='CASCADE',
+    )
+    party = fields.Many2One(
+        'party.party', 'Party', required=True, select=True,
+        ondelete='CASCADE',
+    )
+
+
+class DuplicateKeyMixin(object):
+    "Refresh the duplicate keys of the parties of the modified records"
+
+    @classmethod
+    def _duplicate_party_ids(cls, records):
+        return [r.party.id for r in records if r.party]
+
+    @classmethod
+    def create(cls, vlist):
+        Key = Pool().get('party.duplicate.key')
+        records = super(DuplicateKeyMixin, cls).create(vlist)
+        Key.refresh(cls._duplicate_party_ids(records))
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        Key = Pool().get('party.duplicate.key')
+        records = sum(args[::2], [])
+        # The records may be moved to another party
+        party_ids = cls._duplicate_party_ids(records)
+        super(DuplicateKeyMixin, cls).write(*args)
+        Key.refresh(party_ids + cls._duplicate_party_ids(
+            cls.browse(map(int, records))))
+
+    @classmethod
+    def delete(cls, records):
+        Key = Pool().get('party.duplicate.key')
+        party_ids = cls._duplicate_party_ids(records)
+        super(DuplicateKeyMixin, cls).delete(records)
+        Key.refresh(party_ids)
+
+
+class Address(DuplicateKeyMixin):
+    __metaclass__ = PoolMeta
+    __name__ = 'party.address'
+
+
+class ContactMechanism(DuplicateKeyMixin):
+    __metaclass__ = PoolMeta
+    __name__ = 'party.contact_mechanism'
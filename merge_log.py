@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+"""
+    merge_log.py
+
+    Journal of the merges from which they can be undone.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import json
+import logging
+from collections import defaultdict
+from itertools import groupby
+
+from sql import Table, Column
+
+from trytond.model import Workflow, ModelView, ModelSQL, fields
+from trytond.transaction import Transaction
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from trytond.tools import reduce_ids, grouped_slice
+from trytond.protocols.jsonrpc import JSONEncoder, JSONDecoder
+
+from tools import bulk_insert, insert_rows
+
+__all__ = [
+    'PartyMergeLog', 'PartyMergeLogParty', 'PartyMergeLogEntry',
+    'PartyMergeLogStatistic',
+]
+
+logger = logging.getLogger(__name__)
+
+
+def compress_ids(ids):
+    "Return the sorted ids as a string of ranges like '1-5,8,10-12'"
+    ranges = []
+    ids = sorted(set(ids))
+    for _, group in groupby(enumerate(ids), lambda x: x[1] - x[0]):
+        group = [i for _, i in group]
+        if len(group) > 1:
+            ranges.append('%s-%s' % (group[0], group[-1]))
+        else:
+            ranges.append(str(group[0]))
+    return ','.join(ranges)
+
+
+def expand_ids(value):
+    "Return the list of ids of a string returned by compress_ids"
+    ids = []
+    for range_ in (value or '').split(','):
+        if not range_:
+            continue
+        lower, _, upper = range_.partition('-')
+        ids.extend(xrange(int(lower), int(upper or lower) + 1))
+    return ids
+
+
+class PartyMergeLog(Workflow, ModelSQL, ModelView):
+    'Party Merge Log'
+    __name__ = 'party.merge.log'
+
+    # Emptied but kept when the target is purged (see PartyMerged.purge)
+    target = fields.Many2One(
+        'party.party', 'Target', readonly=True, select=True,
+        ondelete='SET NULL',
+    )
+    parties = fields.Many2Many(
+        'party.merge.log-party.party', 'log', 'party', 'Duplicates',
+        readonly=True,
+    )
+    entries = fields.One2Many(
+        'party.merge.log.entry', 'log', 'Entries', readonly=True,
+    )
+    statistics = fields.One2Many(
+        'party.merge.log.statistic', 'log', 'Statistics', readonly=True,
+    )
+    duration = fields.Float(
+        'Duration (s)', digits=(16, 3), readonly=True,
+        help="Time spent in the UPDATE and DELETE statements.",
+    )
+    lock_wait = fields.Float(
+        'Lock Wait (s)', digits=(16, 3), readonly=True,
+        help="Time lost waiting for locks held by other transactions.",
+    )
+    state = fields.Selection([
+        ('done', 'Done'),
+        ('undone', 'Undone'),
+        ('purged', 'Purged'),
+    ], 'State', required=True, readonly=True, select=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(PartyMergeLog, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+        cls._transitions |= set((
+            ('done', 'undone'),
+            ('done', 'purged'),
+        ))
+        cls._buttons.update({
+            'unmerge': {
+                'invisible': Eval('state') != 'done',
+            },
+        })
+
+    @staticmethod
+    def default_state():
+        return 'done'
+
+    @classmethod
+    def start(cls, parties, target):
+        """Create the log of the merge of parties into target or return None
+        if there is nothing to merge.
+        """
+        LogParty = Pool().get('party.merge.log-party.party')
+
+        party_ids = [p.id for p in parties if p.id != target.id]
+        if not party_ids:
+            return
+        log, = cls.create([{
+            'target': target.id,
+        }])
+        bulk_insert(LogParty, [{
+            'log': log.id,
+            'party': party_id,
+        } for party_id in party_ids])
+        return log
+
+    def record_update(
+            self, table_name, column_name, key_name, reference, rows):
+        """Journal the rows of table_name whose column_name was rewritten.
+
+        rows is the list of (previous party id, key) returned by the UPDATE,
+        key_name is the primary key of the table. The entry stores the keys
+        of each previous party as ranges, so there is one entry per
+        statement whatever the number of parties.
+        """
+        Entry = Pool().get('party.merge.log.entry')
+
+        if not rows:
+            return
+        keys = defaultdict(list)
+        for party_id, key in rows:
+            keys[party_id].append(key)
+        self._record_changes(table_name, [k for _, k in rows])
+        bulk_insert(Entry, [{
+            'log': self.id,
+            'kind': 'update',
+            'table_name': table_name,
+            'column_name': column_name,
+            'key_name': key_name,
+            'reference': reference,
+            'ids': json.dumps(dict(
+                (str(party_id), compress_ids(party_keys))
+                for party_id, party_keys in keys.iteritems()
+            ), sort_keys=True),
+            'count': len(rows),
+        }])
+
+    def record_delete(self, table_name, rows):
+        "Journal the rows (as dictionaries) deleted from table_name"
+        Entry = Pool().get('party.merge.log.entry')
+
+        if not rows:
+            return
+        self._record_changes(table_name, [r.get('id') for r in rows])
+        bulk_insert(Entry, [{
+            'log': self.id,
+            'kind': 'delete',
+            'table_name': table_name,
+            'rows': json.dumps(rows, cls=JSONEncoder),
+            'count': len(rows),
+        }])
+
+    def _record_changes(self, table_name, ids):
+        "Keep the ids of the rows of table_name changed by the merge"
+        Party = Pool().get('party.party')
+
+        models = dict((t.table, t.model) for t in Party.get_merge_targets())
+        model = models.get(table_name)
+        if model is None:
+            # History rows are not cached
+            return
+        changes = self.__dict__.setdefault('_changes', defaultdict(set))
+        changes[model].update(i for i in ids if i is not None)
+
+    def invalidate_caches(self, recompute=True):
+        """Evict the records changed since the last call, the target and
+        the duplicates from the caches of every process, and recompute the
+        values stored from them if recompute is set (see
+        Party.merge_recompute). Return the changes as a dictionary of model
+        name to ids.
+        """
+        pool = Pool()
+        Party = pool.get('party.party')
+        Invalidation = pool.get('party.merge.invalidation')
+
+        changes = self.__dict__.pop('_changes', defaultdict(set))
+        changes[Party.__name__].update(
+            [self.target.id] + [p.id for p in self.parties]
+        )
+        Invalidation.publish(changes)
+        if recompute:
+            Party.merge_recompute(self.target.id, changes)
+        return changes
+
+    def checkpoint(self):
+        "Return the state of the measures and changes kept in memory"
+        return (
+            dict(self.__dict__.get('_statistics', {})),
+            dict(
+                (m, set(i))
+                for m, i in self.__dict__.get('_changes', {}).iteritems()
+            ),
+        )
+
+    def restore(self, checkpoint):
+        "Restore the measures and changes kept in memory to checkpoint"
+        statistics, changes = checkpoint
+        self.__dict__['_statistics'] = dict(statistics)
+        self.__dict__['_changes'] = defaultdict(set, (
+            (m, set(i)) for m, i in changes.iteritems()
+        ))
+
+    def record_lock_wait(self, table_name, seconds):
+        "Add the seconds waited for the locks of table_name"
+        logger.info(
+            'Waited %.3fs for the locks of %s (log %s)',
+            seconds, table_name, self.id
+        )
+        self.lock_wait = round((self.lock_wait or 0) + seconds, 3)
+        self.save()
+
+    def record_statement(
+            self, kind, table_name, column_name, history, duration,
+            rowcount):
+        """Aggregate the measure of a statement of the merge. The measures
+        are kept in memory until save_statistics.
+        """
+        statistics = self.__dict__.setdefault('_statistics', {})
+        key = (kind, table_name, column_name or '', history)
+        statements, rows, total = statistics.get(key, (0, 0, 0))
+        statistics[key] = (statements + 1, rows + rowcount, total + duration)
+
+    def save_statistics(self):
+        "Store the measures aggregated since the last call"
+        Statistic = Pool().get('party.merge.log.statistic')
+
+        statistics = self.__dict__.pop('_statistics', {})
+        if not statistics:
+            return
+        existing = dict(
+            ((s.kind, s.table_name, s.column_name or '', s.history), s)
+            for s in Statistic.search([('log', '=', self.id)])
+        )
+        to_create = []
+        for key, (statements, rows, duration) in statistics.iteritems():
+            statistic = existing.get(key)
+            if statistic:
+                Statistic.write([statistic], {
+                    'statements': statistic.statements + statements,
+                    'rows': statistic.rows + rows,
+                    'duration': round(statistic.duration + duration, 3),
+                })
+                continue
+            kind, table_name, column_name, history = key
+            to_create.append({
+                'log': self.id,
+                'kind': kind,
+                'table_name': table_name,
+                'column_name': column_name or None,
+                'history': history,
+                'statements': statements,
+                'rows': rows,
+                'duration': round(duration, 3),
+            })
+        Statistic.create(to_create)
+        self.duration = round((self.duration or 0) + sum(
+            d for _, _, d in statistics.itervalues()
+        ), 3)
+        self.save()
+        logger.info(
+            'Merge into party %s: %s statements, %s rows in %.3fs',
+            self.target.id, sum(s for s, _, _ in statistics.itervalues()),
+            sum(r for _, r, _ in statistics.itervalues()), self.duration
+        )
+
+    def get_report(self):
+        "Return the statistics as text, the slowest first"
+        lines = []
+        for statistic in sorted(
+                self.statistics, key=lambda s: s.duration, reverse=True):
+            lines.append('%s %s%s%s: %s statements, %s rows, %.3fs' % (
+                statistic.kind.upper(), statistic.table_name,
+                '.%s' % statistic.column_name
+                if statistic.column_name else '',
+                ' (history)' if statistic.history else '',
+                statistic.statements, statistic.rows, statistic.duration,
+            ))
+        return '\n'.join(lines)
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('undone')
+    def unmerge(cls, logs):
+        """Undo the merges replaying their journal backwards.
+
+        Only the rows which still reference the target are given back to
+        the duplicates, the duplicates are activated again. The values
+        stored from the rows given back are recomputed like for the merge.
+        """
+        pool = Pool()
+        Party = pool.get('party.party')
+        Key = pool.get('party.duplicate.key')
+        Merged = pool.get('party.party.merged')
+
+        for log in sorted(logs, key=lambda x: x.id, reverse=True):
+            logger.info('Undoing the merge into party %s', log.target.id)
+            for entry in sorted(
+                    log.entries, key=lambda e: e.id, reverse=True):
+                log._record_changes(
+                    entry.table_name, entry.undo(log.target.id)
+                )
+            Merged.restore(map(int, log.parties), log.target.id)
+            Party.write(list(log.parties), {'active': True})
+            Key.refresh([log.target.id])
+            # The rows were given back with SQL too
+            log.invalidate_caches()
+
+    @classmethod
+    @Workflow.transition('purged')
+    def purge(cls, logs):
+        """The duplicates of the logs are being deleted (see
+        PartyMerged.purge), the merges can not be undone anymore.
+        """
+        pass
+
+
+class PartyMergeLogParty(ModelSQL):
+    'Party Merge Log - Party'
+    __name__ = 'party.merge.log-party.party'
+    _table = 'party_merge_log_party_rel'
+
+    log = fields.Many2One(
+        'party.merge.log', 'Log', ondelete='CASCADE', required=True,
+        select=True,
+    )
+    party = fields.Many2One(
+        'party.party', 'Party', ondelete='CASCADE', required=True,
+        select=True,
+    )
+
+
+class PartyMergeLogEntry(ModelSQL, ModelView):
+    'Party Merge Log Entry'
+    __name__ = 'party.merge.log.entry'
+
+    log = fields.Many2One(
+        'party.merge.log', 'Log', ondelete='CASCADE', required=True,
+        select=True, readonly=True,
+    )
+    kind = fields.Selection([
+        ('update', 'Update'),
+        ('delete', 'Delete'),
+    ], 'Kind', required=True, readonly=True)
+    table_name = fields.Char('Table', required=True, readonly=True)
+    column_name = fields.Char('Column', readonly=True)
+    key_name = fields.Char('Key', readonly=True)
+    reference = fields.Boolean('Reference', readonly=True)
+    ids = fields.Text(
+        'IDs', readonly=True,
+        help="The keys of the rows per previous party as ranges.",
+    )
+    rows = fields.Text('Rows', readonly=True)
+    count = fields.Integer('Count', readonly=True)
+
+    def _value(self, party_id):
+        if self.reference:
+            return '%s,%s' % (Pool().get('party.party').__name__, party_id)
+        return party_id
+
+    def undo(self, target_id):
+        """Restore the rows journaled by the entry and return the keys of
+        the rows restored or given back.
+        """
+        cursor = Transaction().cursor
+        table = Table(self.table_name)
+
+        if self.kind == 'delete':
+            rows = json.loads(self.rows, object_hook=JSONDecoder())
+            insert_rows(table, rows)
+            return [r.get('id') for r in rows]
+
+        column = Column(table, self.column_name)
+        keys = []
+        for party_id, ids in self.get_keys().iteritems():
+            keys.extend(ids)
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*table.update(
+                    columns=[column],
+                    values=[self._value(party_id)],
+                    where=reduce_ids(
+                        Column(table, self.key_name), list(sub_ids))
+                    & (column == self._value(target_id))
+                ))
+        return keys
+
+    def get_keys(self):
+        "Return the dictionary of previous party id to the keys of an update"
+        return dict(
+            (int(party_id), expand_ids(ids))
+            for party_id, ids in json.loads(self.ids or '{}').iteritems()
+        )
+
+
+class PartyMergeLogStatistic(ModelSQL, ModelView):
+    'Party Merge Log Statistic'
+    __name__ = 'party.merge.log.statistic'
+
+    log = fields.Many2One(
+        'party.merge.log', 'Log', ondelete='CASCADE', required=True,
+        select=True, readonly=True,
+    )
+    kind = fields.Selection([
+        ('update', 'Update'),
+        ('delete', 'Delete'),
+        ('step', 'Step'),
+    ], 'Kind', required=True, readonly=True)
+    table_name = fields.Char(
+        'Table', required=True, readonly=True,
+        help="The name of the step for the merge steps.",
+    )
+    column_name = fields.Char('Column', readonly=True)
+    history = fields.Boolean('History', readonly=True)
+    statements = fields.Integer('Statements', readonly=True)
+    rows = fields.Integer('Rows', readonly=True)
+    duration = fields.Float('Duration (s)', digits=(16, 3), readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(PartyMergeLogStatistic, cls).__setup__()
+        cls._order.insert(0, ('duration', 'DESC'))
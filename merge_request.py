@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+"""
+    merge_request.py
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import time
+import random
+import logging
+import datetime
+import threading
+import traceback
+
+from trytond.model import Workflow, ModelView, ModelSQL, fields
+from trytond.transaction import Transaction
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from sql.conditionals import Coalesce
+
+from party import CONFLICT_POLICIES
+
+__all__ = [
+    'PartyMergeRequest', 'PartyMergeRequestParty',
+    'PartyMergeRequestCheckpoint',
+]
+
+logger = logging.getLogger(__name__)
+
+STATES = {
+    'readonly': Eval('state') != 'pending',
+}
+DEPENDS = ['state']
+
+
+class PartyMergeRequest(Workflow, ModelSQL, ModelView):
+    'Party Merge Request'
+    __name__ = 'party.merge.request'
+
+    target = fields.Many2One(
+        'party.party', 'Target', required=True, select=True,
+        states=STATES, depends=DEPENDS,
+    )
+    parties = fields.Many2Many(
+        'party.merge.request-party.party', 'request', 'party', 'Duplicates',
+        required=True, domain=[('id', '!=', Eval('target'))],
+        states=STATES, depends=DEPENDS + ['target'],
+    )
+    conflict_policy = fields.Selection(
+        CONFLICT_POLICIES, 'Conflict Policy', required=True,
+        states=STATES, depends=DEPENDS,
+    )
+    chunk_size = fields.Integer(
+        'Chunk Size', states=STATES, depends=DEPENDS,
+        help="Maximum number of rows rewritten per transaction. "
+        "Leave empty to merge in a single transaction.",
+    )
+    workers = fields.Integer(
+        'Workers', states=STATES, depends=DEPENDS,
+        help="Number of database connections rewriting the tables "
+        "concurrently (PostgreSQL only).",
+    )
+    consolidate = fields.Boolean(
+        'Consolidate', states=STATES, depends=DEPENDS,
+        help="Copy the best values of the duplicates to the target before "
+        "merging.",
+    )
+    checkpoints = fields.One2Many(
+        'party.merge.request.checkpoint', 'request', 'Checkpoints',
+        readonly=True,
+    )
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ('cancel', 'Canceled'),
+    ], 'State', required=True, readonly=True, select=True)
+    start_date = fields.DateTime('Start Date', readonly=True)
+    heartbeat = fields.DateTime(
+        'Heartbeat', readonly=True,
+        help="Last time the worker running the request was seen alive.",
+    )
+    end_date = fields.DateTime('End Date', readonly=True)
+    duration = fields.Function(
+        fields.Float('Duration (s)', digits=(16, 3)), 'get_duration'
+    )
+    log = fields.Many2One('party.merge.log', 'Log', readonly=True)
+    error = fields.Text('Error', readonly=True, states={
+        'invisible': Eval('state') != 'failed',
+    }, depends=DEPENDS)
+
+    # A running request whose heartbeat is older than the timeout has been
+    # abandoned by its worker (crash, restart, ...)
+    _heartbeat_interval = datetime.timedelta(seconds=60)
+    _stale_timeout = datetime.timedelta(minutes=10)
+    #: How many times a request is run again, in a new transaction, when it
+    #: conflicted with another transaction (see Party.merge_retryable)
+    _retries = 5
+
+    @classmethod
+    def __setup__(cls):
+        super(PartyMergeRequest, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+        cls._transitions |= set((
+            ('pending', 'running'),
+            ('running', 'done'),
+            ('running', 'failed'),
+            ('running', 'pending'),
+            ('failed', 'pending'),
+            ('pending', 'cancel'),
+            ('cancel', 'pending'),
+        ))
+        cls._buttons.update({
+            'cancel': {
+                'invisible': Eval('state') != 'pending',
+            },
+            'retry': {
+                'invisible': ~Eval('state').in_(
+                    ['failed', 'cancel', 'running']
+                ),
+            },
+        })
+        cls._error_messages.update({
+            'running': 'The request "%s" is still run by a worker.',
+        })
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_conflict_policy():
+        return Pool().get('party.party')._merge_conflict_policy
+
+    def get_duration(self, name):
+        if self.start_date and self.end_date:
+            delta = self.end_date - self.start_date
+            return delta.days * 86400 + delta.seconds + \
+                delta.microseconds / 1000000.0
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('cancel')
+    def cancel(cls, requests):
+        pass
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('pending')
+    def retry(cls, requests):
+        stale = datetime.datetime.now() - cls._stale_timeout
+        for request in requests:
+            if request.state == 'running' and \
+                    (request.heartbeat or request.start_date) > stale:
+                cls.raise_user_error('running', (request.rec_name,))
+        cls.write(requests, {
+            'start_date': None,
+            'heartbeat': None,
+            'end_date': None,
+            'error': None,
+        })
+
+    @classmethod
+    def enqueue(
+            cls, parties, target, conflict_policy=None, chunk_size=None,
+            workers=None, consolidate=False):
+        """Create a pending request to merge parties into target.
+        """
+        values = {
+            'target': target.id,
+            'parties': [('add', map(int, parties))],
+            'chunk_size': chunk_size,
+            'workers': workers,
+            'consolidate': consolidate,
+        }
+        if conflict_policy:
+            values['conflict_policy'] = conflict_policy
+        request, = cls.create([values])
+        return request
+
+    @classmethod
+    def process(cls, limit=None):
+        """Process the pending requests, each one in its own transaction.
+
+        This is the entry point of the workers and of the cron, requests
+        claimed by another worker are skipped. The requests abandoned by a
+        dead worker are recovered first. Returns the number of processed
+        requests.
+        """
+        cls.recover()
+        count = 0
+        for request_id in cls.claim(limit=limit):
+            cls.execute(request_id)
+            count += 1
+        return count
+
+    @classmethod
+    def claim(cls, limit=None):
+        """Mark pending requests as running and return their ids.
+
+        The claim is committed in its own transaction so that concurrent
+        workers never pick the same request.
+        """
+        table = cls.__table__()
+        claimed = []
+        with Transaction().new_cursor() as transaction:
+            cursor = transaction.cursor
+            cursor.execute(*table.select(
+                table.id, where=table.state == 'pending',
+                order_by=table.id.asc, limit=limit
+            ))
+            for request_id, in cursor.fetchall():
+                now = datetime.datetime.now()
+                cursor.execute(*table.update(
+                    columns=[table.state, table.start_date, table.heartbeat],
+                    values=['running', now, now],
+                    where=(table.id == request_id) &
+                    (table.state == 'pending')
+                ))
+                if cursor.rowcount:
+                    claimed.append(request_id)
+            cursor.commit()
+        return claimed
+
+    @classmethod
+    def recover(cls):
+        """Put back to pending the running requests whose heartbeat is
+        stale and return their ids.
+
+        The checkpoints are kept so that the next worker resumes the merge
+        where the dead one stopped. The prepared transactions of the
+        parallel merges are finished too (see Party.merge_parallel_recover).
+        """
+        Pool().get('party.party').merge_parallel_recover()
+        table = cls.__table__()
+        stale = datetime.datetime.now() - cls._stale_timeout
+        with Transaction().new_cursor() as transaction:
+            cursor = transaction.cursor
+            cursor.execute(*table.select(
+                table.id, where=(table.state == 'running') &
+                (Coalesce(table.heartbeat, table.start_date) < stale),
+                order_by=table.id.asc
+            ))
+            recovered = [request_id for request_id, in cursor.fetchall()]
+            for request_id in recovered:
+                logger.warning(
+                    'Merge request %s abandoned by its worker', request_id
+                )
+                cursor.execute(*table.update(
+                    columns=[table.state],
+                    values=['pending'],
+                    where=(table.id == request_id) &
+                    (table.state == 'running')
+                ))
+            cursor.commit()
+        return recovered
+
+    @classmethod
+    def beat(cls, start, request_id, stop):
+        """Refresh the heartbeat of the request until stop is set, each time
+        in a new transaction started with the database name and user of
+        start.
+
+        This is the body of the heartbeat thread of execute.
+        """
+        table = cls.__table__()
+        database_name, user = start
+        interval = cls._heartbeat_interval
+        while not stop.wait(
+                interval.days * 86400 + interval.seconds):
+            with Transaction().start(database_name, user) as transaction:
+                cursor = transaction.cursor
+                cursor.execute(*table.update(
+                    columns=[table.heartbeat],
+                    values=[datetime.datetime.now()],
+                    where=(table.id == request_id) &
+                    (table.state == 'running')
+                ))
+                cursor.commit()
+
+    @classmethod
+    def execute(cls, request_id):
+        """Execute a claimed request in a new transaction and record the
+        outcome.
+        """
+        transaction = Transaction()
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=cls.beat, args=(
+            (transaction.cursor.database_name, transaction.user),
+            request_id, stop
+        ))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            cls._execute(request_id)
+        finally:
+            stop.set()
+            heartbeat.join()
+
+    @classmethod
+    def _execute(cls, request_id):
+        Party = Pool().get('party.party')
+        for attempt in range(cls._retries + 1):
+            with Transaction().new_cursor() as transaction:
+                try:
+                    request = cls(request_id)
+                    logger.info(
+                        'Merging %s parties into party %s (request %s)',
+                        len(request.parties), request.target.id, request_id
+                    )
+                    request.run()
+                    cls.write([request], {
+                        'state': 'done',
+                        'end_date': datetime.datetime.now(),
+                    })
+                    transaction.cursor.commit()
+                    return
+                except Exception as exception:
+                    transaction.cursor.rollback()
+                    if (Party.merge_retryable(exception)
+                            and attempt < cls._retries):
+                        # The committed chunks are resumed
+                        delay = Party._merge_lock_backoff * 2 ** attempt
+                        logger.info(
+                            'Merge request %s conflicted with another '
+                            'transaction, retrying in %.1fs',
+                            request_id, delay
+                        )
+                        time.sleep(delay * random.uniform(0.5, 1.5))
+                        continue
+                    logger.error(
+                        'Merge request %s failed', request_id, exc_info=True
+                    )
+                    tb_s = ''.join(
+                        traceback.format_exception(*sys.exc_info())
+                    )
+                    cls.write([cls(request_id)], {
+                        'state': 'failed',
+                        'end_date': datetime.datetime.now(),
+                        'error': tb_s.decode('utf-8', 'ignore'),
+                    })
+                    transaction.cursor.commit()
+                    return
+
+    def run(self):
+        """Merge the parties of the request in the current transaction.
+
+        With a chunk size, the transaction is committed after each chunk
+        together with a checkpoint from which a failed request resumes when
+        it is retried. With workers, the tables are rewritten concurrently
+        (see Party.merge_parallel).
+        """
+        pool = Pool()
+        Party = pool.get('party.party')
+        Checkpoint = pool.get('party.merge.request.checkpoint')
+        MergeLog = pool.get('party.merge.log')
+
+        if self.consolidate and not self.log:
+            Party.merge_consolidate(self.parties, self.target)
+
+        if self.workers and self.workers > 1:
+            self.log = Party.merge_parallel(
+                self.parties, self.target, self.workers,
+                conflict_policy=self.conflict_policy
+            )
+            self.save()
+            return
+
+        if not self.chunk_size:
+            self.log = Party.merge(
+                self.parties, self.target,
+                conflict_policy=self.conflict_policy
+            )
+            self.save()
+            return
+
+        if not self.log:
+            # The log must survive the commits of the chunks
+            self.log = MergeLog.start(self.parties, self.target)
+            self.save()
+
+        checkpoints = dict(
+            ((c.table_name, c.column_name, c.history), c)
+            for c in self.checkpoints
+        )
+        for merge_target, history, last_id in Party.merge_in_chunks(
+                self.parties, self.target, self.chunk_size,
+                conflict_policy=self.conflict_policy,
+                resume=dict(
+                    (key, c.last_id) for key, c in checkpoints.iteritems()
+                ), log=self.log):
+            key = (merge_target.table, merge_target.column, history)
+            checkpoint = checkpoints.get(key)
+            if checkpoint is None:
+                checkpoint = checkpoints[key] = Checkpoint(
+                    request=self, table_name=merge_target.table,
+                    column_name=merge_target.column, history=history,
+                )
+            checkpoint.last_id = last_id
+            checkpoint.save()
+            self.heartbeat = datetime.datetime.now()
+            self.save()
+            Transaction().cursor.commit()
+
+
+class PartyMergeRequestParty(ModelSQL):
+    'Party Merge Request - Party'
+    __name__ = 'party.merge.request-party.party'
+    _table = 'party_merge_request_party_rel'
+
+    request = fields.Many2One(
+        'party.merge.request', 'Request', ondelete='CASCADE', required=True,
+        select=True,
+    )
+    party = fields.Many2One(
+        'party.party', 'Party', ondelete='CASCADE', required=True,
+        select=True,
+    )
+
+
+class PartyMergeRequestCheckpoint(ModelSQL, ModelView):
+    'Party Merge Request Checkpoint'
+    __name__ = 'party.merge.request.checkpoint'
+
+    request = fields.Many2One(
+        'party.merge.request', 'Request', ondelete='CASCADE', required=True,
+        select=True, readonly=True,
+    )
+    table_name = fields.Char('Table', required=True, readonly=True)
+    column_name = fields.Char('Column', required=True, readonly=True)
+    history = fields.Boolean('History', readonly=True)
+    last_id = fields.Integer(
+        'Last ID', required=True, readonly=True,
+        help="The rows up to this id have been merged.",
+    )
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+    merged.py
+
+    Redirection of the merged parties to the party they were merged into.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import logging
+import datetime
+
+from sql import Literal
+from sql.aggregate import Count
+
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.transaction import Transaction
+from trytond.pool import Pool
+from trytond.tools import reduce_ids, grouped_slice
+
+from party import resolve_merge_chains
+from cache import MergeCache
+from tools import bulk_insert
+
+__all__ = ['PartyMerged']
+
+logger = logging.getLogger(__name__)
+
+
+class PartyMerged(ModelSQL, ModelView):
+    'Merged Party'
+    __name__ = 'party.party.merged'
+
+    # Not a Many2One: the redirection must outlive the purge of the party
+    party = fields.Integer(
+        'Party', required=True, readonly=True, select=True,
+        help="The id of the merged party.",
+    )
+    target = fields.Many2One(
+        'party.party', 'Target', required=True, readonly=True, select=True,
+        ondelete='CASCADE',
+        help="The party into which it was finally merged.",
+    )
+    date = fields.DateTime('Date', required=True, readonly=True)
+
+    _resolve_cache = MergeCache(
+        'party.party.merged.resolve', size_limit=10000, context=False
+    )
+    #: How long a merged party is kept before it can be purged
+    _purge_delay = datetime.timedelta(days=90)
+    #: Number of parties deleted per transaction by the purge
+    _purge_batch_size = 500
+
+    @classmethod
+    def __setup__(cls):
+        super(PartyMerged, cls).__setup__()
+        cls._order.insert(0, ('date', 'DESC'))
+        cls._sql_constraints += [
+            ('party_uniq', 'UNIQUE(party)',
+                'A party can be merged only once.'),
+        ]
+
+    @classmethod
+    def record(cls, party_ids, target_id):
+        """Redirect the parties to target_id, and so the parties which were
+        merged into them. The targets stay the final ones.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        for sub_ids in grouped_slice(party_ids):
+            sub_ids = list(sub_ids)
+            cursor.execute(*table.update(
+                columns=[table.target], values=[target_id],
+                where=reduce_ids(table.target, sub_ids)
+            ))
+            cursor.execute(*table.delete(
+                where=reduce_ids(table.party, sub_ids)
+            ))
+        now = datetime.datetime.now()
+        bulk_insert(cls, [{
+            'party': party_id,
+            'target': target_id,
+            'date': now,
+        } for party_id in party_ids])
+
+    @classmethod
+    def restore(cls, party_ids, target_id):
+        """Remove the redirections of the parties merged into target_id by
+        a merge which is undone. The parties which were merged into them
+        are redirected to them again.
+        """
+        Party = Pool().get('party.party')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        # The previous merges of the redirected parties, without this one
+        parents = Party._merge_previous_targets()
+        for party_id in party_ids:
+            if parents.get(party_id) == target_id:
+                del parents[party_id]
+        final, _ = resolve_merge_chains(parents)
+
+        for sub_ids in grouped_slice(party_ids):
+            cursor.execute(*table.delete(
+                where=reduce_ids(table.party, list(sub_ids))
+            ))
+        cursor.execute(*table.select(
+            table.id, table.party, where=table.target == target_id
+        ))
+        for merged_id, party_id in cursor.fetchall():
+            previous_id = final.get(party_id, target_id)
+            if previous_id != target_id:
+                cursor.execute(*table.update(
+                    columns=[table.target], values=[previous_id],
+                    where=table.id == merged_id
+                ))
+        cls._resolve_cache.clear()
+
+    @classmethod
+    def targets(cls, party_ids=None):
+        """Return the dictionary of the merged party ids (among party_ids)
+        to the id of their final target.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        if party_ids is None:
+            cursor.execute(*table.select(table.party, table.target))
+            return dict(cursor.fetchall())
+        targets = {}
+        for sub_ids in grouped_slice(sorted(party_ids)):
+            cursor.execute(*table.select(
+                table.party, table.target,
+                where=reduce_ids(table.party, list(sub_ids))
+            ))
+            targets.update(cursor.fetchall())
+        return targets
+
+    @classmethod
+    def resolve(cls, party_id):
+        """Return the id of the party into which party_id was merged, or
+        party_id itself. The redirections are cached in memory until a merge
+        changes them.
+        """
+        return cls.resolve_ids([party_id])[0]
+
+    @classmethod
+    def resolve_ids(cls, party_ids):
+        """Return the list of the ids of the parties into which party_ids
+        were merged (or the ids themselves), reading only the ids which are
+        not cached.
+        """
+        Party = Pool().get('party.party')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        targets = {}
+        missing = set()
+        for party_id in party_ids:
+            target_id = cls._resolve_cache.get(party_id)
+            if target_id is None:
+                missing.add(party_id)
+            else:
+                targets[party_id] = target_id
+        for sub_ids in grouped_slice(sorted(missing)):
+            sub_ids = list(sub_ids)
+            cursor.execute(*table.select(
+                table.party, table.target,
+                where=reduce_ids(table.party, sub_ids)
+            ))
+            found = dict(cursor.fetchall())
+            for party_id in sub_ids:
+                target_id = found.get(party_id, party_id)
+                # Evicted when a merge changes the party or its target
+                targets[party_id] = cls._resolve_cache.set(
+                    party_id, target_id, records=[
+                        (Party.__name__, party_id),
+                        (Party.__name__, target_id),
+                    ]
+                )
+        return [targets[i] for i in party_ids]
+
+    @classmethod
+    def _purge_query(cls, delay=None):
+        "Return the query of the merged parties which can be purged"
+        Party = Pool().get('party.party')
+        table = cls.__table__()
+        party = Party.__table__()
+
+        if delay is None:
+            delay = cls._purge_delay
+        return table.join(
+            party, condition=table.party == party.id
+        ).select(
+            table.party,
+            where=~party.active
+            & (table.date < datetime.datetime.now() - delay)
+        )
+
+    @classmethod
+    def _purge_blocking_targets(cls):
+        """Return the MergeTarget of the columns whose rows must not
+        reference a purged party: the Reference fields and the Many2One
+        fields not deleted together with the party. The models keeping
+        track of the merges are included, except the logs which keep the
+        journal of the purged parties.
+        """
+        pool = Pool()
+        Party = pool.get('party.party')
+
+        targets = []
+        for merge_target in Party._build_merge_targets(
+                excluded_models=('party.merge.log',)):
+            field = pool.get(merge_target.model)._fields[merge_target.field]
+            if getattr(field, 'ondelete', None) != 'CASCADE':
+                targets.append(merge_target)
+        return targets
+
+    @classmethod
+    def purge_batches(cls, batch_size=None, delay=None):
+        """Delete the parties merged for longer than delay (_purge_delay
+        by default) by batches of at most batch_size parties.
+
+        The rows referencing a batch are searched with one grouped query
+        per blocking column (see _purge_blocking_targets), the parties
+        still referenced are kept. The other ones are deleted with the
+        rows depending on them (their addresses, contact mechanisms, ...)
+        but their redirection is kept. The merges of which they were a
+        duplicate or the target can not be undone anymore, their logs are
+        kept.
+
+        This is a generator which yields (purged ids, referenced ids) after
+        each batch so that the caller decides when to commit.
+        """
+        pool = Pool()
+        Party = pool.get('party.party')
+        MergeLog = pool.get('party.merge.log')
+        Invalidation = pool.get('party.merge.invalidation')
+        cursor = Transaction().cursor
+
+        if batch_size is None:
+            batch_size = cls._purge_batch_size
+        targets = cls._purge_blocking_targets()
+        query = cls._purge_query(delay)
+        where = query.where
+        party_column, = query.columns
+        query.order_by = [party_column.asc]
+        query.limit = batch_size
+
+        last_id = 0
+        while True:
+            query.where = where & (party_column > last_id)
+            cursor.execute(*query)
+            party_ids = [i for i, in cursor.fetchall()]
+            if not party_ids:
+                break
+            last_id = party_ids[-1]
+
+            referenced = set()
+            for merge_target in targets:
+                referenced |= Party._merge_referenced(merge_target, party_ids)
+            purged = [i for i in party_ids if i not in referenced]
+            if purged:
+                with Transaction().set_context(active_test=False):
+                    MergeLog.purge(MergeLog.search([
+                        ('state', '=', 'done'),
+                        ['OR',
+                            ('parties', 'in', purged),
+                            ('target', 'in', purged)],
+                    ]))
+                    Party.delete(Party.browse(purged))
+                Invalidation.publish({Party.__name__: purged})
+            yield purged, sorted(referenced)
+
+    @classmethod
+    def purge_count(cls, delay=None):
+        "Return the number of merged parties which could be purged"
+        cursor = Transaction().cursor
+        cursor.execute(*cls._purge_query(delay).select(Count(Literal('*'))))
+        return cursor.fetchone()[0]
+
+    @classmethod
+    def purge(cls, batch_size=None, delay=None):
+        """Purge the merged parties committing after each batch. This is
+        the entry point of the cron, returns the number of purged parties.
+        """
+        cursor = Transaction().cursor
+
+        total = cls.purge_count(delay)
+        start = time.time()
+        purged = referenced = 0
+        for purged_ids, referenced_ids in cls.purge_batches(
+                batch_size=batch_size, delay=delay):
+            cursor.commit()
+            purged += len(purged_ids)
+            referenced += len(referenced_ids)
+            elapsed = time.time() - start
+            logger.info(
+                'Purged %s/%s merged parties (%s still referenced) in %.1fs '
+                '(%.1f/s)', purged, total, referenced, elapsed,
+                purged / elapsed if elapsed else 0
+            )
+        return purged
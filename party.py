@@ -5,91 +5,1998 @@
     :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
-from trytond.model import ModelView, fields
+import re
+import sys
+import time
+import hashlib
+import Queue
+import random
+import logging
+import operator
+import datetime
+import threading
+from collections import namedtuple, defaultdict
+
+from sql import Table, Column, Literal, Null
+from sql.aggregate import Count, Min
+from sql.conditionals import Coalesce, Case
+
+from trytond import backend
+from trytond.model import ModelView, ModelSQL, fields
 from trytond.transaction import Transaction
 from trytond.pool import PoolMeta, Pool
+from trytond.tools import reduce_ids, grouped_slice
 from trytond.pyson import Eval
 from trytond.wizard import Wizard, StateView, StateTransition, Button
 
+from duplicate import score
+
 __metaclass__ = PoolMeta
-__all__ = ['Party', 'PartyMergeView', 'PartyMerge']
+__all__ = [
+    'Party', 'PartyMergeStaged', 'PartyMergeView', 'PartyMergePreview',
+    'PartyMergePreviewLine', 'PartyMergePlan', 'PartyMergeReport',
+    'PartyMerge',
+]
+
+logger = logging.getLogger(__name__)
+
+_RE_UNIQUE = re.compile(r'UNIQUE\s*\((.*)\)', re.I)
+# SQLSTATE of PostgreSQL when lock_timeout expired
+_LOCK_NOT_AVAILABLE = '55P03'
+# SQLSTATE of PostgreSQL when a row was updated by a concurrent transaction
+# committed after the snapshot (REPEATABLE READ) or on a deadlock, only a new
+# transaction can succeed
+_TRANSACTION_ROLLBACK = ('40001', '40P01')
+
+#: How the rows which would violate a unique constraint once merged are
+#: resolved: keep the row of the target party (or else the oldest row), keep
+#: the most recently modified row or delete all the rows of the duplicates.
+CONFLICT_POLICIES = [
+    ('keep_target', 'Keep Target Row'),
+    ('keep_newest', 'Keep Newest Row'),
+    ('delete_source', 'Delete Duplicate Rows'),
+]
+
+#: A column referencing a party which is rewritten by a merge.
+#:
+#: ``kind`` is the type of the field (many2one, reference or many2many for
+#: the party column of a Many2Many relation table), ``table`` and ``column``
+#: name the SQL column and ``history`` the name of the history table of the
+#: model (or None if the model is not historized). ``unique`` lists the
+#: tuples of other columns which must stay unique together with the party
+#: column (from the Many2Many relation or the SQL unique constraints).
+MergeTarget = namedtuple('MergeTarget', [
+    'model', 'field', 'kind', 'table', 'column', 'history', 'unique',
+])
+
+#: A custom step of a merge declared by another module in
+#: ``Party._merge_steps``.
+#:
+#: ``method`` is the name of a classmethod of party.party called once per
+#: merge with all the duplicates as ``method(source_ids, target_id,
+#: conflict_policy, log=None)``; it returns the number of rows it handled.
+#: ``sequence`` orders the step with the others and with the rewrite of the
+#: referencing columns (at ``Party._merge_rewrite_sequence``) and ``tables``
+#: lists the tables it handles, which are left out of the rewrite.
+MergeStep = namedtuple('MergeStep', ['name', 'sequence', 'method', 'tables'])
+
+
+def resolve_merge_chains(parents):
+    """Return the final target of the parties of parents, a dictionary of
+    party id to the id of the party it is merged into, and the ids of the
+    parties in a cycle.
+
+    This is the find of a union-find with path compression: with A merged
+    into B and B into C, both A and B get C as final target.
+    """
+    final = {}
+    cycles = set()
+    for party_id in parents:
+        path = []
+        on_path = set()
+        node = party_id
+        while node in parents and node not in final:
+            if node in on_path:
+                cycles.update(path[path.index(node):])
+                break
+            path.append(node)
+            on_path.add(node)
+            node = parents[node]
+        root = final.get(node, node)
+        for node in path:
+            final[node] = root
+    for party_id in cycles | set(
+            i for i, t in final.iteritems() if t in cycles):
+        final.pop(party_id, None)
+        cycles.add(party_id)
+    return final, cycles
+
+
+class _MergeJournal(object):
+    """Collect the journal of a merge done on another database connection to
+    record it later in a party.merge.log.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def record_update(self, *args):
+        self.records.append(('record_update', args))
+
+    def record_delete(self, *args):
+        self.records.append(('record_delete', args))
+
+    def record_lock_wait(self, *args):
+        self.records.append(('record_lock_wait', args))
+
+    def record_statement(self, *args):
+        self.records.append(('record_statement', args))
+
+    def replay(self, log):
+        for method, args in self.records:
+            getattr(log, method)(*args)
+
+    def checkpoint(self):
+        return len(self.records)
+
+    def restore(self, checkpoint):
+        del self.records[checkpoint:]
+
+    def changed(self):
+        "Whether rows were journaled as updated or deleted"
+        return any(
+            method in ('record_update', 'record_delete') and args[-1]
+            for method, args in self.records
+        )
 
 
 class Party:
     __name__ = 'party.party'
 
-    def merge_into(self, target):
-        """Merge current record to target party.
+    #: Resolved merge targets per database name, see get_merge_targets
+    _merge_targets_cache = {}
+    #: The default of CONFLICT_POLICIES used by merge
+    _merge_conflict_policy = 'keep_target'
+    #: Rough cost in seconds of a statement and of a rewritten row, used to
+    #: estimate the runtime of a merge (see merge_plan)
+    _merge_statement_cost = 0.005
+    _merge_row_cost = 0.0002
+    #: How long (in milliseconds) a merge statement waits for a lock before
+    #: the table is retried, how many times and the initial delay in seconds
+    #: between the retries (doubled each time)
+    _merge_lock_timeout = 2000
+    _merge_lock_retries = 5
+    _merge_lock_backoff = 0.5
+    #: The first key of the advisory lock held by the coordinator of a
+    #: parallel merge until it commits (the second is the id of the log)
+    _merge_parallel_lock = 0x70617274
+    #: The sequence of the rewrite of the referencing columns among the
+    #: merge steps, the steps of the same sequence run before it
+    _merge_rewrite_sequence = 100
+
+    merge_session = fields.Function(
+        fields.Integer('Merge Session'), 'get_merge_session',
+        searcher='search_merge_session'
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(Party, cls).__setup__()
+        # The models keeping track of merges must not be rewritten by them
+        cls._merge_excluded_models = set([
+            'party.merge.request', 'party.merge.request-party.party',
+            'party.duplicate.key', 'party.duplicate.cluster.member',
+            'party.merge.log', 'party.merge.log-party.party',
+            'party.party.merged', 'party.party.merge.staged',
+        ])
+        # The fields from which the duplicate keys are built
+        cls._duplicate_fields = set([
+            'name', 'vat_country', 'vat_number', 'active',
+        ])
+        # The rule consolidating the values of the duplicates on the target,
+        # per field or tuple of fields taken together (see merge_consolidate)
+        cls._merge_consolidation_rules = {
+            'lang': 'non_empty',
+            ('vat_country', 'vat_number'): 'non_empty',
+        }
+        # The MergeStep run by the merges (see get_merge_pipeline)
+        cls._merge_steps = []
+        # The names of the classmethods recomputing the values stored from
+        # the rows changed by a merge (see merge_recompute)
+        cls._merge_recompute_methods = []
+
+    @classmethod
+    def create(cls, vlist):
+        Key = Pool().get('party.duplicate.key')
+        parties = super(Party, cls).create(vlist)
+        Key.refresh(map(int, parties))
+        return parties
+
+    @classmethod
+    def write(cls, *args):
+        Key = Pool().get('party.duplicate.key')
+        super(Party, cls).write(*args)
+        actions = iter(args)
+        party_ids = []
+        for parties, values in zip(actions, actions):
+            if cls._duplicate_fields & set(values):
+                party_ids.extend(map(int, parties))
+        if party_ids:
+            Key.refresh(party_ids)
+
+    @classmethod
+    def get_merge_session(cls, parties, name):
+        return dict((p.id, None) for p in parties)
+
+    @classmethod
+    def search_merge_session(cls, name, clause):
+        """Search the parties staged (or not) in the merge wizard session,
+        without sending the ids of the staged parties.
+        """
+        Staged = Pool().get('party.party.merge.staged')
+        staged = Staged.__table__()
+
+        _, operator_, value = clause
+        query = staged.select(staged.party, where=staged.session == value)
+        if operator_ == '=':
+            return [('id', 'in', query)]
+        elif operator_ == '!=':
+            return [('id', 'not in', query)]
+        raise ValueError('Unsupported operator %s' % operator_)
+
+    @classmethod
+    def find_probable_duplicates(cls, party, threshold=None):
+        """Return the list of (party, score) of the probable duplicates of
+        the party sorted by decreasing score.
+
+        Only the parties sharing a blocking key with the party are read,
+        so the cost does not depend on the number of parties.
+        """
+        pool = Pool()
+        Key = pool.get('party.duplicate.key')
+        Cluster = pool.get('party.duplicate.cluster')
+
+        if threshold is None:
+            threshold = Cluster._threshold
+        scores = [
+            (other_id, score(kinds)) for other_id, kinds in Key.match(
+                party.id, Cluster._max_block_size).iteritems()
+        ]
+        scores = [(i, s) for i, s in scores if s >= threshold]
+        scores.sort(key=lambda x: (-x[1], x[0]))
+        return [(cls(i), s) for i, s in scores]
+
+    @classmethod
+    def __post_setup__(cls):
+        super(Party, cls).__post_setup__()
+        # The pool is (re)built when modules are installed or updated,
+        # which could change the columns referencing a party.
+        cls._merge_targets_cache.pop(
+            Transaction().cursor.database_name, None
+        )
+
+    @classmethod
+    def get_merge_targets(cls):
+        """Return the list of MergeTarget rewritten by a merge.
+
+        The list is built from the pool on first use and cached for the
+        database, so merging never has to read ir.model.field.
+        """
+        database_name = Transaction().cursor.database_name
+        targets = cls._merge_targets_cache.get(database_name)
+        if targets is None:
+            targets = cls._build_merge_targets()
+            cls._merge_targets_cache[database_name] = targets
+        return targets
+
+    @classmethod
+    def _build_merge_targets(cls, excluded_models=None):
+        """Introspect the pool for the columns referencing a party, except
+        those of excluded_models (by default _merge_excluded_models).
+        """
+        pool = Pool()
+
+        if excluded_models is None:
+            excluded_models = cls._merge_excluded_models
+
+        # The party columns of Many2Many relation tables are rewritten like
+        # any many2one but the relation must stay unique.
+        relations = {}
+        for model_name, Model in pool.iterobject():
+            for field in Model._fields.itervalues():
+                if isinstance(field, fields.Function):
+                    continue
+                if not isinstance(field, fields.Many2Many):
+                    continue
+                relations[(field.relation_name, field.origin)] = field.target
+                relations[(field.relation_name, field.target)] = field.origin
+
+        targets = []
+        for model_name, Model in pool.iterobject():
+            if (model_name in excluded_models
+                    or not issubclass(Model, ModelSQL)
+                    or Model.table_query()):
+                continue
+            for field_name, field in Model._fields.iteritems():
+                merge_target = cls._get_merge_target(
+                    Model, field_name, field, relations
+                )
+                if merge_target:
+                    targets.append(merge_target)
+        return sorted(targets, key=lambda t: (t.table, t.column))
+
+    @classmethod
+    def _get_merge_target(cls, Model, field_name, field, relations):
+        "Return the MergeTarget for the field or None"
+        if isinstance(field, fields.Function):
+            return
+        if isinstance(field, fields.Reference):
+            if (isinstance(field.selection, (list, tuple)) and
+                    cls.__name__ not in dict(field.selection)):
+                return
+            kind, unique = 'reference', ()
+        elif isinstance(field, fields.Many2One):
+            if field.model_name != cls.__name__:
+                return
+            other = relations.get((Model.__name__, field_name))
+            if other:
+                kind, unique = 'many2many', ((other,),)
+            else:
+                kind, unique = 'many2one', ()
+            unique += cls._get_merge_unique(Model, field_name)
+        else:
+            return
+        return MergeTarget(
+            Model.__name__, field_name, kind, Model._table, field_name,
+            Model._table + '__history' if Model._history else None, unique
+        )
+
+    @staticmethod
+    def _get_merge_unique(Model, field_name):
+        """Return the tuples of the other columns of the unique constraints
+        of Model which include field_name.
+        """
+        unique = ()
+        for _, constraint, _ in Model._sql_constraints:
+            match = _RE_UNIQUE.match(constraint)
+            if not match:
+                continue
+            columns = [c.strip().strip('"') for c in match.group(1).split(',')]
+            if field_name in columns:
+                columns.remove(field_name)
+                unique += (tuple(columns),)
+        return unique
+
+    @classmethod
+    def get_merge_pipeline(cls):
+        """Return the list of (kind, item) run by a merge in their order:
+        ('step', MergeStep) for the steps of _merge_steps and ('rewrite',
+        MergeTarget) for the columns rewritten by the merge, without the
+        tables handled by a step.
+        """
+        handled = set(t for step in cls._merge_steps for t in step.tables)
+        pipeline = []
+        for step in cls._merge_steps:
+            if not hasattr(cls, step.method):
+                raise ValueError('Missing method %s of the merge step %s' % (
+                    step.method, step.name))
+            pipeline.append(((step.sequence, 0, step.name), ('step', step)))
+        for i, merge_target in enumerate(cls.get_merge_targets()):
+            if merge_target.table in handled:
+                continue
+            pipeline.append((
+                (cls._merge_rewrite_sequence, 1, i),
+                ('rewrite', merge_target)
+            ))
+        pipeline.sort(key=lambda x: x[0])
+        return [item for _, item in pipeline]
+
+    @classmethod
+    def _merge_rewrite_targets(cls):
+        "Return the MergeTarget rewritten by the pipeline of the merges"
+        return [
+            item for kind, item in cls.get_merge_pipeline()
+            if kind == 'rewrite'
+        ]
+
+    @classmethod
+    def _merge_pipeline_item(
+            cls, kind, item, source_ids, target_id, conflict_policy,
+            log=None):
+        "Run the step or rewrite the merge target of the pipeline"
+        if kind == 'rewrite':
+            cls._merge_target(
+                item, source_ids, target_id, conflict_policy, log=log
+            )
+        else:
+            cls._merge_step(
+                item, source_ids, target_id, conflict_policy, log=log
+            )
+
+    @classmethod
+    def _merge_step(
+            cls, step, source_ids, target_id, conflict_policy, log=None):
+        """Call the method of the merge step with all the source ids, it is
+        retried like the rewrite of a table (see _merge_lock_retry).
+        """
+        method = getattr(cls, step.method)
+        result = {}
+
+        def run():
+            start = time.time()
+            result['rows'] = method(
+                source_ids, target_id, conflict_policy, log=log
+            ) or 0
+            result['duration'] = time.time() - start
+        waited = cls._merge_lock_retry(run, log=log)
+        if log:
+            if waited:
+                log.record_lock_wait(step.name, waited)
+            log.record_statement(
+                'step', step.name, None, False, result['duration'],
+                result['rows']
+            )
+
+    @classmethod
+    def merge(cls, parties, target, conflict_policy=None):
+        """Merge all the given parties into the target party.
+
+        The duplicates are handled as one batch: every referencing column
+        (and its history table) is rewritten with a single UPDATE covering
+        all the parties instead of one UPDATE per party.
+
+        Rows which would violate a unique constraint are resolved before
+        the rewrite following conflict_policy (see CONFLICT_POLICIES).
+
+        The rewritten and deleted rows are journaled in the returned
+        party.merge.log from which the merge can be undone.
+        """
+        MergeLog = Pool().get('party.merge.log')
+
+        if conflict_policy is None:
+            conflict_policy = cls._merge_conflict_policy
+        log = MergeLog.start(parties, target)
+        source_ids = cls._merge_prepare(parties, target, log=log)
+        if not source_ids:
+            return
+
+        for kind, item in cls.get_merge_pipeline():
+            cls._merge_pipeline_item(
+                kind, item, source_ids, target.id, conflict_policy, log=log
+            )
+        # The addresses and contact mechanisms were moved with SQL
+        Pool().get('party.duplicate.key').refresh([target.id])
+        log.save_statistics()
+        log.invalidate_caches()
+        return log
+
+    @classmethod
+    def merge_parallel(cls, parties, target, workers, conflict_policy=None):
+        """Merge the parties into target rewriting the referencing tables
+        concurrently on workers database connections.
+
+        The tables are dispatched from the largest to the smallest so the
+        duration is bounded by the largest table. Each worker runs in its
+        own transaction which is prepared (two-phase commit) once its
+        tables are rewritten. The current transaction is committed before
+        the prepared transactions (in the order of the workers), or all of
+        them are rolled back if a worker failed. The prepared transactions
+        left by a coordinator which died meanwhile are finished by
+        merge_parallel_recover.
+
+        This requires PostgreSQL with max_prepared_transactions at least
+        workers, on the other backends it is the same as merge (and does not
+        commit).
+
+        The merge steps run in the current transaction: those sequenced
+        before the rewrite (see _merge_rewrite_sequence) before the tables
+        are dispatched, the others once the workers are committed so that
+        they see the rewritten rows. Those are therefore not committed with
+        the rewrite. The changed records are evicted from the caches and
+        the stored values are recomputed once the workers are committed
+        (see merge_recompute), in the current transaction.
+        """
+        MergeLog = Pool().get('party.merge.log')
+        transaction = Transaction()
+
+        if backend.name() != 'postgresql' or workers < 2:
+            return cls.merge(parties, target, conflict_policy=conflict_policy)
+
+        if conflict_policy is None:
+            conflict_policy = cls._merge_conflict_policy
+        cls.merge_parallel_recover()
+        merge_targets = cls._merge_parallel_targets(parties, target)
+        log = MergeLog.start(parties, target)
+        if not log:
+            return
+        # Tell merge_parallel_recover that the coordinator is alive
+        transaction.cursor.execute(
+            'SELECT pg_advisory_xact_lock(%s, %s)',
+            (cls._merge_parallel_lock, log.id)
+        )
+        source_ids = cls._merge_prepare(parties, target, log=log)
+        if not source_ids:
+            return
+
+        cls._merge_parallel_steps(
+            False, source_ids, target.id, conflict_policy, log
+        )
+        queue = Queue.Queue()
+        for merge_target in merge_targets:
+            if merge_target.table == cls._table:
+                # The party rows are locked by the current transaction
+                cls._merge_target(
+                    merge_target, source_ids, target.id, conflict_policy,
+                    log=log
+                )
+            else:
+                queue.put(merge_target)
+
+        results = cls._merge_parallel_dispatch(
+            queue, workers, source_ids, target.id, conflict_policy, log
+        )
+        cls._merge_parallel_commit(log, results)
+        cls._merge_parallel_steps(
+            True, source_ids, target.id, conflict_policy, log
+        )
+        log.save_statistics()
+
+        # Published only once the rows rewritten by the workers are visible,
+        # otherwise the other processes could cache their previous values
+        log.invalidate_caches()
+        Pool().get('party.duplicate.key').refresh([target.id])
+        return log
+
+    @classmethod
+    def _merge_parallel_steps(
+            cls, after, source_ids, target_id, conflict_policy, log):
+        """Run the merge steps sequenced before the rewrite, or after it if
+        after is set (see merge_parallel).
         """
-        ModelField = Pool().get('ir.model.field')
+        for kind, step in cls.get_merge_pipeline():
+            if (kind == 'step'
+                    and (step.sequence > cls._merge_rewrite_sequence) == after):
+                cls._merge_step(
+                    step, source_ids, target_id, conflict_policy, log=log
+                )
+
+    @classmethod
+    def _merge_parallel_dispatch(
+            cls, queue, workers, source_ids, target_id, conflict_policy, log):
+        """Rewrite the merge targets of the queue with workers threads and
+        return their results (see _merge_parallel_work).
+        """
+        transaction = Transaction()
+        database_name = transaction.cursor.database_name
+        results = []
+        threads = [
+            threading.Thread(target=cls._merge_parallel_work, args=(
+                (database_name, transaction.user, transaction.context),
+                queue, source_ids, target_id, conflict_policy,
+                'party_merge-%s-%s-%s' % (database_name, log.id, i), results
+            )) for i in range(workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    @classmethod
+    def _merge_parallel_commit(cls, log, results):
+        """Commit the current transaction and then the prepared workers of
+        results (see _merge_parallel_work) in the order of their gid, or
+        roll back all of them if one failed.
+        """
+        transaction = Transaction()
+        prepared = [gid for gid, _, error in results if not error]
+        errors = [error for _, _, error in results if error]
 
-        # Inactive party first
-        self.active = False
-        self.save()
+        Database = backend.get('Database')
+        # COMMIT/ROLLBACK PREPARED can not run in a transaction
+        cursor = Database(transaction.cursor.database_name).connect().cursor(
+            autocommit=True
+        )
+        try:
+            if errors:
+                for gid in sorted(prepared):
+                    cls._merge_parallel_finish(cursor, gid, False)
+                raise errors[0]
+            for _, journal, _ in results:
+                journal.replay(log)
+            log.save_statistics()
+            # The committed log is the decision to commit the workers
+            transaction.cursor.commit()
+            for gid in sorted(prepared):
+                cls._merge_parallel_finish(cursor, gid, True)
+        finally:
+            cursor.close()
+
+    @classmethod
+    def merge_parallel_recover(cls):
+        """Finish the prepared transactions of the workers left by the
+        parallel merges whose coordinator died and return their gids.
+
+        The workers of a merge are committed if its log is committed, as the
+        coordinator commits it before the workers, otherwise they are rolled
+        back. The merges whose coordinator is still running are skipped.
+        """
+        MergeLog = Pool().get('party.merge.log')
+
+        if backend.name() != 'postgresql':
+            return []
+        Database = backend.get('Database')
+        database_name = Transaction().cursor.database_name
+        # COMMIT/ROLLBACK PREPARED can not run in a transaction
+        cursor = Database(database_name).connect().cursor(autocommit=True)
+        finished = []
+        try:
+            cursor.execute(
+                'SELECT gid FROM pg_prepared_xacts '
+                'WHERE database = current_database() AND gid LIKE %s',
+                ('party_merge-%s-%%' % database_name,)
+            )
+            gids = defaultdict(list)
+            for gid, in cursor.fetchall():
+                gids[int(gid.rsplit('-', 2)[1])].append(gid)
+            for log_id, log_gids in sorted(gids.iteritems()):
+                lock = (cls._merge_parallel_lock, log_id)
+                cursor.execute('SELECT pg_try_advisory_lock(%s, %s)', lock)
+                if not cursor.fetchone()[0]:
+                    continue
+                try:
+                    cursor.execute(
+                        'SELECT id FROM "%s" WHERE id = %%s' % MergeLog._table,
+                        (log_id,)
+                    )
+                    commit = bool(cursor.fetchone())
+                    logger.warning(
+                        '%s the workers of the abandoned merge %s',
+                        'Committing' if commit else 'Rolling back', log_id
+                    )
+                    for gid in sorted(log_gids):
+                        if cls._merge_parallel_finish(cursor, gid, commit):
+                            finished.append(gid)
+                finally:
+                    cursor.execute('SELECT pg_advisory_unlock(%s, %s)', lock)
+        finally:
+            cursor.close()
+        return finished
 
+    @staticmethod
+    def _merge_parallel_finish(cursor, gid, commit):
+        """Commit or roll back the prepared transaction gid with the
+        autocommit cursor. Return False if it was already finished (by a
+        concurrent recovery).
+        """
+        try:
+            cursor.execute(
+                'COMMIT PREPARED %s' if commit else 'ROLLBACK PREPARED %s',
+                (gid,)
+            )
+        except Exception:
+            cursor.execute(
+                'SELECT 1 FROM pg_prepared_xacts WHERE gid = %s', (gid,)
+            )
+            if cursor.fetchone():
+                raise
+            return False
+        return True
+
+    @classmethod
+    def _merge_parallel_work(
+            cls, start, queue, source_ids, target_id, conflict_policy, gid,
+            results):
+        """Rewrite the merge targets of the queue in a new transaction
+        (started with the database name, user and context of start) prepared
+        as gid. Append (gid, journal, exception) to results.
+
+        This is the body of the worker threads of merge_parallel.
+        """
+        database_name, user, context = start
+        journal = _MergeJournal()
+        with Transaction().start(
+                database_name, user, context=context) as worker:
+            try:
+                while True:
+                    try:
+                        merge_target = queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                    cls._merge_target(
+                        merge_target, source_ids, target_id,
+                        conflict_policy, log=journal
+                    )
+                worker.cursor.execute('PREPARE TRANSACTION %s', (gid,))
+            except Exception:
+                logger.error('Merge worker %s failed', gid, exc_info=True)
+                worker.cursor.rollback()
+                results.append((gid, journal, sys.exc_info()[1]))
+                return
+        results.append((gid, journal, None))
+
+    @classmethod
+    def _merge_parallel_targets(cls, parties, target):
+        """Return all the rewrite targets sorted from the largest to the
+        smallest number of rows planned.
+
+        The targets without rows planned are kept (last): rows may reference
+        the duplicates by the time the workers rewrite them.
+        """
+        counts = dict(
+            ((x['table'], x['column']), x['rows'] + x['history_rows'])
+            for x in cls.merge_plan(parties, target)['lines']
+        )
+        return sorted(
+            cls._merge_rewrite_targets(),
+            key=lambda t: counts.get((t.table, t.column), 0), reverse=True
+        )
+
+    @classmethod
+    def merge_plan(cls, parties, target):
+        """Return what merging parties into target would do, without
+        modifying nor locking anything.
+
+        The result is a dictionary with the list of ``lines`` (one per
+        merge target, with the count of referencing ``rows`` and
+        ``history_rows``), the names of the merge ``steps``, the total of
+        ``rows``, the number of ``statements`` and the ``estimate`` of the
+        runtime in seconds. The rows of each table are counted with one
+        query for all the duplicates, the rows of the steps are not.
+        """
+        cursor = Transaction().cursor
+        source_ids = [p.id for p in parties if p.id != target.id]
+        pipeline = cls.get_merge_pipeline()
+        rewrites = [i for k, i in pipeline if k == 'rewrite']
+        steps = [i.name for k, i in pipeline if k == 'step']
+
+        by_table = defaultdict(list)
+        for merge_target in rewrites:
+            by_table[merge_target.table].append(merge_target)
+            if merge_target.history:
+                by_table[merge_target.history].append(merge_target)
+
+        counts = defaultdict(int)
+        for table_name, merge_targets in sorted(by_table.iteritems()):
+            sql_table = Table(table_name)
+            for sub_ids in grouped_slice(source_ids):
+                sub_ids = list(sub_ids)
+                conditions = [
+                    cls._merge_where(t, sql_table, sub_ids)
+                    for t in merge_targets
+                ]
+                cursor.execute(*sql_table.select(
+                    *[Count(Case((c, Literal(1)))) for c in conditions],
+                    where=reduce(operator.or_, conditions)
+                ))
+                for merge_target, count in zip(
+                        merge_targets, cursor.fetchone()):
+                    counts[(table_name, merge_target)] += count
+
+        lines = []
+        for merge_target in rewrites:
+            lines.append({
+                'model': merge_target.model,
+                'field': merge_target.field,
+                'table': merge_target.table,
+                'column': merge_target.column,
+                'rows': counts[(merge_target.table, merge_target)],
+                'history_rows': counts.get(
+                    (merge_target.history, merge_target), 0
+                ),
+            })
+
+        rows = sum(line['rows'] + line['history_rows'] for line in lines)
+        slices = (len(source_ids) + cursor.IN_MAX - 1) // cursor.IN_MAX
+        statements = slices * sum(
+            2 if t.history else 1 for t in rewrites
+        ) + len(steps)
+        return {
+            'lines': lines,
+            'steps': steps,
+            'rows': rows,
+            'statements': statements,
+            'estimate': (
+                statements * cls._merge_statement_cost +
+                rows * cls._merge_row_cost
+            ),
+        }
+
+    @classmethod
+    def merge_reference_counts(cls, party_ids):
+        """Return the dictionary of the number of rows referencing each
+        party, history tables excluded, with one grouped query per merge
+        target and slice of parties.
+        """
         cursor = Transaction().cursor
 
-        if self._history:
-            # Update the party history first.
-            #
-            # The approach is to make the history of all merged records
-            # also the history of the target record.
-            party_history_table = self.__table_history__()
+        counts = defaultdict(int)
+        for merge_target in cls.get_merge_targets():
+            sql_table = Table(merge_target.table)
+            column = Column(sql_table, merge_target.column)
+            for sub_ids in grouped_slice(party_ids):
+                cursor.execute(*sql_table.select(
+                    column, Count(Literal('*')),
+                    where=cls._merge_where(
+                        merge_target, sql_table, list(sub_ids)),
+                    group_by=[column]
+                ))
+                for value, count in cursor.fetchall():
+                    if merge_target.kind == 'reference':
+                        value = int(value.split(',')[1])
+                    counts[value] += count
+        return dict(counts)
+
+    @classmethod
+    def merge_consolidate_values(cls, parties, target):
+        """Return the values to write on target so that it keeps the best
+        values of the parties following _merge_consolidation_rules:
+
+        * ``non_empty``: the value of the target or else the one of the
+          most recently modified duplicate,
+        * ``most_recent``: the value of the most recently modified party,
+        * ``most_referenced``: the value of the party with the most
+          referencing rows.
+
+        Empty values never win and the fields of a tuple are taken
+        together from the same party. The parties are read at once.
+        """
+        party_ids = [target.id] + [p.id for p in parties if p.id != target.id]
+        rules = cls._merge_consolidation_rules
+        names = set()
+        for key in rules:
+            names.update(key if isinstance(key, tuple) else (key,))
+        rows = dict((r['id'], r) for r in cls.read(
+            party_ids, sorted(names) + ['create_date', 'write_date']
+        ))
+        current = rows[target.id]
+        counts = {}
+        if 'most_referenced' in rules.itervalues():
+            counts = cls.merge_reference_counts(party_ids)
+
+        values = {}
+        for key, rule in rules.iteritems():
+            key = key if isinstance(key, tuple) else (key,)
+            candidates = [
+                rows[i] for i in party_ids
+                if any(rows[i][n] not in (None, '') for n in key)
+            ]
+            if not candidates:
+                continue
+            winner = cls._merge_consolidation_winner(
+                rule, candidates, current, counts)
+            for name in key:
+                if winner[name] != current[name]:
+                    values[name] = winner[name]
+        return values
+
+    @staticmethod
+    def _merge_consolidation_winner(rule, candidates, current, counts):
+        """Return the row among candidates (with a non-empty value, the
+        target first) whose value wins following rule.
+        """
+        def recent(row):
+            return (
+                row['write_date'] or row['create_date'] or
+                datetime.datetime.min, row is current)
+
+        if rule == 'non_empty':
+            if candidates[0] is current:
+                return current
+            return max(candidates, key=recent)
+        elif rule == 'most_recent':
+            return max(candidates, key=recent)
+        elif rule == 'most_referenced':
+            return max(candidates, key=lambda r: (
+                counts.get(r['id'], 0), r is current))
+        raise ValueError('Unknown consolidation rule %s' % rule)
+
+    @classmethod
+    def merge_consolidate(cls, parties, target):
+        """Write on target the values consolidated from the parties (see
+        merge_consolidate_values) and return them.
+        """
+        values = cls.merge_consolidate_values(parties, target)
+        if values:
+            cls.write([target], values)
+        return values
+
+    @classmethod
+    def get_merge_derived_fields(cls):
+        """Return the dictionary of model name to the names of its stored
+        fields computed by an on_change_with from a column rewritten by the
+        merges, like a denormalized party name.
+        """
+        pool = Pool()
+
+        derived = defaultdict(set)
+        for merge_target in cls._merge_rewrite_targets():
+            Model = pool.get(merge_target.model)
+            for name, field in Model._fields.iteritems():
+                if isinstance(field, fields.Function):
+                    continue
+                if not hasattr(Model, 'on_change_with_%s' % name):
+                    continue
+                depends = set(
+                    f.split('.')[0] for f in field.on_change_with
+                )
+                if merge_target.field in depends:
+                    derived[merge_target.model].add(name)
+        return dict((m, sorted(n)) for m, n in derived.iteritems())
+
+    @classmethod
+    def merge_recompute(cls, target_id, changes):
+        """Recompute the values stored from the rows changed by a merge,
+        changes is a dictionary of model name to ids.
+
+        Only the changed rows are read, by slices, and the derived fields
+        (see get_merge_derived_fields) are updated with one UPDATE per
+        distinct value of a slice. The methods of _merge_recompute_methods
+        are then called with target_id and changes, to update for example
+        the totals stored on the target.
+        """
+        pool = Pool()
+        Invalidation = pool.get('party.merge.invalidation')
+        cursor = Transaction().cursor
+
+        updated = {}
+        for model_name, names in sorted(
+                cls.get_merge_derived_fields().iteritems()):
+            ids = sorted(changes.get(model_name, ()))
+            if not ids:
+                continue
+            Model = pool.get(model_name)
+            table = Model.__table__()
+            for sub_ids in grouped_slice(ids):
+                records = Model.browse(list(sub_ids))
+                for name in names:
+                    field = Model._fields[name]
+                    by_value = defaultdict(list)
+                    for record in records:
+                        value = getattr(record, 'on_change_with_%s' % name)()
+                        by_value[field.sql_format(value)].append(record.id)
+                    for value, value_ids in by_value.iteritems():
+                        cursor.execute(*table.update(
+                            columns=[Column(table, name)], values=[value],
+                            where=reduce_ids(table.id, value_ids)
+                        ))
+            updated[model_name] = ids
+        if updated:
+            # The records were read before their update
+            Invalidation.evict_transaction(updated)
+
+        for method in cls._merge_recompute_methods:
+            getattr(cls, method)(target_id, changes)
+
+    @classmethod
+    def merge_index_report(cls):
+        """Return for each column rewritten by a merge (including the
+        history tables) whether it is the leading column of an index.
+
+        The result is a list of dictionaries with the ``table``, ``column``,
+        ``history`` and ``indexed`` keys.
+        """
+        indexed = {}
+        report = []
+        for merge_target in cls.get_merge_targets():
+            for history in (False, True):
+                if history and not merge_target.history:
+                    continue
+                table_name = (
+                    merge_target.history if history else merge_target.table
+                )
+                if table_name not in indexed:
+                    indexed[table_name] = cls._merge_indexed_columns(
+                        table_name
+                    )
+                report.append({
+                    'table': table_name,
+                    'column': merge_target.column,
+                    'history': history,
+                    'indexed': merge_target.column in indexed[table_name],
+                })
+        return report
+
+    @staticmethod
+    def _merge_indexed_columns(table_name):
+        """Return the set of columns leading a valid index of the table
+        (empty on the backends which can not be introspected).
+        """
+        cursor = Transaction().cursor
+        if backend.name() == 'postgresql':
+            # An index whose concurrent build failed is not valid
             cursor.execute(
-                *party_history_table.update(
-                    columns=[party_history_table.id],
-                    values=[target.id],
-                    where=(party_history_table.id == self.id)
+                'SELECT a.attname FROM pg_index i '
+                'JOIN pg_class c ON c.oid = i.indrelid '
+                'JOIN pg_attribute a '
+                'ON a.attrelid = c.oid AND a.attnum = i.indkey[0] '
+                'WHERE c.relname = %s AND i.indisvalid', (table_name,)
+            )
+            return set(name for name, in cursor.fetchall())
+        elif backend.name() == 'sqlite':
+            columns = set()
+            cursor.execute('PRAGMA index_list("%s")' % table_name)
+            for index in cursor.fetchall():
+                cursor.execute('PRAGMA index_info("%s")' % index[1])
+                columns.update(
+                    name for seqno, _, name in cursor.fetchall() if seqno == 0
                 )
+            return columns
+        return set()
+
+    @staticmethod
+    def _merge_index_name(table_name, column_name):
+        """Return the name of the merge index on the column of the table.
+
+        The names longer than the 63 characters allowed by PostgreSQL are
+        truncated and suffixed with a hash to remain unique.
+        """
+        index_name = '%s_%s_merge_index' % (table_name, column_name)
+        if len(index_name) > 63:
+            index_name = '%s_%s' % (
+                index_name[:54], hashlib.md5(index_name).hexdigest()[:8]
             )
+        return index_name
 
-        party_fields = ModelField.search([
-            ('relation', '=', 'party.party'),
-            ('ttype', '=', 'many2one'),
-        ])
-        for field in party_fields:
-            Model = Pool().get(field.model.model)
+    @classmethod
+    def merge_create_indexes(cls, concurrently=True):
+        """Create the missing indexes on the columns rewritten by a merge
+        and return the names of the created indexes.
+
+        On PostgreSQL the indexes are built concurrently, in autocommit
+        mode, so that the tables are not locked against writes. An invalid
+        index left by a failed build is dropped and built again.
+        """
+        database_name = Transaction().cursor.database_name
+        created = []
+        for line in cls.merge_index_report():
+            if line['indexed']:
+                continue
+            index_name = cls._merge_index_name(line['table'], line['column'])
+            concurrent = (
+                backend.name() == 'postgresql' and concurrently
+            ) and 'CONCURRENTLY ' or ''
+            queries = [
+                'CREATE INDEX %s"%s" ON "%s" ("%s")' % (
+                    concurrent, index_name, line['table'], line['column']
+                ),
+            ]
+            if backend.name() == 'postgresql':
+                queries.insert(0, 'DROP INDEX %sIF EXISTS "%s"' % (
+                    concurrent, index_name
+                ))
+            if concurrent:
+                # CREATE INDEX CONCURRENTLY can not run in a transaction
+                Database = backend.get('Database')
+                cursor = Database(database_name).connect().cursor(
+                    autocommit=True
+                )
+                try:
+                    for query in queries:
+                        cursor.execute(query)
+                finally:
+                    cursor.close()
+            else:
+                for query in queries:
+                    Transaction().cursor.execute(query)
+            logger.info('Created index %s', index_name)
+            created.append(index_name)
+        return created
+
+    @classmethod
+    def merge_in_chunks(
+            cls, parties, target, chunk_size, conflict_policy=None,
+            resume=None, log=None):
+        """Merge the parties into target rewriting at most chunk_size rows
+        per statement.
+
+        This is a generator which yields (merge_target, history, last_id)
+        after each chunk, last_id being the greatest primary key of the
+        chunk. The caller is expected to commit and to persist the
+        checkpoint, so that an interrupted merge can be resumed by passing
+        the checkpoints back as the resume dictionary, keyed by
+        (table, column, history), together with the party.merge.log of the
+        first run as log.
+
+        The merge steps are not chunked nor checkpointed, they run again
+        when the merge is resumed and must therefore be idempotent.
+        """
+        MergeLog = Pool().get('party.merge.log')
+
+        if conflict_policy is None:
+            conflict_policy = cls._merge_conflict_policy
+        resume = resume or {}
+        if log is None:
+            log = MergeLog.start(parties, target)
+        source_ids = cls._merge_prepare(parties, target, log=log)
+        if not source_ids:
+            return
+
+        for kind, merge_target in cls.get_merge_pipeline():
+            if kind == 'step':
+                cls._merge_step(
+                    merge_target, source_ids, target.id, conflict_policy,
+                    log=log
+                )
+                continue
+            for history, last_id in cls._merge_target_chunks(
+                    merge_target, source_ids, target.id, chunk_size,
+                    conflict_policy, resume, log):
+                log.save_statistics()
+                log.invalidate_caches()
+                yield merge_target, history, last_id
+        Pool().get('party.duplicate.key').refresh([target.id])
+        log.save_statistics()
+        log.invalidate_caches()
+
+    @classmethod
+    def _merge_target_chunks(
+            cls, merge_target, source_ids, target_id, chunk_size,
+            conflict_policy, resume, log):
+        """Rewrite the merge target column and its history by chunks from
+        the checkpoints of resume, yield (history, last_id) after each
+        chunk (see merge_in_chunks).
+        """
+        for history in (False, True):
+            if history and not merge_target.history:
+                continue
+            key = (merge_target.table, merge_target.column, history)
+            last_id = resume.get(key)
+            if not history:
+                # Also on resume: rows may reference the duplicates since
+                def resolve_conflicts():
+                    for sub_ids in grouped_slice(source_ids):
+                        cls._merge_resolve_conflicts(
+                            merge_target, list(sub_ids), target_id,
+                            conflict_policy, log=log, start=last_id
+                        )
+                waited = cls._merge_lock_retry(resolve_conflicts, log=log)
+                if waited and log:
+                    log.record_lock_wait(merge_target.table, waited)
+            for last_id in cls._merge_rewrite_chunks(
+                    merge_target, source_ids, target_id, chunk_size,
+                    history=history, start=last_id, log=log):
+                yield history, last_id
+
+    @classmethod
+    def check_merge_mapping(cls, pairs):
+        """Group the (duplicate id, target id) pairs by final target and
+        return the mapping of target id to the set of its duplicate ids
+        together with the list of errors found.
+
+        The chains of merges (A into B and B into C) are collapsed, also
+        through the redirection of a target already merged (even purged),
+        so that every duplicate is merged directly into its final target
+        (see resolve_merge_chains). The duplicates already merged and purged
+        are skipped. A pair is an error when the duplicate is also mapped
+        to another target or is its own target, when it is part of a cycle
+        of merges and when a party does not exist or the final target is
+        inactive.
+        """
+        Merged = Pool().get('party.party.merged')
+
+        targets, errors = cls._merge_mapping_pairs(pairs)
+        party_ids = set(targets) | set(targets.itervalues())
+        active = cls._merge_active(party_ids)
+        redirected = Merged.targets(
+            [i for i in party_ids if not active.get(i, False)])
+        for party_id in sorted(party_ids - set(active)):
+            if party_id not in redirected:
+                errors.append('Party %s does not exist' % party_id)
+            elif party_id in targets:
+                # Purged once merged
+                del targets[party_id]
+
+        parents = redirected
+        parents.update(targets)
+        final, cycles = resolve_merge_chains(parents)
+        for party_id in sorted(cycles & set(targets)):
+            errors.append('Party %s is in a cycle of merges' % party_id)
 
-            if isinstance(getattr(Model, field.name), fields.Function):
+        mapping = defaultdict(set)
+        for source_id in targets:
+            target_id = final.get(source_id)
+            if target_id is None:
                 continue
+            if target_id in active and not active[target_id]:
+                errors.append('Party %s is inactive' % target_id)
+            mapping[target_id].add(source_id)
+        return dict(mapping), sorted(set(errors), key=errors.index)
+
+    @staticmethod
+    def _merge_mapping_pairs(pairs):
+        """Return the dictionary of the duplicate ids to their target id
+        and the list of errors of the pairs themselves.
+        """
+        targets = {}
+        errors = []
+        for source_id, target_id in pairs:
+            if source_id == target_id:
+                errors.append('Party %s is merged into itself' % source_id)
+            elif targets.setdefault(source_id, target_id) != target_id:
+                errors.append('Party %s is merged into %s and %s' % (
+                    source_id, targets[source_id], target_id))
+        return targets, errors
+
+    @classmethod
+    def _merge_active(cls, party_ids):
+        "Return the dictionary of the existing party ids to their active flag"
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        active = {}
+        for sub_ids in grouped_slice(sorted(party_ids)):
+            cursor.execute(*table.select(
+                table.id, table.active,
+                where=reduce_ids(table.id, list(sub_ids))
+            ))
+            active.update(cursor.fetchall())
+        return active
+
+    @classmethod
+    def _merge_previous_targets(cls, party_ids=None):
+        """Return the dictionary of the merged party ids (among party_ids)
+        to the id of the party they were merged into, from the merge logs
+        not undone.
+        """
+        pool = Pool()
+        MergeLog = pool.get('party.merge.log')
+        LogParty = pool.get('party.merge.log-party.party')
+        cursor = Transaction().cursor
+        log = MergeLog.__table__()
+        log_party = LogParty.__table__()
 
-            if not hasattr(Model, '__table__'):
+        query = log_party.join(
+            log, condition=log_party.log == log.id
+        ).select(
+            log_party.party, log.target,
+            where=log.state == 'done', order_by=log.id.asc
+        )
+        if party_ids is None:
+            cursor.execute(*query)
+            return dict(cursor.fetchall())
+        targets = {}
+        for sub_ids in grouped_slice(party_ids):
+            query.where = (log.state == 'done') & reduce_ids(
+                log_party.party, list(sub_ids))
+            cursor.execute(*query)
+            # The latest merge wins
+            targets.update(cursor.fetchall())
+        return targets
+
+    @classmethod
+    def merge_sweep(cls, conflict_policy=None):
+        """Point the rows still referencing previously merged (inactive or
+        purged) parties to their final target (see PartyMerged), e.g. rows
+        created with a stale id after the merge, and collapse the chains of
+        merges.
+
+        The referenced parties are found with one grouped query per column
+        and slice of parties, only the columns with stale rows are
+        rewritten. The merge steps run in their sequence for each target
+        with all the parties merged into it, they must be idempotent like
+        for a resumed merge. Return the party.merge.log of each target which
+        had rows to rewrite, from which the sweep can be undone.
+        """
+        MergeLog = Pool().get('party.merge.log')
+
+        if conflict_policy is None:
+            conflict_policy = cls._merge_conflict_policy
+        parents = Pool().get('party.party.merged').targets()
+        # The redirections of the purged parties are kept
+        active = cls._merge_active(parents)
+        inactive = set(i for i in parents if not active.get(i, False))
+        final, _ = resolve_merge_chains(
+            dict((i, t) for i, t in parents.iteritems() if i in inactive)
+        )
+
+        merged = defaultdict(list)
+        for source_id, target_id in final.iteritems():
+            merged[target_id].append(source_id)
+
+        journals = defaultdict(_MergeJournal)
+        for kind, item in cls.get_merge_pipeline():
+            if kind == 'step':
+                mapping = merged
+            else:
+                mapping = defaultdict(list)
+                for source_id in cls._merge_referenced(item, final):
+                    mapping[final[source_id]].append(source_id)
+            for target_id in sorted(mapping):
+                cls._merge_pipeline_item(
+                    kind, item, sorted(mapping[target_id]), target_id,
+                    conflict_policy, log=journals[target_id]
+                )
+
+        logs = []
+        for target_id in sorted(journals):
+            if not journals[target_id].changed():
                 continue
+            log, = MergeLog.create([{'target': target_id}])
+            journals[target_id].replay(log)
+            log.save_statistics()
+            log.invalidate_caches()
+            logs.append(log)
+        if logs:
+            Pool().get('party.duplicate.key').refresh(
+                [swept.target.id for swept in logs])
+        return logs
 
-            sql_table = Model.__table__()
+    @classmethod
+    def _merge_referenced(cls, merge_target, party_ids):
+        """Return the ids among party_ids referenced by the merge target
+        column or by its history.
+        """
+        cursor = Transaction().cursor
+        referenced = set()
+        for table_name in filter(
+                None, [merge_target.table, merge_target.history]):
+            sql_table = Table(table_name)
+            column = Column(sql_table, merge_target.column)
+            for sub_ids in grouped_slice(sorted(party_ids)):
+                cursor.execute(*sql_table.select(
+                    column, where=cls._merge_where(
+                        merge_target, sql_table, list(sub_ids)),
+                    group_by=[column]
+                ))
+                for value, in cursor.fetchall():
+                    if merge_target.kind == 'reference':
+                        value = int(value.split(',')[1])
+                    referenced.add(value)
+        return referenced
 
-            # Update direct foreign key references
+    @classmethod
+    def merge_mapping(cls, mapping, batch_size=None, conflict_policy=None):
+        """Merge the duplicates of the mapping, a dictionary of target id to
+        duplicate ids (see check_merge_mapping), into their target.
+
+        The duplicates of a target are merged by batches of at most
+        batch_size parties. This is a generator which yields (target,
+        duplicates, log) after each batch so that the caller decides when
+        to commit.
+        """
+        for target_id in sorted(mapping):
+            target = cls(target_id)
+            source_ids = sorted(mapping[target_id])
+            for sub_ids in grouped_slice(
+                    source_ids, batch_size or len(source_ids)):
+                parties = cls.browse(list(sub_ids))
+                log = cls.merge(
+                    parties, target, conflict_policy=conflict_policy
+                )
+                yield target, parties, log
+
+    @classmethod
+    def _merge_target(
+            cls, merge_target, source_ids, target_id, conflict_policy,
+            log=None):
+        """Rewrite the merge target column (and its history) to target_id.
+
+        The table is retried when its locks are not obtained in time (see
+        _merge_lock_retry).
+        """
+        def rewrite():
+            for sub_ids in grouped_slice(source_ids):
+                sub_ids = list(sub_ids)
+
+                cls._merge_resolve_conflicts(
+                    merge_target, sub_ids, target_id, conflict_policy,
+                    log=log
+                )
+                # Update direct foreign key references
+                cls._merge_rewrite(
+                    merge_target, sub_ids, target_id, log=log
+                )
+                if merge_target.history:
+                    # If historization is enabled on the model
+                    # then the party value in the history should
+                    # now point to the target party id since the
+                    # history of the merged parties is already the
+                    # history of target party.
+                    cls._merge_rewrite(
+                        merge_target, sub_ids, target_id, history=True,
+                        log=log
+                    )
+        waited = cls._merge_lock_retry(rewrite, log=log)
+        if waited and log:
+            log.record_lock_wait(merge_target.table, waited)
+
+    @staticmethod
+    def merge_retryable(exception):
+        """Tell if a merge which failed with the exception can succeed in
+        a new transaction: a lock was not obtained in time or a row was
+        updated concurrently.
+        """
+        return getattr(exception, 'pgcode', None) in (
+            (_LOCK_NOT_AVAILABLE,) + _TRANSACTION_ROLLBACK
+        )
+
+    @classmethod
+    def _merge_lock_retry(cls, func, log=None):
+        """Call func in a savepoint with a lock timeout of
+        _merge_lock_timeout. When a lock is not obtained in time, the
+        savepoint is rolled back and func is called again after a growing
+        delay, at most _merge_lock_retries times. Return the seconds lost
+        waiting. What the failed attempts journaled in the memory of log
+        (a party.merge.log or a _MergeJournal) is discarded too.
+
+        Giving up a table instead of queuing behind the transactions of the
+        users avoids blocking them in turn and deadlocking with them. But
+        when the transaction holding the lock committed an update of the
+        rows, the snapshot of the merge (REPEATABLE READ) can not rewrite
+        them anymore: the serialization failure is raised at once, the
+        merge must run again in a new transaction (see merge_retryable and
+        PartyMergeRequest.execute, the chunked merges resume from their
+        last committed chunk).
+
+        Only PostgreSQL has lock timeouts, func is simply called on the
+        other backends.
+        """
+        cursor = Transaction().cursor
+        if backend.name() != 'postgresql':
+            func()
+            return 0
+        waited = 0
+        for attempt in range(cls._merge_lock_retries + 1):
+            start = time.time()
+            checkpoint = log.checkpoint() if log else None
+            cursor.execute('SAVEPOINT party_merge')
+            cursor.execute(
+                'SET LOCAL lock_timeout = %s', (cls._merge_lock_timeout,)
+            )
+            try:
+                func()
+            except Exception as exception:
+                cursor.execute('ROLLBACK TO SAVEPOINT party_merge')
+                if log:
+                    # Forget what the failed attempt journaled in memory
+                    log.restore(checkpoint)
+                # The savepoint does not refresh the snapshot, only the lock
+                # timeouts can be retried in this transaction
+                if (getattr(exception, 'pgcode', None) != _LOCK_NOT_AVAILABLE
+                        or attempt >= cls._merge_lock_retries):
+                    raise
+                delay = cls._merge_lock_backoff * 2 ** attempt
+                logger.info(
+                    'Lock not available, retrying in %.1fs', delay
+                )
+                time.sleep(delay * random.uniform(0.5, 1.5))
+                waited += time.time() - start
+                continue
+            finally:
+                cursor.execute('SET LOCAL lock_timeout TO DEFAULT')
+            cursor.execute('RELEASE SAVEPOINT party_merge')
+            return waited
+
+    @classmethod
+    def _merge_prepare(cls, parties, target, log=None):
+        """Deactivate the parties and make their history the one of the
+        target. Return the ids of the parties to merge.
+        """
+        parties = [p for p in parties if p.id != target.id]
+        if not parties:
+            return []
+        source_ids = map(int, parties)
+
+        # Always lock the parties in the same order
+        waited = cls._merge_lock_retry(
+            lambda: cls._merge_lock_parties(source_ids + [target.id]),
+            log=log
+        )
+        if waited and log:
+            log.record_lock_wait(cls._table, waited)
+
+        # Inactive parties first
+        cls.write(parties, {'active': False})
+        Pool().get('party.party.merged').record(source_ids, target.id)
+
+        cls._merge_history(source_ids, target, log=log)
+        return source_ids
+
+    @classmethod
+    def _merge_lock_parties(cls, party_ids):
+        """Lock the rows of the parties by increasing id.
+
+        Other transactions can still insert rows referencing them, the
+        lock is the one taken by the UPDATE which deactivates them.
+        """
+        if backend.name() != 'postgresql':
+            return
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        for sub_ids in grouped_slice(sorted(party_ids)):
+            query, args = tuple(table.select(
+                table.id, where=reduce_ids(table.id, list(sub_ids)),
+                order_by=table.id.asc
+            ))
+            cursor.execute(query + ' FOR NO KEY UPDATE', args)
+
+    @classmethod
+    def _merge_history(cls, source_ids, target, log=None):
+        """Make the history of the parties the one of the target.
+
+        The history rows of all the parties are moved with one UPDATE per
+        slice of ids, then the target is written so that its current state
+        stays its latest revision. The rows which end up with the same
+        date time as another row of the target are deleted with one
+        grouped query, keeping the target's own row (or else the latest
+        row, which is the one read by trytond).
+        """
+        if not cls._history:
+            return
+        cursor = Transaction().cursor
+        history = cls.__table_history__()
+
+        moved = set()
+        for sub_ids in grouped_slice(source_ids):
+            sub_ids = list(sub_ids)
+            rows = cls._merge_update(
+                history, 'id', '__id', target.id,
+                lambda t: reduce_ids(t.id, sub_ids), log=log
+            )
+            moved.update(k for _, k in rows)
+            if log:
+                log.record_update(history._name, 'id', '__id', False, rows)
+        # The sources' latest rows (e.g. their deactivation) are newer
+        cls.write([target], {})
+
+        date_time = Coalesce(history.write_date, history.create_date)
+        cursor.execute(*history.select(
+            date_time, where=history.id == target.id,
+            group_by=[date_time], having=Count(Literal('*')) > 1
+        ))
+        collisions = set(d for d, in cursor.fetchall())
+        if not collisions:
+            return
+        cursor.execute(*history.select(
+            Column(history, '__id'), date_time, where=history.id == target.id
+        ))
+        groups = defaultdict(list)
+        for history_id, row_date_time in cursor.fetchall():
+            if row_date_time in collisions:
+                groups[row_date_time].append(history_id)
+        to_delete = []
+        for history_ids in groups.itervalues():
+            keep = max(history_ids, key=lambda i: (i not in moved, i))
+            to_delete.extend(
+                i for i in history_ids if i != keep and i in moved
+            )
+        for sub_ids in grouped_slice(to_delete):
+            sub_ids = list(sub_ids)
+            where = reduce_ids(Column(history, '__id'), sub_ids)
+            if log:
+                cursor.execute(*history.select(where=where))
+                names = [d[0] for d in cursor.description]
+                log.record_delete(history._name, [
+                    dict(zip(names, row)) for row in cursor.fetchall()
+                ])
+            start = time.time()
+            cursor.execute(*history.delete(where=where))
+            cls._merge_statement(
+                log, 'delete', history._name, None, start, cursor.rowcount
+            )
+
+    @classmethod
+    def _merge_where(cls, merge_target, sql_table, source_ids):
+        "Return the condition matching the rows referencing source_ids"
+        column = Column(sql_table, merge_target.column)
+        if merge_target.kind == 'reference':
+            return column.in_([
+                '%s,%s' % (cls.__name__, i) for i in source_ids
+            ])
+        return reduce_ids(column, source_ids)
+
+    @classmethod
+    def _merge_value(cls, merge_target, target_id):
+        "Return the value stored in the merge target column for target_id"
+        if merge_target.kind == 'reference':
+            return '%s,%s' % (cls.__name__, target_id)
+        return target_id
+
+    @classmethod
+    def _merge_update(
+            cls, sql_table, column_name, key_name, value, where, log=None):
+        """Set column_name to value for the rows of sql_table matching the
+        condition returned by where for a table. Return the list of
+        (previous value, key) of the updated rows.
+
+        On PostgreSQL the previous values are returned by the UPDATE itself
+        (with RETURNING), the other backends read them first.
+        """
+        cursor = Transaction().cursor
+        start = time.time()
+        # A distinct alias for the rows before the update
+        previous = Table(sql_table._name)
+        rows = previous.select(
+            Column(previous, column_name).as_('value'),
+            Column(previous, key_name).as_('key'),
+            where=where(previous)
+        )
+        if backend.name() == 'postgresql':
             cursor.execute(*sql_table.update(
-                columns=[getattr(sql_table, field.name)], values=[target.id],
-                where=(getattr(sql_table, field.name) == self.id)
+                columns=[Column(sql_table, column_name)], values=[value],
+                from_=[rows],
+                where=Column(sql_table, key_name) == rows.key,
+                returning=[rows.value, rows.key]
+            ))
+            result = cursor.fetchall()
+        else:
+            cursor.execute(*rows)
+            result = cursor.fetchall()
+            for sub_rows in grouped_slice(result):
+                cursor.execute(*sql_table.update(
+                    columns=[Column(sql_table, column_name)], values=[value],
+                    where=reduce_ids(
+                        Column(sql_table, key_name), [k for _, k in sub_rows]
+                    )
+                ))
+        cls._merge_statement(
+            log, 'update', sql_table._name, column_name, start, len(result)
+        )
+        return result
+
+    @classmethod
+    def _merge_statement(
+            cls, log, kind, table_name, column_name, start, rowcount):
+        "Measure a statement of a merge started at start"
+        duration = time.time() - start
+        history = table_name.endswith('__history')
+        logger.debug(
+            '%s %s.%s%s: %s rows in %.3fs', kind.upper(), table_name,
+            column_name or '', ' (history)' if history else '', rowcount,
+            duration
+        )
+        cls.merge_statement_executed(
+            kind, table_name, column_name, history, duration, rowcount
+        )
+        if log:
+            log.record_statement(
+                kind, table_name, column_name, history, duration, rowcount
+            )
+
+    @classmethod
+    def merge_statement_executed(
+            cls, kind, table_name, column_name, history, duration,
+            rowcount):
+        """Called after each UPDATE and DELETE of a merge with the table,
+        the column (None for a DELETE), the duration in seconds and the
+        number of rows.
+
+        It does nothing and is meant to be extended to export the measures
+        (e.g. to a metrics server).
+        """
+        pass
+
+    @classmethod
+    def _merge_rewrite(
+            cls, merge_target, source_ids, target_id, history=False,
+            where=None, log=None):
+        """Point the merge target column (or its history) to target_id and
+        journal the rewritten rows in log.
+        """
+        sql_table = Table(
+            merge_target.history if history else merge_target.table
+        )
+        # History rows share the id of the record, __id is their own key
+        key = '__id' if history else 'id'
+
+        def condition(table):
+            condition = cls._merge_where(merge_target, table, source_ids)
+            if where is not None:
+                condition &= where(table)
+            return condition
+
+        rows = cls._merge_update(
+            sql_table, merge_target.column, key,
+            cls._merge_value(merge_target, target_id), condition, log=log
+        )
+        if log:
+            if merge_target.kind == 'reference':
+                rows = [(int(v.split(',')[1]), k) for v, k in rows]
+            log.record_update(
+                sql_table._name, merge_target.column, key,
+                merge_target.kind == 'reference', rows
+            )
+
+    @classmethod
+    def _merge_rewrite_chunks(
+            cls, merge_target, source_ids, target_id, chunk_size,
+            history=False, start=None, log=None):
+        """Rewrite the merge target column in ranges of chunk_size primary
+        keys, starting after start. Yield the last id of each range.
+
+        Each range is retried when its locks are not obtained in time (see
+        _merge_lock_retry).
+        """
+        cursor = Transaction().cursor
+        sql_table = Table(
+            merge_target.history if history else merge_target.table
+        )
+        # History rows share the id of the record, __id is their own key
+        key = '__id' if history else 'id'
+
+        def next_id(after):
+            "Return the first referencing row after the given id"
+            ids = []
+            for sub_ids in grouped_slice(source_ids):
+                where = cls._merge_where(
+                    merge_target, sql_table, list(sub_ids)
+                )
+                if after is not None:
+                    where &= Column(sql_table, key) > after
+                cursor.execute(*sql_table.select(
+                    Min(Column(sql_table, key)), where=where
+                ))
+                ids.extend(i for i, in cursor.fetchall() if i is not None)
+            return min(ids) if ids else None
+
+        def rewrite(lower, upper):
+            for sub_ids in grouped_slice(source_ids):
+                cls._merge_rewrite(
+                    merge_target, list(sub_ids), target_id, history=history,
+                    where=lambda t: (Column(t, key) >= lower) &
+                    (Column(t, key) <= upper), log=log
+                )
+
+        lower = next_id(start)
+        while lower is not None:
+            upper = lower + chunk_size - 1
+            waited = cls._merge_lock_retry(
+                lambda: rewrite(lower, upper), log=log
+            )
+            if waited and log:
+                log.record_lock_wait(merge_target.table, waited)
+            yield upper
+            lower = next_id(upper)
+
+    @classmethod
+    def _merge_resolve_conflicts(
+            cls, merge_target, source_ids, target_id, conflict_policy,
+            log=None, start=None):
+        """Delete the rows which would violate a unique constraint once
+        rewritten, instead of failing late in the UPDATE. The deleted rows
+        are journaled in log. Only the rows of the sources after the start
+        id are rewritten (see _merge_rewrite_chunks).
+        """
+        if not merge_target.unique:
+            return
+        cursor = Transaction().cursor
+        sql_table = Table(merge_target.table)
+
+        if merge_target.kind == 'many2many':
+            # Relation rows are identical, any of them can be kept
+            conflict_policy = 'keep_target'
+        to_delete = []
+        for columns in merge_target.unique:
+            to_delete.extend(cls._merge_conflicts(
+                merge_target, columns, source_ids, target_id,
+                conflict_policy, start=start
             ))
-            if Model._history:
-                # If historization is enabled on the model
-                # then the party value in the history should
-                # now point to the target party id since the
-                # history of the current party is already the history of
-                # target party.
-                history_table = Model.__table_history__()
-                cursor.execute(*history_table.update(
-                    columns=[getattr(history_table, field.name)],
-                    values=[target.id],
-                    where=(getattr(history_table, field.name) == self.id)
+        for sub_ids in grouped_slice(sorted(set(to_delete))):
+            sub_ids = list(sub_ids)
+            if log:
+                cursor.execute(*sql_table.select(
+                    where=reduce_ids(Column(sql_table, 'id'), sub_ids)
                 ))
+                names = [d[0] for d in cursor.description]
+                log.record_delete(sql_table._name, [
+                    dict(zip(names, row)) for row in cursor.fetchall()
+                ])
+            start = time.time()
+            cursor.execute(*sql_table.delete(
+                where=reduce_ids(Column(sql_table, 'id'), sub_ids)
+            ))
+            cls._merge_statement(
+                log, 'delete', sql_table._name, None, start, cursor.rowcount
+            )
+
+    @classmethod
+    def _merge_conflicts(
+            cls, merge_target, columns, source_ids, target_id,
+            conflict_policy, start=None):
+        """Return the ids of the rows to delete so that the merge target
+        column stays unique together with columns, the rows of the sources
+        up to the start id being left out.
+
+        The would-be duplicates are detected with a single grouped query and
+        the rows are only read when there is a conflict.
+        """
+        cursor = Transaction().cursor
+        table = Table(merge_target.table)
+        party = Column(table, merge_target.column)
+        others = [Column(table, name) for name in columns]
+
+        where = reduce_ids(party, list(source_ids))
+        if start is not None:
+            where &= Column(table, 'id') > start
+        where |= party == target_id
+        for other in others:
+            # NULL values never violate a unique constraint
+            where &= other != Null
+        if others:
+            cursor.execute(*table.select(
+                *others, where=where, group_by=others,
+                having=Count(Literal('*')) > 1
+            ))
+            conflicts = set(tuple(row) for row in cursor.fetchall())
+        else:
+            cursor.execute(*table.select(Count(Literal('*')), where=where))
+            count, = cursor.fetchone()
+            conflicts = set([()]) if count > 1 else set()
+        if not conflicts:
+            return []
+
+        cursor.execute(*table.select(
+            Column(table, 'id'), party,
+            Coalesce(Column(table, 'write_date'), Column(table, 'create_date')),
+            *others, where=where
+        ))
+        groups = defaultdict(list)
+        for row in cursor.fetchall():
+            key = tuple(row[3:])
+            if key in conflicts:
+                groups[key].append(row[:3])
+
+        to_delete = []
+        for rows in groups.itervalues():
+            if conflict_policy == 'delete_source':
+                to_delete.extend(
+                    id_ for id_, party_id, _ in rows if party_id != target_id
+                )
+                continue
+            if conflict_policy == 'keep_newest':
+                keep = max(
+                    rows, key=lambda r: (r[2] or datetime.datetime.min, r[0])
+                )
+            else:
+                keep = min(rows, key=lambda r: (r[1] != target_id, r[0]))
+            to_delete.extend(id_ for id_, _, _ in rows if id_ != keep[0])
+        return to_delete
+
+    def merge_into(self, target):
+        """Merge current record to target party.
+        """
+        return self.merge([self], target)
+
+
+class PartyMergeStaged(ModelSQL):
+    'Party Merge Staged'
+    __name__ = 'party.party.merge.staged'
+    # The parties selected in a session of the merge wizard are kept on
+    # the server instead of sending their ids back and forth to the client
+
+    session = fields.Many2One(
+        'ir.session.wizard', 'Session', required=True, select=True,
+        ondelete='CASCADE',
+    )
+    party = fields.Many2One(
+        'party.party', 'Party', required=True, select=True,
+        ondelete='CASCADE',
+    )
+
+    @classmethod
+    def stage(cls, session_id, party_ids):
+        "Stage the parties in the session, with one INSERT per slice"
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        now = datetime.datetime.now()
+        user = Transaction().user
+        for sub_ids in grouped_slice(sorted(set(party_ids))):
+            cursor.execute(*table.insert(
+                columns=[
+                    table.session, table.party, table.create_uid,
+                    table.create_date,
+                ],
+                values=[[session_id, i, user, now] for i in sub_ids]
+            ))
+
+    @classmethod
+    def count(cls, session_id):
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        cursor.execute(*table.select(
+            Count(Literal('*')), where=table.session == session_id
+        ))
+        return cursor.fetchone()[0]
+
+    @classmethod
+    def get_party_ids(cls, session_id, offset=None, limit=None):
+        "Return the ids of the parties staged in the session by id"
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        cursor.execute(*table.select(
+            table.party, where=table.session == session_id,
+            order_by=table.party.asc, offset=offset, limit=limit
+        ))
+        return [i for i, in cursor.fetchall()]
 
 
 class PartyMergeView(ModelView):
     'Party Merge'
     __name__ = 'party.party.merge.view'
 
-    duplicates = fields.One2Many(
-        'party.party', None, "Duplicates", readonly=True,
+    session = fields.Integer('Session', readonly=True)
+    count = fields.Integer(
+        'Duplicates', readonly=True,
+        help="The number of parties merged into the target.",
     )
     target = fields.Many2One(
         'party.party', 'Target', required=True,
-        domain=[('id', 'not in', Eval('duplicates'))],
-        depends=['duplicates'],
+        domain=[('merge_session', '!=', Eval('session'))],
+        depends=['session'],
+    )
+    conflict_policy = fields.Selection(
+        CONFLICT_POLICIES, 'Conflict Policy', required=True,
+        help="How to resolve the records which would be duplicated once "
+        "merged into the target.",
     )
 
+    chunk_size = fields.Integer(
+        'Chunk Size', help="Maximum number of rows rewritten per "
+        "transaction when the merge is queued.",
+    )
+    consolidate = fields.Boolean(
+        'Consolidate', help="Copy the best values of the duplicates (like "
+        "the language or the VAT number) to the target before merging.",
+    )
+
+    @staticmethod
+    def default_conflict_policy():
+        return Pool().get('party.party')._merge_conflict_policy
+
+    @staticmethod
+    def default_consolidate():
+        return True
+
+
+class PartyMergePreview(ModelView):
+    'Party Merge Preview'
+    __name__ = 'party.party.merge.preview'
+
+    page = fields.Integer('Page', readonly=True)
+    pages = fields.Integer('Pages', readonly=True)
+    lines = fields.One2Many(
+        'party.party.merge.preview.line', None, 'Duplicates', readonly=True,
+    )
+
+
+class PartyMergePreviewLine(ModelView):
+    'Party Merge Preview Line'
+    __name__ = 'party.party.merge.preview.line'
+
+    party = fields.Many2One('party.party', 'Party', readonly=True)
+    references = fields.Integer(
+        'References', readonly=True,
+        help="The number of rows referencing the party.",
+    )
+
+
+class PartyMergePlan(ModelView):
+    'Party Merge Plan'
+    __name__ = 'party.party.merge.plan'
+
+    plan = fields.Text('Plan', readonly=True)
+    consolidation = fields.Text('Consolidation', readonly=True)
+    rows = fields.Integer('Rows', readonly=True)
+    statements = fields.Integer('Statements', readonly=True)
+    estimate = fields.Float(
+        'Estimated Time (s)', digits=(16, 1), readonly=True
+    )
+
+
+class PartyMergeReport(ModelView):
+    'Party Merge Report'
+    __name__ = 'party.party.merge.report'
+
+    log = fields.Many2One('party.merge.log', 'Log', readonly=True)
+    report = fields.Text('Report', readonly=True)
+    statements = fields.Integer('Statements', readonly=True)
+    rows = fields.Integer('Rows', readonly=True)
+    duration = fields.Float('Duration (s)', digits=(16, 3), readonly=True)
+
 
 class PartyMerge(Wizard):
     __name__ = 'party.party.merge'
@@ -99,18 +2006,194 @@ class PartyMerge(Wizard):
         'party.party.merge.view',
         'party_merge.party_merge_view', [
             Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Duplicates', 'preview', 'tryton-list'),
+            Button('Preview', 'plan', 'tryton-find'),
+            Button('Queue', 'enqueue', 'tryton-go-next'),
             Button('OK', 'result', 'tryton-ok'),
         ]
     )
+    preview = StateView(
+        'party.party.merge.preview',
+        'party_merge.party_merge_preview_view', [
+            Button('Back', 'merge', 'tryton-go-previous'),
+            Button('Previous Page', 'preview_previous', 'tryton-go-previous'),
+            Button(
+                'Next Page', 'preview_next', 'tryton-go-next', default=True
+            ),
+        ]
+    )
+    preview_previous = StateTransition()
+    preview_next = StateTransition()
+    plan = StateView(
+        'party.party.merge.plan',
+        'party_merge.party_merge_plan_view', [
+            Button('Back', 'merge', 'tryton-go-previous'),
+            Button('Queue', 'enqueue', 'tryton-go-next'),
+            Button('OK', 'result', 'tryton-ok', default=True),
+        ]
+    )
     result = StateTransition()
+    report = StateView(
+        'party.party.merge.report',
+        'party_merge.party_merge_report_view', [
+            Button('Close', 'end', 'tryton-close', default=True),
+        ]
+    )
+    enqueue = StateTransition()
+
+    #: Number of duplicates per page of the preview
+    _preview_page_size = 50
+
+    @property
+    def duplicates(self):
+        "The parties staged in the session"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Staged = pool.get('party.party.merge.staged')
+        return Party.browse(Staged.get_party_ids(self._session_id))
 
     def default_merge(self, fields):
+        pool = Pool()
+        Cluster = pool.get('party.duplicate.cluster')
+        Staged = pool.get('party.party.merge.staged')
+
+        context = Transaction().context
+        values = {}
+        party_ids = context.get('active_ids') or []
+        if context.get('active_model') == Cluster.__name__:
+            # Propose the oldest party of the clusters as target
+            party_ids = sorted(set(
+                m.party.id
+                for c in Cluster.browse(context['active_ids'])
+                for m in c.members if m.party.active
+            ))
+            values['target'] = party_ids[0] if party_ids else None
+            party_ids = party_ids[1:]
+        # The selection is staged once per session
+        if not Staged.count(self._session_id):
+            Staged.stage(self._session_id, party_ids)
+        values.update({
+            'session': self._session_id,
+            'count': Staged.count(self._session_id),
+        })
+        # Keep the values when coming back from the plan
+        target = getattr(self.merge, 'target', None)
+        if target:
+            values.update({
+                'target': target.id,
+                'conflict_policy': self.merge.conflict_policy,
+                'chunk_size': self.merge.chunk_size,
+                'consolidate': getattr(self.merge, 'consolidate', True),
+            })
+        return values
+
+    def default_preview(self, fields):
+        """Show a page of the staged parties with their number of
+        references, only the parties of the page are read.
+        """
+        pool = Pool()
+        Party = pool.get('party.party')
+        Staged = pool.get('party.party.merge.staged')
+
+        size = self._preview_page_size
+        pages = max((Staged.count(self._session_id) + size - 1) // size, 1)
+        page = min(max(getattr(self.preview, 'page', None) or 1, 1), pages)
+        self.preview.page = page
+        party_ids = Staged.get_party_ids(
+            self._session_id, offset=(page - 1) * size, limit=size
+        )
+        counts = Party.merge_reference_counts(party_ids)
+        return {
+            'page': page,
+            'pages': pages,
+            'lines': [{
+                'party': party_id,
+                'references': counts.get(party_id, 0),
+            } for party_id in party_ids],
+        }
+
+    def transition_preview_previous(self):
+        self.preview.page = (getattr(self.preview, 'page', None) or 1) - 1
+        return 'preview'
+
+    def transition_preview_next(self):
+        self.preview.page = (getattr(self.preview, 'page', None) or 1) + 1
+        return 'preview'
+
+    def default_plan(self, fields):
+        Party = Pool().get('party.party')
+
+        plan = Party.merge_plan(self.duplicates, self.merge.target)
+        text = []
+        for line in plan['lines']:
+            if not line['rows'] and not line['history_rows']:
+                continue
+            text.append('%s.%s (%s): %s rows, %s history rows' % (
+                line['table'], line['column'], line['model'],
+                line['rows'], line['history_rows'],
+            ))
+        text.extend('Step %s' % name for name in plan['steps'])
+        consolidation = []
+        if getattr(self.merge, 'consolidate', False):
+            target = self.merge.target
+            for name, value in sorted(Party.merge_consolidate_values(
+                    self.duplicates, target).iteritems()):
+                field = Party._fields[name]
+                if field._type == 'many2one' and value:
+                    value = Pool().get(field.model_name)(value).rec_name
+                consolidation.append('%s: %s -> %s' % (
+                    field.string, getattr(target, name) or '', value))
         return {
-            'duplicates': Transaction().context['active_ids'],
+            'plan': '\n'.join(text),
+            'consolidation': '\n'.join(consolidation),
+            'rows': plan['rows'],
+            'statements': plan['statements'],
+            'estimate': plan['estimate'],
         }
 
     def transition_result(self):
-        for party in self.merge.duplicates:
-            party.merge_into(self.merge.target)
+        Party = Pool().get('party.party')
+
+        if getattr(self.merge, 'consolidate', False):
+            Party.merge_consolidate(self.duplicates, self.merge.target)
+        log = Party.merge(
+            self.duplicates, self.merge.target,
+            conflict_policy=self.merge.conflict_policy
+        )
+        self.close_clusters()
+
+        if not log:
+            return 'end'
+        self.report.log = log
+        return 'report'
+
+    def default_report(self, fields):
+        log = self.report.log
+        return {
+            'log': log.id,
+            'report': log.get_report(),
+            'statements': sum(s.statements for s in log.statistics),
+            'rows': sum(s.rows for s in log.statistics),
+            'duration': log.duration,
+        }
+
+    def transition_enqueue(self):
+        MergeRequest = Pool().get('party.merge.request')
+
+        MergeRequest.enqueue(
+            self.duplicates, self.merge.target,
+            conflict_policy=self.merge.conflict_policy,
+            chunk_size=self.merge.chunk_size,
+            consolidate=getattr(self.merge, 'consolidate', False)
+        )
+        self.close_clusters()
 
         return 'end'
+
+    def close_clusters(self):
+        "Mark the duplicate clusters the wizard was launched from as merged"
+        Cluster = Pool().get('party.duplicate.cluster')
+
+        context = Transaction().context
+        if context.get('active_model') == Cluster.__name__:
+            Cluster.merged(Cluster.browse(context['active_ids']))
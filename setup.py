@@ -88,6 +88,68 @@ class PostgresTest(Command):
         sys.exit(-1)
 
 
+class SQLiteBenchmark(Command):
+    """
+    Benchmark the merge on SQLite
+    """
+    description = "Benchmark the merge on SQLite"
+
+    user_options = [
+        ('sizes=', None, "comma separated numbers of duplicates"),
+        ('invoices=', None, "invoices per duplicate"),
+        ('addresses=', None, "addresses per duplicate"),
+        ('history=', None, "history rows per duplicate"),
+        ('tolerance=', None, "accepted slowdown against the baseline"),
+        ('save', None, "store the results as the baseline"),
+    ]
+    boolean_options = ['save']
+
+    def initialize_options(self):
+        self.sizes = None
+        self.invoices = 2
+        self.addresses = 1
+        self.history = 2
+        self.tolerance = 0.5
+        self.save = False
+
+    def finalize_options(self):
+        if self.sizes:
+            self.sizes = map(int, self.sizes.split(','))
+        self.invoices = int(self.invoices)
+        self.addresses = int(self.addresses)
+        self.history = int(self.history)
+        self.tolerance = float(self.tolerance)
+
+    def setup_database(self):
+        os.environ['TRYTOND_DATABASE_URI'] = 'sqlite://'
+        os.environ['DB_NAME'] = ':memory:'
+
+    def run(self):
+        if self.distribution.tests_require:
+            self.distribution.fetch_build_eggs(self.distribution.tests_require)
+
+        self.setup_database()
+
+        from tests import benchmark
+        if benchmark.run(
+                sizes=self.sizes, invoices=self.invoices,
+                addresses=self.addresses, history=self.history,
+                tolerance=self.tolerance, save=self.save):
+            sys.exit(0)
+        sys.exit(-1)
+
+
+class PostgresBenchmark(SQLiteBenchmark):
+    """
+    Benchmark the merge on Postgres
+    """
+    description = "Benchmark the merge on Postgresql"
+
+    def setup_database(self):
+        os.environ['TRYTOND_DATABASE_URI'] = 'postgresql://'
+        os.environ['DB_NAME'] = 'test_' + str(int(time.time()))
+
+
 requires = []
 tests_require = [
     get_required_version('trytond_account_invoice_history'),
@@ -122,7 +184,8 @@ setup(
     package_data={
         'trytond.modules.%s' % MODULE: info.get('xml', []) +
         info.get('translation', []) +
-        ['tryton.cfg', 'locale/*.po', 'tests/*.rst', 'reports/*.odt'] +
+        ['tryton.cfg', 'locale/*.po', 'tests/*.rst', 'tests/*.json',
+         'reports/*.odt'] +
         ['view/*.xml'],
     },
     classifiers=[
@@ -143,11 +206,16 @@ setup(
     entry_points="""
     [trytond.modules]
     %s = trytond.modules.%s
-    """ % (MODULE, MODULE),
+
+    [console_scripts]
+    trytond_party_merge = trytond.modules.%s.console:main
+    """ % (MODULE, MODULE, MODULE),
     test_suite='tests',
     test_loader='trytond.test_loader:Loader',
     cmdclass={
         'test': SQLiteTest,
         'test_on_postgres': PostgresTest,
+        'benchmark': SQLiteBenchmark,
+        'benchmark_on_postgres': PostgresBenchmark,
     }
 )
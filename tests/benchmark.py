@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/benchmark.py
+
+    Throughput of the merge on generated parties. Run it with::
+
+        python setup.py benchmark [--sizes=1,10,100,1000] [--save]
+        python setup.py benchmark_on_postgres
+
+    The results are compared to the baseline stored in benchmark.json, a
+    merge issuing more statements or running slower than the baseline
+    (beyond the tolerance) is reported as a regression.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import json
+import time
+import resource
+import threading
+
+from trytond.tests.test_tryton import USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+
+from tests.test_party import TestParty
+
+SIZES = [1, 10, 100, 1000]
+BASELINE = os.path.join(os.path.dirname(__file__), 'benchmark.json')
+# The number of statements varies slightly with the record cache
+STATEMENT_TOLERANCE = 0.05
+
+
+def current_memory():
+    "Return the resident memory of the process in kB"
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize() // 1024
+    except IOError:
+        # Only the peak is known outside of Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class MemorySampler(threading.Thread):
+    "Sample the resident memory to find its peak while the thread runs"
+
+    def __init__(self, interval=0.01):
+        super(MemorySampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.start_memory = self.peak = current_memory()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, current_memory())
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        "Stop sampling and return the growth of the memory in kB"
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, current_memory())
+        return self.peak - self.start_memory
+
+
+class MergeBenchmark(TestParty):
+    '''
+    Merge Benchmark
+    '''
+
+    def runTest(self):
+        pass
+
+    def generate(self, size, invoices, addresses, history):
+        """Create a target and size duplicates, each one with addresses,
+        invoices and history rows. Returns the target and the duplicates.
+        """
+        journal, = self.Journal.search([('name', '=', 'Revenue')])
+        account = self._get_account_by_kind('receivable')
+        target, = self.Party.create([{'name': 'Target'}])
+        duplicates = self.Party.create([{
+            'name': 'Duplicate %s' % i,
+            'addresses': [('create', [{
+                'name': 'Address %s' % j,
+                'street': 'Street %s' % j,
+                'city': 'City',
+                'country': self.country.id,
+            } for j in range(addresses)])],
+        } for i in range(size)])
+
+        for _ in range(history):
+            # Every write stores a row in the history table
+            self.Party.write(duplicates, {})
+
+        with Transaction().set_context({'company': self.company.id}):
+            self.Invoice.create([{
+                'party': party.id,
+                'invoice_address': party.addresses[0].id
+                if party.addresses else None,
+                'journal': journal.id,
+                'payment_term': self.payment_term.id,
+                'currency': self.currency.id,
+                'account': account.id,
+            } for party in duplicates for _ in range(invoices)
+                if party.addresses])
+        return target, duplicates
+
+    def measure(self, size, invoices=2, addresses=1, history=2):
+        """Merge size generated duplicates and return the duration, the
+        number of statements executed and the memory growth of the merge.
+        The transaction is rolled back.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            self.setup_defaults()
+            target, duplicates = self.generate(
+                size, invoices, addresses, history)
+
+            cursor = txn.cursor
+            counter = [0]
+            execute = cursor.execute
+
+            def counting_execute(*args, **kwargs):
+                counter[0] += 1
+                return execute(*args, **kwargs)
+            cursor.execute = counting_execute
+
+            sampler = MemorySampler()
+            sampler.start()
+            start = time.time()
+            try:
+                self.Party.merge(duplicates, target)
+            finally:
+                duration = time.time() - start
+                memory = sampler.stop()
+                del cursor.execute
+        return {
+            'duration': round(duration, 3),
+            'statements': counter[0],
+            'memory': memory,
+        }
+
+
+def load_baseline(path=BASELINE):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as baseline:
+        return json.load(baseline)
+
+
+def compare(result, reference, tolerance):
+    "Return the regressions of result against its reference as text"
+    regressions = []
+    if result['statements'] > \
+            reference['statements'] * (1 + STATEMENT_TOLERANCE):
+        regressions.append('%s statements instead of %s' % (
+            result['statements'], reference['statements']))
+    if result['duration'] > reference['duration'] * (1 + tolerance):
+        regressions.append('%.3fs instead of %.3fs' % (
+            result['duration'], reference['duration']))
+    if result['memory'] > max(reference['memory'], 1024) * (1 + tolerance):
+        regressions.append('%skB instead of %skB' % (
+            result['memory'], reference['memory']))
+    return regressions
+
+
+def run(
+        sizes=None, invoices=2, addresses=1, history=2, tolerance=0.5,
+        save=False, path=BASELINE, stream=sys.stdout):
+    """Run the benchmark for the sizes, compare it to the baseline of the
+    backend and store it when save is set. Returns False on regressions.
+    """
+    backend = os.environ.get('TRYTOND_DATABASE_URI', 'sqlite://').split(
+        ':', 1)[0]
+    parameters = {
+        'invoices': invoices,
+        'addresses': addresses,
+        'history': history,
+    }
+    baseline = load_baseline(path)
+    reference = baseline.get(backend, {})
+    if reference.get('parameters') != parameters:
+        reference = {}
+
+    benchmark = MergeBenchmark()
+    benchmark.setUp()
+    results = {}
+    success = True
+    for size in sizes or SIZES:
+        result = results[str(size)] = benchmark.measure(size, **parameters)
+        stream.write(
+            '%5s duplicates: %8.3fs %8s statements %8skB' % (
+                size, result['duration'], result['statements'],
+                result['memory']))
+        if str(size) in reference.get('results', {}):
+            regressions = compare(
+                result, reference['results'][str(size)], tolerance)
+            if regressions:
+                success = False
+                stream.write('  REGRESSION: %s' % ', '.join(regressions))
+        stream.write('\n')
+
+    if save:
+        baseline[backend] = {
+            'parameters': parameters,
+            'results': dict(reference.get('results', {}), **results),
+        }
+        with open(path, 'w') as baseline_file:
+            json.dump(
+                baseline, baseline_file, indent=4, sort_keys=True,
+                separators=(',', ': '))
+            baseline_file.write('\n')
+    return success
@@ -7,13 +7,21 @@
 """
 import unittest
 import datetime
+import tempfile
 from dateutil.relativedelta import relativedelta
+from sql import Null
 
 from trytond.tests.test_tryton import POOL, USER
 from trytond.tests.test_tryton import DB_NAME, CONTEXT
 from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+from trytond import backend
 import trytond.tests.test_tryton
 
+from trytond.modules.party_merge.party import MergeTarget, MergeStep, \
+    _MergeJournal
+from trytond.modules.party_merge.console import read_mapping
+
 
 class TestParty(unittest.TestCase):
     '''
@@ -316,6 +324,1680 @@ class TestParty(unittest.TestCase):
             self.assertNotIn(party2.id, id_list)
             self.assertIn(party3.id, id_list)
 
+    def test0015_bulk_merge_parties(self):
+        """
+        Test merging a batch of parties into a target in one call
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            target, = self.Party.create([{
+                'name': 'Target',
+                'addresses': [('create', [{
+                    'name': 'target',
+                    'city': 'New Delhi',
+                }])]
+            }])
+            duplicates = self.Party.create([{
+                'name': 'Duplicate %d' % index,
+                'addresses': [('create', [{
+                    'name': 'duplicate %d' % index,
+                    'city': 'Mumbai',
+                }])]
+            } for index in range(5)])
+
+            self.Party.merge(duplicates, target)
+
+            self.assertEqual(len(target.addresses), 6)
+            self.assertFalse(
+                any(party.active for party in self.Party.browse(duplicates))
+            )
+            self.assertTrue(target.active)
+
+    def test0020_merge_targets(self):
+        """
+        Test the introspection of the columns rewritten by a merge
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            targets = self.Party.get_merge_targets()
+
+            address_target, = [
+                t for t in targets if t.model == 'party.address'
+            ]
+            self.assertEqual(address_target.table, 'party_address')
+            self.assertEqual(address_target.column, 'party')
+            self.assertEqual(
+                address_target.history, 'party_address__history'
+            )
+            invoice_target, = [
+                t for t in targets
+                if t.model == 'account.invoice' and t.field == 'party'
+            ]
+            self.assertEqual(invoice_target.history, None)
+
+            # Function fields are never rewritten
+            self.assertFalse(
+                [t for t in targets if t.model == 'party.party.merge.view']
+            )
+
+            # The registry is cached for the database
+            self.assertIs(self.Party.get_merge_targets(), targets)
+
+    def test0025_merge_many2many_and_reference(self):
+        """
+        Test that relation tables and reference fields are merged
+        """
+        Category = POOL.get('party.category')
+        Attachment = POOL.get('ir.attachment')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            self.setup_defaults()
+
+            customer, supplier = Category.create([{
+                'name': 'Customer',
+            }, {
+                'name': 'Supplier',
+            }])
+            party1, party2, party3 = self.Party.create([{
+                'name': 'Party 1',
+                'categories': [('add', [customer.id])],
+            }, {
+                'name': 'Party 2',
+                'categories': [('add', [customer.id, supplier.id])],
+            }, {
+                'name': 'Party 3',
+                'categories': [('add', [supplier.id])],
+            }])
+            attachment, = Attachment.create([{
+                'name': 'contract.txt',
+                'resource': str(party2),
+            }])
+
+            self.Party.merge([party2, party3], party1)
+
+            relation = POOL.get('party.party-party.category').__table__()
+            txn.cursor.execute(*relation.select(
+                relation.category, where=relation.party == party1.id
+            ))
+            self.assertEqual(
+                sorted(c for c, in txn.cursor.fetchall()),
+                sorted([customer.id, supplier.id])
+            )
+            attachment_table = Attachment.__table__()
+            txn.cursor.execute(*attachment_table.select(
+                attachment_table.resource,
+                where=attachment_table.id == attachment.id
+            ))
+            self.assertEqual(txn.cursor.fetchone()[0], str(party1))
+
+    def test0030_merge_unique_conflicts(self):
+        """
+        Test the resolution of rows violating a unique constraint
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            party1, party2, party3 = self.Party.create([{
+                'name': 'Party 1',
+                'addresses': [('create', [{'name': 'Main'}])],
+            }, {
+                'name': 'Party 2',
+                'addresses': [('create', [{'name': 'Main'}, {
+                    'name': 'Warehouse'
+                }])],
+            }, {
+                'name': 'Party 3',
+                'addresses': [('create', [{'name': 'Main'}])],
+            }])
+            main1, = party1.addresses
+            main2, warehouse = party2.addresses
+            main3, = party3.addresses
+            self.Address.write([main3], {'street': 'Updated'})
+
+            merge_target = MergeTarget(
+                'party.address', 'party', 'many2one', 'party_address',
+                'party', None, (('name',),)
+            )
+
+            def conflicts(policy):
+                return sorted(self.Party._merge_conflicts(
+                    merge_target, ('name',), [party2.id, party3.id],
+                    party1.id, policy
+                ))
+
+            self.assertEqual(
+                conflicts('keep_target'), sorted([main2.id, main3.id])
+            )
+            self.assertEqual(
+                conflicts('keep_newest'), sorted([main1.id, main2.id])
+            )
+            self.assertEqual(
+                conflicts('delete_source'), sorted([main2.id, main3.id])
+            )
+            self.assertEqual(
+                self.Party._merge_conflicts(
+                    merge_target, ('name',), [party2.id], party3.id,
+                    'delete_source'
+                ), [main2.id]
+            )
+            self.assertNotIn(
+                warehouse.id, conflicts('keep_target')
+            )
+
+    def test0035_merge_request(self):
+        """
+        Test queuing a merge and running the request
+        """
+        MergeRequest = POOL.get('party.merge.request')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            target, party2, party3 = self.Party.create([{
+                'name': 'Target',
+                'addresses': [('create', [{'name': 'target'}])],
+            }, {
+                'name': 'Party 2',
+                'addresses': [('create', [{'name': 'party2'}])],
+            }, {
+                'name': 'Party 3',
+                'addresses': [('create', [{'name': 'party3'}])],
+            }])
+
+            request = MergeRequest.enqueue([party2, party3], target)
+            self.assertEqual(request.state, 'pending')
+            self.assertEqual(request.conflict_policy, 'keep_target')
+
+            MergeRequest.cancel([request])
+            self.assertEqual(request.state, 'cancel')
+            MergeRequest.retry([request])
+            self.assertEqual(request.state, 'pending')
+
+            request.run()
+
+            self.assertEqual(len(target.addresses), 3)
+            self.assertFalse(party2.active)
+            # The request still records the merged parties
+            self.assertEqual(
+                sorted(map(int, MergeRequest(request.id).parties)),
+                sorted([party2.id, party3.id])
+            )
+
+    def test0040_merge_in_chunks(self):
+        """
+        Test the chunked merge and its resumption from a checkpoint
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            target, = self.Party.create([{
+                'name': 'Target',
+                'addresses': [('create', [{'name': 'target'}])],
+            }])
+            duplicates = self.Party.create([{
+                'name': 'Duplicate %d' % index,
+                'addresses': [('create', [{
+                    'name': 'address %d' % i
+                } for i in range(3)])],
+            } for index in range(2)])
+
+            chunks = self.Party.merge_in_chunks(duplicates, target, 2)
+            for merge_target, history, last_id in chunks:
+                if (merge_target.table, history) == ('party_address', False):
+                    # Interrupt the merge after the first chunk
+                    break
+            chunks.close()
+            self.assertEqual(len(self.Party(target.id).addresses), 3)
+
+            resume = {
+                ('party_address', 'party', False): last_id,
+            }
+            checkpoints = [
+                c for c in self.Party.merge_in_chunks(
+                    duplicates, target, 2, resume=resume
+                ) if (c[0].table, c[1]) == ('party_address', False)
+            ]
+            self.assertEqual(len(checkpoints), 2)
+            self.assertEqual(len(self.Party(target.id).addresses), 7)
+
+            # The conflicts of the rows added between the runs are resolved
+            Category = POOL.get('party.category')
+            Relation = POOL.get('party.party-party.category')
+            customer, supplier = Category.create([{
+                'name': 'Customer',
+            }, {
+                'name': 'Supplier',
+            }])
+            party1, party2 = self.Party.create([{
+                'name': 'Party 1',
+                'categories': [('add', [customer.id])],
+            }, {
+                'name': 'Party 2',
+                'categories': [('add', [supplier.id])],
+            }])
+            merge_target, = [
+                t for t in self.Party.get_merge_targets()
+                if t.table == Relation._table
+            ]
+            chunks = self.Party._merge_target_chunks(
+                merge_target, [party2.id], party1.id, 1, 'keep_target', {},
+                None
+            )
+            _, last_id = next(chunks)
+            chunks.close()
+            self.Party.write([party2], {
+                'categories': [('add', [customer.id])],
+            })
+            list(self.Party._merge_target_chunks(
+                merge_target, [party2.id], party1.id, 1, 'keep_target',
+                {(Relation._table, 'party', False): last_id}, None
+            ))
+            self.assertEqual(
+                sorted(r.category.id for r in Relation.search([
+                    ('party', 'in', [party1.id, party2.id]),
+                ])),
+                sorted([customer.id, supplier.id])
+            )
+
+    def test0045_merge_plan(self):
+        """
+        Test the dry-run plan of a merge
+        """
+        PartyMergeWizard = POOL.get('party.party.merge', type='wizard')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            target, = self.Party.create([{
+                'name': 'Target',
+                'addresses': [('create', [{'name': 'target'}])],
+            }])
+            duplicates = self.Party.create([{
+                'name': 'Duplicate %d' % index,
+                'addresses': [('create', [
+                    {'name': 'home'}, {'name': 'office'},
+                ])],
+            } for index in range(2)])
+
+            plan = self.Party.merge_plan(duplicates, target)
+
+            address_line, = [
+                line for line in plan['lines']
+                if line['table'] == 'party_address'
+            ]
+            self.assertEqual(address_line['rows'], 4)
+            self.assertEqual(address_line['history_rows'], 4)
+            self.assertTrue(plan['rows'] >= 8)
+            self.assertTrue(plan['estimate'] > 0)
+
+            # Nothing was merged
+            self.assertTrue(all(p.active for p in duplicates))
+            self.assertEqual(len(self.Party(target.id).addresses), 1)
+
+            session_id, _, _ = PartyMergeWizard.create()
+            wizard = PartyMergeWizard(session_id)
+            with Transaction().set_context(
+                    active_ids=map(int, duplicates)):
+                values = wizard.default_merge(None)
+            self.assertEqual(values['session'], session_id)
+            self.assertEqual(values['count'], len(duplicates))
+            wizard.merge.target = target
+            values = wizard.default_plan(None)
+            self.assertEqual(values['rows'], plan['rows'])
+            self.assertIn('party_address.party', values['plan'])
+
+    def test0050_merge_indexes(self):
+        """
+        Test the report and creation of the indexes used by a merge
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            report = self.Party.merge_index_report()
+
+            address_line, = [
+                line for line in report
+                if (line['table'], line['column']) ==
+                ('party_address', 'party')
+            ]
+            # party.address.party is a select field
+            self.assertTrue(address_line['indexed'])
+
+            missing = [line for line in report if not line['indexed']]
+            self.assertTrue(missing)
+
+            created = self.Party.merge_create_indexes()
+            self.assertEqual(len(created), len(missing))
+            self.assertTrue(all(len(name) <= 63 for name in created))
+
+            # The long names are shortened and remain unique
+            long_name = self.Party._merge_index_name('a' * 40, 'b' * 30)
+            self.assertEqual(len(long_name), 63)
+            self.assertNotEqual(
+                long_name, self.Party._merge_index_name('a' * 40, 'b' * 31)
+            )
+            self.assertTrue(all(
+                line['indexed'] for line in self.Party.merge_index_report()
+            ))
+
+    def test0055_detect_duplicates(self):
+        """
+        Test the detection of duplicate parties
+        """
+        from trytond.modules.party_merge.duplicate import normalize, \
+            soundex, score
+
+        self.assertEqual(
+            normalize(u'Ren\xe9e  O\'Brien-Co.'), u'renee o brien co'
+        )
+        self.assertEqual(soundex('robert'), soundex('rupert'))
+        self.assertEqual(soundex('tymczak'), 'T522')
+
+        Cluster = POOL.get('party.duplicate.cluster')
+        PartyMergeWizard = POOL.get('party.party.merge', type='wizard')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            john1, john2, smith, other = self.Party.create([{
+                'name': 'John Doe Ltd.',
+            }, {
+                'name': 'john  doe',
+            }, {
+                'name': 'Smith',
+                'contact_mechanisms': [('create', [{
+                    'type': 'email', 'value': 'Doe@Example.com',
+                }])],
+            }, {
+                'name': 'Somebody Else',
+            }])
+            self.ContactMechanism = POOL.get('party.contact_mechanism')
+            self.ContactMechanism.create([{
+                'party': john2.id, 'type': 'email',
+                'value': ' doe@example.com',
+            }])
+
+            # Each pair is scored once with all its shared keys, whatever
+            # the size of the pages of keys
+            Key = POOL.get('party.duplicate.key')
+            pairs = list(Cluster.score_pairs(max_block_size=3))
+            self.assertEqual(len(pairs), len(dict(pairs)))
+            self.assertEqual(
+                dict(pairs)[tuple(sorted([john1.id, john2.id]))],
+                score(['name', 'phonetic'])
+            )
+            # The blocks above the size limit are left out
+            shared = Key.shared_keys([john1.id], 3)
+            self.assertIn('name', [k for _, k in shared[john1.id]])
+            self.assertEqual(Key.shared_keys([john1.id], 1), {})
+            batch_size = Key._batch_size
+            Key._batch_size = 1
+            try:
+                self.assertEqual(
+                    sorted(Cluster.score_pairs(max_block_size=3)),
+                    sorted(pairs)
+                )
+            finally:
+                Key._batch_size = batch_size
+
+            cluster, = Cluster.detect()
+            self.assertEqual(
+                sorted(m.party.id for m in cluster.members),
+                [john1.id, john2.id, smith.id]
+            )
+
+            # The ignored clusters are not proposed again
+            Cluster.ignore([cluster])
+            self.assertEqual(Cluster.detect(), [])
+            Cluster.reopen([cluster])
+
+            session_id, _, _ = PartyMergeWizard.create()
+            wizard = PartyMergeWizard(session_id)
+            with Transaction().set_context(
+                    active_model=Cluster.__name__, active_ids=[cluster.id]):
+                values = wizard.default_merge(None)
+                self.assertEqual(values['target'], john1.id)
+                self.assertEqual(
+                    map(int, wizard.duplicates), [john2.id, smith.id]
+                )
+                wizard.merge.target = self.Party(john1.id)
+                wizard.merge.conflict_policy = 'keep_target'
+                wizard.transition_result()
+            self.assertEqual(Cluster(cluster.id).state, 'merged')
+            self.assertFalse(self.Party(john2.id).active)
+            self.assertTrue(self.Party(other.id).active)
+
+    def test0060_duplicate_keys_maintained(self):
+        """
+        Test the duplicate keys follow the changes of the parties
+        """
+        Key = POOL.get('party.duplicate.key')
+        ContactMechanism = POOL.get('party.contact_mechanism')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            def keys(party):
+                return sorted(
+                    (k.kind, k.key) for k in Key.search([
+                        ('party', '=', party.id),
+                    ])
+                )
+
+            party, = self.Party.create([{
+                'name': 'ACME Corp.',
+                'addresses': [('create', [{
+                    'street': 'Main Street 1', 'zip': '1000',
+                }])],
+            }])
+            self.assertIn(('name', 'acme'), keys(party))
+            self.assertIn(('address', '1000 main street 1'), keys(party))
+
+            self.Party.write([party], {'name': 'Wile'})
+            self.assertNotIn(('name', 'acme'), keys(party))
+            self.assertIn(('name', 'wile'), keys(party))
+
+            mechanism, = ContactMechanism.create([{
+                'party': party.id, 'type': 'phone',
+                'value': '+33 1 23 45 67 89',
+            }])
+            self.assertIn(('phone', '123456789'), keys(party))
+
+            # A new party is checked against the existing ones
+            duplicate, = self.Party.create([{
+                'name': 'wile',
+                'contact_mechanisms': [('create', [{
+                    'type': 'mobile', 'value': '01.23.45.67.89',
+                }])],
+            }])
+            (found, score), = self.Party.find_probable_duplicates(duplicate)
+            self.assertEqual(found, party)
+            self.assertEqual(score, 1.0)
+
+            ContactMechanism.delete([mechanism])
+            (found, score), = self.Party.find_probable_duplicates(duplicate)
+            self.assertEqual(score, 0.9)
+            self.assertEqual(
+                self.Party.find_probable_duplicates(duplicate, threshold=1),
+                []
+            )
+
+            # The keys of the merged parties are moved to the target
+            self.Party.merge([duplicate], party)
+            self.assertEqual(keys(duplicate), [])
+            self.assertIn(('phone', '123456789'), keys(party))
+            self.assertEqual(self.Party.find_probable_duplicates(party), [])
+
+    def test0065_unmerge(self):
+        """
+        Test a merge is journaled and can be undone
+        """
+        from trytond.modules.party_merge.merge_log import compress_ids, \
+            expand_ids
+
+        self.assertEqual(compress_ids([5, 1, 2, 3, 8, 10, 11]), '1-3,5,8,10-11')
+        self.assertEqual(expand_ids('1-3,5,8,10-11'), [1, 2, 3, 5, 8, 10, 11])
+        self.assertEqual(expand_ids(''), [])
+
+        Category = POOL.get('party.category')
+        Attachment = POOL.get('ir.attachment')
+        MergeLog = POOL.get('party.merge.log')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            self.setup_defaults()
+            cursor = txn.cursor
+
+            customer, supplier = Category.create([{
+                'name': 'Customer',
+            }, {
+                'name': 'Supplier',
+            }])
+            party1, party2, party3 = self.Party.create([{
+                'name': 'Party 1',
+                'categories': [('add', [customer.id])],
+            }, {
+                'name': 'Party 2',
+                'categories': [('add', [customer.id, supplier.id])],
+                'addresses': [('create', [{}, {}])],
+            }, {
+                'name': 'Party 3',
+                'addresses': [('create', [{}])],
+            }])
+            attachment, = Attachment.create([{
+                'name': 'contract.txt',
+                'resource': str(party2),
+            }])
+
+            def state():
+                relation = POOL.get('party.party-party.category').__table__()
+                cursor.execute(*relation.select(
+                    relation.party, relation.category,
+                    order_by=[relation.party, relation.category]
+                ))
+                categories = cursor.fetchall()
+                address = self.Address.__table__()
+                cursor.execute(*address.select(
+                    address.id, address.party, order_by=address.id
+                ))
+                addresses = cursor.fetchall()
+                attachment_table = Attachment.__table__()
+                cursor.execute(*attachment_table.select(
+                    attachment_table.resource,
+                    where=attachment_table.id == attachment.id
+                ))
+                resource, = cursor.fetchone()
+                return categories, addresses, resource
+
+            before = state()
+
+            log = self.Party.merge([party2, party3], party1)
+            self.assertEqual(log.target, party1)
+            self.assertEqual(sorted(log.parties), sorted([party2, party3]))
+            # One entry per statement holding the keys of every party
+            address_entry, = [
+                e for e in log.entries
+                if (e.kind, e.table_name) == ('update', 'party_address')
+            ]
+            self.assertEqual(address_entry.count, 3)
+            keys = address_entry.get_keys()
+            self.assertEqual(
+                sorted((p, len(k)) for p, k in keys.iteritems()),
+                [(party2.id, 2), (party3.id, 1)]
+            )
+            # The customer relation of party 2 is a duplicate
+            deleted, = [e for e in log.entries if e.kind == 'delete']
+            self.assertEqual(deleted.count, 1)
+            self.assertNotEqual(state(), before)
+
+            Invalidation = POOL.get('party.merge.invalidation')
+            published = len(Invalidation.search([]))
+            MergeLog.unmerge([log])
+            self.assertEqual(MergeLog(log.id).state, 'undone')
+            self.assertEqual(state(), before)
+            self.assertTrue(self.Party(party2.id).active)
+            self.assertTrue(self.Party(party3.id).active)
+            # The rows given back are evicted from the caches
+            models = [
+                i.model for i in Invalidation.search(
+                    [], order=[('id', 'ASC')])[published:]
+            ]
+            self.assertIn('party.address', models)
+
+    def test0070_merge_history(self):
+        """
+        Test the consolidation of the party history
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            self.setup_defaults()
+            cursor = txn.cursor
+            history = self.Party.__table_history__()
+
+            target, party1, party2 = self.Party.create([{
+                'name': 'Target',
+            }, {
+                'name': 'Party 1',
+            }, {
+                'name': 'Party 2',
+            }])
+            # Revisions at the same date time in the three histories
+            date_time = datetime.datetime(2014, 1, 1, 12, 0)
+            cursor.execute(*history.update(
+                columns=[history.create_date], values=[date_time],
+                where=history.id.in_([target.id, party1.id, party2.id])
+            ))
+
+            log = self.Party.merge([party1, party2], target)
+
+            cursor.execute(*history.select(
+                history.name, where=(history.id == target.id) &
+                (history.create_date == date_time) &
+                (history.write_date == Null)
+            ))
+            self.assertEqual(cursor.fetchall(), [('Target',)])
+            cursor.execute(*history.select(
+                history.id, where=history.id.in_([party1.id, party2.id])
+            ))
+            self.assertEqual(cursor.fetchall(), [])
+
+            # The latest revision of the target is its current state
+            with Transaction().set_context(
+                    _datetime=datetime.datetime.now()):
+                self.assertEqual(self.Party(target.id).name, 'Target')
+
+            # The deleted revisions are restored by the undo
+            POOL.get('party.merge.log').unmerge([log])
+            cursor.execute(*history.select(
+                history.id, history.name,
+                where=history.create_date == date_time,
+                order_by=history.id
+            ))
+            self.assertEqual(cursor.fetchall(), [
+                (target.id, 'Target'), (party1.id, 'Party 1'),
+                (party2.id, 'Party 2'),
+            ])
+
+    def test0075_merge_parallel(self):
+        """
+        Test the dispatch of the tables of a parallel merge
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            target, party1, party2 = self.Party.create([{
+                'name': 'Target',
+            }, {
+                'name': 'Party 1',
+                'addresses': [('create', [{}, {}])],
+                'contact_mechanisms': [('create', [{
+                    'type': 'email', 'value': 'party1@example.com',
+                }])],
+            }, {
+                'name': 'Party 2',
+                'addresses': [('create', [{}])],
+            }])
+
+            merge_targets = self.Party._merge_parallel_targets(
+                [party1, party2], target
+            )
+            # All the tables, the largest first
+            tables = [(t.table, t.column) for t in merge_targets]
+            self.assertEqual(tables[0], ('party_address', 'party'))
+            self.assertIn(('party_contact_mechanism', 'party'), tables)
+            # Even those without rows planned
+            self.assertIn(('account_invoice', 'party'), tables)
+            self.assertEqual(
+                len(tables), len(self.Party._merge_rewrite_targets())
+            )
+
+            # Nothing to merge
+            self.assertEqual(
+                self.Party.merge_parallel([target], target, 4), None
+            )
+
+            # Other backends merge sequentially
+            log = self.Party.merge_parallel([party1, party2], target, 4)
+            self.assertEqual(len(self.Party(target.id).addresses), 3)
+            self.assertEqual(
+                sum(e.count for e in log.entries
+                    if e.table_name == 'party_address'), 3
+            )
+
+    def test0080_merge_lock_wait(self):
+        """
+        Test the report of the time waited for locks
+        """
+        from trytond.modules.party_merge.party import _MergeJournal
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            target, party = self.Party.create([{
+                'name': 'Target',
+            }, {
+                'name': 'Party',
+            }])
+            log = self.Party.merge([party], target)
+            self.assertFalse(log.lock_wait)
+
+            # As recorded by the workers of a parallel merge
+            journal = _MergeJournal()
+            journal.record_lock_wait('party_address', 1.5)
+            journal.record_lock_wait('account_invoice', 0.25)
+            journal.replay(log)
+            self.assertEqual(log.lock_wait, 1.75)
+
+    def test0085_merge_statistics(self):
+        """
+        Test the measures of the statements of a merge
+        """
+        PartyMergeWizard = POOL.get('party.party.merge', type='wizard')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            target, party1, party2 = self.Party.create([{
+                'name': 'Target',
+            }, {
+                'name': 'Party 1',
+                'addresses': [('create', [{}, {}])],
+            }, {
+                'name': 'Party 2',
+                'addresses': [('create', [{}])],
+            }])
+
+            measures = []
+
+            def merge_statement_executed(cls, *args):
+                measures.append(args)
+            hook = self.Party.merge_statement_executed
+            self.Party.merge_statement_executed = classmethod(
+                merge_statement_executed
+            )
+            try:
+                session_id, _, _ = PartyMergeWizard.create()
+                wizard = PartyMergeWizard(session_id)
+                with Transaction().set_context(
+                        active_ids=[party1.id, party2.id]):
+                    wizard.default_merge(None)
+                wizard.merge.target = target
+                wizard.merge.conflict_policy = 'keep_target'
+                self.assertEqual(wizard.transition_result(), 'report')
+            finally:
+                self.Party.merge_statement_executed = hook
+
+            self.assertIn(
+                ('update', 'party_address', 'party', False, 3),
+                [m[:4] + m[5:] for m in measures]
+            )
+            self.assertIn(
+                ('update', 'party_address__history', 'party', True, 3),
+                [m[:4] + m[5:] for m in measures]
+            )
+
+            log = wizard.report.log
+            statistic, = [
+                s for s in log.statistics
+                if (s.table_name, s.column_name) == ('party_address', 'party')
+            ]
+            self.assertEqual(statistic.kind, 'update')
+            self.assertEqual(statistic.statements, 1)
+            self.assertEqual(statistic.rows, 3)
+            self.assertEqual(
+                len(log.statistics), len(set(m[:4] for m in measures))
+            )
+
+            values = wizard.default_report(None)
+            self.assertEqual(values['rows'], sum(m[-1] for m in measures))
+            self.assertIn(
+                'UPDATE party_address.party: 1 statements, 3 rows',
+                values['report']
+            )
+
+    def test0090_merge_mapping(self):
+        """
+        Test the merge of the parties of a mapping file
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            target1, target2, party1, party2, party3 = self.Party.create([{
+                'name': 'Target 1',
+            }, {
+                'name': 'Target 2',
+            }, {
+                'name': 'Party 1',
+                'addresses': [('create', [{}])],
+            }, {
+                'name': 'Party 2',
+                'addresses': [('create', [{}])],
+            }, {
+                'name': 'Party 3',
+                'addresses': [('create', [{}])],
+            }])
+
+            with tempfile.NamedTemporaryFile(suffix='.csv') as mapping:
+                mapping.write('duplicate,target\n')
+                for party, target in [
+                        (party1, target1), (party2, target1),
+                        (party3, target2)]:
+                    mapping.write('%s,%s\n' % (party.id, target.id))
+                mapping.flush()
+                pairs = list(read_mapping(mapping.name))
+            self.assertEqual(pairs, [
+                (party1.id, target1.id), (party2.id, target1.id),
+                (party3.id, target2.id),
+            ])
+
+            errors = self.Party.check_merge_mapping(pairs + [
+                (party1.id, target2.id),
+                (target1.id, target2.id),
+                (party2.id, party2.id),
+                (999999, target2.id),
+            ])[1]
+            self.assertEqual(errors, [
+                'Party %s is merged into %s and %s' % (
+                    party1.id, target1.id, target2.id),
+                'Party %s is merged into itself' % party2.id,
+                'Party 999999 does not exist',
+            ])
+
+            mapping, errors = self.Party.check_merge_mapping(pairs)
+            self.assertEqual(errors, [])
+            self.assertEqual(mapping, {
+                target1.id: set([party1.id, party2.id]),
+                target2.id: set([party3.id]),
+            })
+
+            batches = list(self.Party.merge_mapping(mapping, batch_size=1))
+            self.assertEqual(
+                [(t, map(int, p)) for t, p, _ in batches], [
+                    (target1, [party1.id]), (target1, [party2.id]),
+                    (target2, [party3.id]),
+                ]
+            )
+            self.assertEqual(len(self.Party(target1.id).addresses), 2)
+            self.assertEqual(len(self.Party(target2.id).addresses), 1)
+            self.assertFalse(any(
+                self.Party(p.id).active for p in [party1, party2, party3]
+            ))
+
+    def test0095_merge_chains(self):
+        """
+        Test the resolution of the chains of merges and the sweep
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            party_a, party_b, party_c, party_d, party_e = self.Party.create([{
+                'name': 'A',
+                'addresses': [('create', [{}])],
+            }, {
+                'name': 'B',
+            }, {
+                'name': 'C',
+            }, {
+                'name': 'D',
+            }, {
+                'name': 'E',
+            }])
+
+            mapping, errors = self.Party.check_merge_mapping([
+                (party_a.id, party_b.id), (party_b.id, party_c.id),
+            ])
+            self.assertEqual(errors, [])
+            self.assertEqual(mapping, {
+                party_c.id: set([party_a.id, party_b.id]),
+            })
+            errors = self.Party.check_merge_mapping([
+                (party_a.id, party_b.id), (party_b.id, party_a.id),
+                (party_d.id, party_a.id),
+            ])[1]
+            self.assertEqual(errors, [
+                'Party %s is in a cycle of merges' % i
+                for i in sorted([party_a.id, party_b.id, party_d.id])
+            ])
+
+            # A stale reference created after the merge of A into B
+            original, = party_a.addresses
+            party_a.merge_into(party_b)
+            address, = self.Address.create([{'party': party_a.id}])
+            # B is inactive once merged, D follows its previous merge
+            party_b.merge_into(party_c)
+            mapping, errors = self.Party.check_merge_mapping([
+                (party_d.id, party_b.id),
+            ])
+            self.assertEqual(errors, [])
+            self.assertEqual(mapping, {party_c.id: set([party_d.id])})
+
+            log, = self.Party.merge_sweep()
+            self.assertEqual(log.target, party_c)
+            self.assertEqual(
+                self.Address.search([('party', '=', party_c.id)], order=[
+                    ('id', 'ASC')]), [original, address]
+            )
+            self.assertEqual(self.Party.merge_sweep(), [])
+
+            self.PartyMergeLog = POOL.get('party.merge.log')
+            self.PartyMergeLog.unmerge([log])
+            self.assertEqual(
+                self.Address.search([('party', '=', party_a.id)]), [address]
+            )
+            self.assertFalse(self.Party(party_a.id).active)
+
+    def test0100_merged_redirect(self):
+        """
+        Test the redirection of the merged parties
+        """
+        Merged = POOL.get('party.party.merged')
+        MergeLog = POOL.get('party.merge.log')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            party_a, party_b, party_c = self.Party.create([{
+                'name': 'A',
+            }, {
+                'name': 'B',
+            }, {
+                'name': 'C',
+            }])
+
+            party_a.merge_into(party_b)
+            self.assertEqual(Merged.resolve(party_a.id), party_b.id)
+            log = party_b.merge_into(party_c)
+            self.assertEqual(
+                Merged.resolve_ids([party_a.id, party_b.id, party_c.id]),
+                [party_c.id, party_c.id, party_c.id]
+            )
+            merged, = Merged.search([('party', '=', party_a.id)])
+            self.assertEqual(merged.target, party_c)
+
+            MergeLog.unmerge([log])
+            self.assertEqual(
+                Merged.resolve_ids([party_a.id, party_b.id]),
+                [party_b.id, party_b.id]
+            )
+
+    def test0105_merge_consolidate(self):
+        """
+        Test the consolidation of the values of the duplicates
+        """
+        Lang = POOL.get('ir.lang')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            english, = Lang.search([('code', '=', 'en_US')])
+            target, party1, party2 = self.Party.create([{
+                'name': 'Target',
+            }, {
+                'name': 'Party 1',
+                'vat_number': '40303265045',
+                'lang': english.id,
+            }, {
+                'name': 'Party 2',
+                'vat_number': '0897290877',
+            }])
+
+            self.assertEqual(
+                self.Party.merge_consolidate_values([party1, party2], target),
+                {'lang': english.id, 'vat_number': '0897290877'}
+            )
+
+            # The target keeps its own non-empty values
+            self.Party.write([target], {'lang': english.id})
+            self.Party._merge_consolidation_rules[
+                ('vat_country', 'vat_number')] = 'most_referenced'
+            try:
+                self.Address.create([{'party': party1.id}])
+                self.assertEqual(self.Party.merge_consolidate(
+                    [party1, party2], target), {'vat_number': '40303265045'})
+            finally:
+                self.Party._merge_consolidation_rules[
+                    ('vat_country', 'vat_number')] = 'non_empty'
+            target = self.Party(target.id)
+            self.assertEqual(target.vat_number, '40303265045')
+
+    def test0110_merge_invalidate_caches(self):
+        """
+        Test the eviction of the records changed by a merge from the caches
+        """
+        from trytond.modules.party_merge.cache import MergeCache
+        Invalidation = POOL.get('party.merge.invalidation')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            target, party1, party2 = self.Party.create([{
+                'name': 'Target',
+            }, {
+                'name': 'Party 1',
+                'addresses': [('create', [{}])],
+            }, {
+                'name': 'Party 2',
+            }])
+            address, = party1.addresses
+            cache = MergeCache('test.party_merge', context=False)
+            cache.set('address', address.id, records=[
+                ('party.address', address.id),
+            ])
+            cache.set('party2', party2.id, records=[
+                ('party.party', party2.id),
+            ])
+            # Read and cached by the transaction
+            self.assertEqual(address.party, party1)
+
+            party1.merge_into(target)
+
+            self.assertEqual(address.party, target)
+            self.assertEqual(cache.get('address'), None)
+            self.assertEqual(cache.get('party2'), party2.id)
+            invalidations = dict(
+                (i.model, i.ids) for i in Invalidation.search([])
+            )
+            self.assertEqual(invalidations['party.address'], str(address.id))
+            self.assertEqual(
+                invalidations['party.party'], '%s-%s' % (target.id, party1.id)
+            )
+
+            # Another process evicts the records once notified
+            cache.set('address', address.id, records=[
+                ('party.address', address.id),
+            ])
+            MergeCache._merge_last[Transaction().cursor.dbname] = 0
+            MergeCache._merge_synced.clear()
+            self.assertEqual(cache.get('address'), None)
+            self.assertEqual(cache.get('party2'), party2.id)
+
+            # An invalidation committed after a later one is read late
+            dbname = Transaction().cursor.dbname
+            cursor = Transaction().cursor
+            table = Invalidation.__table__()
+            # Inserted before the one of party.party
+            first, = Invalidation.search([('model', '=', 'party.address')])
+            values = [first.id, first.model, first.ids]
+            Invalidation.delete([first])
+            cache.set('address', address.id, records=[
+                ('party.address', address.id),
+            ])
+            MergeCache._merge_last[dbname] = first.id - 1
+            MergeCache._merge_synced.clear()
+            self.assertEqual(cache.get('party2'), party2.id)
+            self.assertEqual(
+                MergeCache._merge_unread[dbname].keys(), [first.id]
+            )
+            self.assertEqual(cache.get('address'), address.id)
+            cursor.execute(*table.insert(
+                columns=[table.id, table.model, table.ids], values=[values]
+            ))
+            MergeCache._merge_synced.clear()
+            self.assertEqual(cache.get('address'), None)
+            self.assertEqual(MergeCache._merge_unread[dbname], {})
+
+            # The dependencies leave with the entries
+            small = MergeCache(
+                'test.party_merge.lru', size_limit=2, context=False
+            )
+            for i in range(3):
+                small.set(i, i, records=[('party.party', i)])
+            self.assertEqual(
+                sorted(small._cache[dbname].keys_of),
+                [('party.party', 1), ('party.party', 2)]
+            )
+            small.clear()
+            small.evict([('party.party', 1)])
+            small.set(3, 3, records=[('party.party', 3)])
+            self.assertEqual(
+                small._cache[dbname].keys_of, {('party.party', 3): set([3])}
+            )
+
+    def test0115_merge_wizard_staging(self):
+        """
+        Test the selection of the merge wizard is staged on the server
+        """
+        PartyMergeWizard = POOL.get('party.party.merge', type='wizard')
+        Staged = POOL.get('party.party.merge.staged')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            target, = self.Party.create([{'name': 'Target'}])
+            duplicates = self.Party.create([{
+                'name': 'Duplicate %s' % i,
+                'addresses': [('create', [{}] * i)],
+            } for i in range(5)])
+
+            session_id, _, _ = PartyMergeWizard.create()
+            wizard = PartyMergeWizard(session_id)
+            with Transaction().set_context(
+                    active_ids=map(int, duplicates)):
+                values = wizard.default_merge(None)
+                # Staged only once per session
+                wizard.default_merge(None)
+            self.assertEqual(values['count'], 5)
+            self.assertEqual(Staged.count(session_id), 5)
+            self.assertEqual(
+                Staged.get_party_ids(session_id, offset=1, limit=2),
+                sorted(map(int, duplicates))[1:3]
+            )
+
+            # The staged parties can not be the target
+            self.assertEqual(self.Party.search([
+                ('merge_session', '!=', session_id),
+                ('name', 'like', 'Duplicate%'),
+            ]), [])
+            self.assertEqual(
+                self.Party.search([('merge_session', '=', session_id)]),
+                sorted(duplicates, key=lambda p: p.id)
+            )
+
+            wizard._preview_page_size = 2
+            values = wizard.default_preview(None)
+            self.assertEqual(values['pages'], 3)
+            self.assertEqual(values['page'], 1)
+            self.assertEqual(
+                [(x['party'], x['references']) for x in values['lines']],
+                sorted(self.Party.merge_reference_counts(
+                    [duplicates[0].id, duplicates[1].id]).items())
+            )
+            self.assertEqual(wizard.transition_preview_next(), 'preview')
+            wizard.transition_preview_next()
+            wizard.transition_preview_next()
+            values = wizard.default_preview(None)
+            self.assertEqual(values['page'], 3)
+            self.assertEqual(
+                [x['party'] for x in values['lines']], [duplicates[4].id]
+            )
+            wizard.transition_preview_previous()
+            values = wizard.default_preview(None)
+            self.assertEqual(values['page'], 2)
+
+            wizard.merge.target = target
+            wizard.merge.conflict_policy = 'keep_target'
+            wizard.transition_result()
+            self.assertFalse(any(
+                p.active for p in self.Party.browse(map(int, duplicates))
+            ))
+
+            # The staged parties go with the session
+            PartyMergeWizard.delete(session_id)
+            self.assertEqual(Staged.count(session_id), 0)
+
+    def test0120_purge_merged(self):
+        """
+        Test the purge of the merged parties no longer referenced
+        """
+        Merged = POOL.get('party.party.merged')
+        MergeLog = POOL.get('party.merge.log')
+        Address = POOL.get('party.address')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            journal, = self.Journal.search([('name', '=', 'Revenue')])
+
+            target, party1, party2, party3, party4 = self.Party.create([{
+                'name': 'Target',
+            }, {
+                'name': 'Party 1',
+            }, {
+                'name': 'Party 2',
+            }, {
+                'name': 'Party 3',
+            }, {
+                'name': 'Party 4',
+            }])
+            log = self.Party.merge([party1, party2], target)
+            # A chain of merges through party 3
+            chain_log = self.Party.merge([party4], party3)
+            party3.merge_into(target)
+
+            # Created with the ids of the merged parties afterwards
+            address, = Address.create([{'party': party1.id}])
+            other_address, = Address.create([{'party': party2.id}])
+            with Transaction().set_context({'company': self.company.id}):
+                self.Invoice.create([{
+                    'party': party2.id,
+                    'invoice_address': other_address.id,
+                    'journal': journal.id,
+                    'payment_term': self.payment_term.id,
+                    'currency': self.currency.id,
+                    'account': self._get_account_by_kind('receivable').id,
+                }])
+
+            # Kept until the delay is over
+            self.assertEqual(Merged.purge_count(), 0)
+            self.assertEqual(list(Merged.purge_batches()), [])
+            delay = datetime.timedelta(0)
+            self.assertEqual(Merged.purge_count(delay), 4)
+
+            self.assertEqual(
+                list(Merged.purge_batches(batch_size=2, delay=delay)),
+                [([party1.id], [party2.id]), ([party3.id, party4.id], [])]
+            )
+            with Transaction().set_context(active_test=False):
+                self.assertEqual(
+                    self.Party.search([('name', 'like', 'Party%')]),
+                    [party2]
+                )
+                self.assertEqual(Address.search([('id', '=', address.id)]), [])
+            # The redirections of the purged parties are kept
+            self.assertEqual(
+                Merged.resolve_ids([party2.id, party3.id, party4.id]),
+                [target.id] * 3
+            )
+            self.assertEqual(MergeLog(log.id).state, 'purged')
+            self.assertEqual(MergeLog(log.id).parties, (party2,))
+            self.assertTrue(self.Party(target.id).active)
+            # The log of a merge into a purged party is kept
+            chain_log = MergeLog(chain_log.id)
+            self.assertEqual(chain_log.state, 'purged')
+            self.assertEqual(chain_log.target, None)
+            self.assertTrue(chain_log.entries or chain_log.statistics)
+
+            # The purged parties are still resolved to their final target
+            mapping, errors = self.Party.check_merge_mapping([
+                (party1.id, target.id), (party2.id, party3.id),
+            ])
+            self.assertEqual(errors, [])
+            self.assertEqual(mapping, {target.id: set([party2.id])})
+
+    def test0125_merge_steps(self):
+        """
+        Test the merge steps declared by other modules
+        """
+        MergeLog = POOL.get('party.merge.log')
+        ContactMechanism = POOL.get('party.contact_mechanism')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            target, party1, party2 = self.Party.create([{
+                'name': 'Target',
+            }, {
+                'name': 'Party 1',
+                'addresses': [('create', [{}])],
+                'contact_mechanisms': [('create', [{
+                    'type': 'email', 'value': 'party1@example.com',
+                }])],
+            }, {
+                'name': 'Party 2',
+                'contact_mechanisms': [('create', [{
+                    'type': 'phone', 'value': '0123456789',
+                }])],
+            }])
+            address, = party1.addresses
+            mechanism_ids = map(
+                int, party1.contact_mechanisms + party2.contact_mechanisms
+            )
+
+            calls = []
+
+            def merge_mechanisms(
+                    cls, source_ids, target_id, conflict_policy, log=None):
+                calls.append(('mechanisms', source_ids, target_id))
+                cursor = Transaction().cursor
+                table = ContactMechanism.__table__()
+                cursor.execute(*table.select(
+                    table.party, table.id,
+                    where=table.party.in_(source_ids)
+                ))
+                rows = cursor.fetchall()
+                cursor.execute(*table.update(
+                    columns=[table.party], values=[target_id],
+                    where=table.party.in_(source_ids)
+                ))
+                log.record_update(
+                    ContactMechanism._table, 'party', 'id', False, rows
+                )
+                return len(rows)
+
+            def check_addresses(
+                    cls, source_ids, target_id, conflict_policy, log=None):
+                # Run after the rewrite of the addresses
+                calls.append(('addresses', source_ids, target_id))
+                cursor = Transaction().cursor
+                table = POOL.get('party.address').__table__()
+                cursor.execute(*table.select(
+                    table.party, where=table.id == address.id
+                ))
+                self.assertEqual(cursor.fetchone(), (target_id,))
+
+            self.Party.merge_mechanisms = classmethod(merge_mechanisms)
+            self.Party.check_addresses = classmethod(check_addresses)
+            steps = self.Party._merge_steps
+            self.Party._merge_steps = [
+                MergeStep('addresses', 200, 'check_addresses', ()),
+                MergeStep(
+                    'mechanisms', 10, 'merge_mechanisms',
+                    (ContactMechanism._table,)
+                ),
+            ]
+            try:
+                pipeline = self.Party.get_merge_pipeline()
+                self.assertEqual(pipeline[0][0], 'step')
+                self.assertEqual(pipeline[0][1].name, 'mechanisms')
+                self.assertEqual(pipeline[-1][1].name, 'addresses')
+                self.assertNotIn(
+                    ContactMechanism._table,
+                    [t.table for t in self.Party._merge_rewrite_targets()]
+                )
+
+                plan = self.Party.merge_plan([party1, party2], target)
+                self.assertEqual(plan['steps'], ['mechanisms', 'addresses'])
+                self.assertNotIn(
+                    ContactMechanism._table,
+                    [line['table'] for line in plan['lines']]
+                )
+
+                log = self.Party.merge([party1, party2], target)
+
+                # The sweep runs the steps in their sequence too
+                stale, = ContactMechanism.create([{
+                    'party': party1.id, 'type': 'email',
+                    'value': 'stale@example.com',
+                }])
+                sweep_log, = self.Party.merge_sweep()
+                self.assertEqual(calls[2:], [
+                    ('mechanisms', [party1.id, party2.id], target.id),
+                    ('addresses', [party1.id, party2.id], target.id),
+                ])
+                self.assertEqual(stale.party, target)
+                # Nothing left to rewrite
+                self.assertEqual(self.Party.merge_sweep(), [])
+                MergeLog.unmerge([sweep_log])
+                self.assertEqual(stale.party, party1)
+                ContactMechanism.delete([stale])
+                del calls[2:]
+            finally:
+                self.Party._merge_steps = steps
+                del self.Party.merge_mechanisms
+                del self.Party.check_addresses
+
+            # Called once with all the duplicates
+            self.assertEqual(calls, [
+                ('mechanisms', [party1.id, party2.id], target.id),
+                ('addresses', [party1.id, party2.id], target.id),
+            ])
+            self.assertEqual(
+                [m.party for m in ContactMechanism.browse(mechanism_ids)],
+                [target, target]
+            )
+            statistic, = [
+                s for s in log.statistics if s.kind == 'step'
+                and s.table_name == 'mechanisms'
+            ]
+            self.assertEqual(statistic.rows, 2)
+
+            # The journal of the steps is undone with the merge
+            MergeLog.unmerge([log])
+            self.assertEqual(
+                ContactMechanism.search([('party', '=', party1.id)]),
+                ContactMechanism.browse(mechanism_ids[:1])
+            )
+
+    def test0130_merge_recompute(self):
+        """
+        Test the values stored from the rewritten rows are recomputed
+        """
+        Address = POOL.get('party.address')
+        MergeLog = POOL.get('party.merge.log')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            target, party1, party2, other = self.Party.create([{
+                'name': 'Target',
+            }, {
+                'name': 'Party 1',
+                'addresses': [('create', [{'name': 'Party 1'}])],
+            }, {
+                'name': 'Party 2',
+                'addresses': [('create', [{'name': 'Party 2'}] * 2)],
+            }, {
+                'name': 'Other',
+                'addresses': [('create', [{'name': 'Stale'}])],
+            }])
+            address_ids = map(int, party1.addresses + party2.addresses)
+
+            # The name of the addresses as a denormalized party name
+            def on_change_with_name(self, name=None):
+                return self.party.name if self.party else None
+
+            recomputed = []
+
+            def recompute_totals(cls, target_id, changes):
+                recomputed.append((target_id, changes.get(Address.__name__)))
+
+            field = Address._fields['name']
+            on_change_with = field.on_change_with
+            field.on_change_with = on_change_with | set(['party'])
+            Address.on_change_with_name = on_change_with_name
+            self.Party.recompute_totals = classmethod(recompute_totals)
+            methods = self.Party._merge_recompute_methods
+            self.Party._merge_recompute_methods = ['recompute_totals']
+            try:
+                self.assertEqual(
+                    self.Party.get_merge_derived_fields()[Address.__name__],
+                    ['name']
+                )
+                log = self.Party.merge([party1, party2], target)
+
+                self.assertEqual(
+                    [a.name for a in Address.browse(address_ids)],
+                    ['Target'] * 3
+                )
+                # Only the rewritten rows
+                self.assertEqual(other.addresses[0].name, 'Stale')
+                self.assertEqual(
+                    recomputed, [(target.id, set(address_ids))]
+                )
+
+                # The rows given back are recomputed too
+                MergeLog.unmerge([log])
+                self.assertEqual(
+                    [a.name for a in Address.browse(address_ids)],
+                    ['Party 1', 'Party 2', 'Party 2']
+                )
+                self.assertEqual(
+                    recomputed[-1], (target.id, set(address_ids))
+                )
+            finally:
+                field.on_change_with = on_change_with
+                del Address.on_change_with_name
+                del self.Party.recompute_totals
+                self.Party._merge_recompute_methods = methods
+
+    def test0135_merge_lock_retry_journal(self):
+        """
+        Test a retried table journals the rows of its last attempt only
+        """
+        Category = POOL.get('party.category')
+        MergeLog = POOL.get('party.merge.log')
+
+        class LockNotAvailable(Exception):
+            pgcode = '55P03'
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            journal = _MergeJournal()
+            journal.record_statement(
+                'update', 'party_address', 'party', False, 0.1, 2)
+            checkpoint = journal.checkpoint()
+            journal.record_delete('party_address', [{'id': 1}])
+            journal.restore(checkpoint)
+            self.assertEqual(len(journal.records), 1)
+
+            customer, = Category.create([{'name': 'Customer'}])
+            target, party1 = self.Party.create([{
+                'name': 'Target',
+                'categories': [('add', [customer.id])],
+            }, {
+                'name': 'Party 1',
+                'categories': [('add', [customer.id])],
+            }])
+            log = MergeLog.start([party1], target)
+            log.record_statement(
+                'update', 'party_address', 'party', False, 0.1, 2)
+            checkpoint = log.checkpoint()
+            log.record_statement(
+                'update', 'party_address', 'party', False, 0.1, 2)
+            log.record_update('party_address', 'party', 'id', False, [
+                (party1.id, 1),
+            ])
+            log.restore(checkpoint)
+            self.assertEqual(
+                log._statistics.values(), [(1, 2, 0.1)]
+            )
+            self.assertEqual(dict(log._changes), {})
+            MergeLog.delete([log])
+
+            if backend.name() != 'postgresql':
+                # Only PostgreSQL has lock timeouts
+                return
+
+            failed = []
+            rewrite = self.Party._merge_rewrite
+
+            def merge_rewrite(cls, merge_target, *args, **kwargs):
+                # The conflicting relation is already deleted
+                if merge_target.table == 'party_category_rel' \
+                        and not failed:
+                    failed.append(merge_target)
+                    raise LockNotAvailable()
+                return rewrite(merge_target, *args, **kwargs)
+            backoff = self.Party._merge_lock_backoff
+            self.Party._merge_rewrite = classmethod(merge_rewrite)
+            self.Party._merge_lock_backoff = 0
+            try:
+                log = self.Party.merge(
+                    [party1], target, conflict_policy='keep_target'
+                )
+            finally:
+                self.Party._merge_rewrite = rewrite
+                self.Party._merge_lock_backoff = backoff
+            self.assertTrue(failed)
+
+            deleted, = [e for e in log.entries if e.kind == 'delete']
+            self.assertEqual(deleted.count, 1)
+            statistic, = [
+                s for s in log.statistics
+                if (s.kind, s.table_name) == ('delete', 'party_category_rel')
+            ]
+            self.assertEqual(statistic.statements, 1)
+
+            # The deleted relation is restored once
+            MergeLog.unmerge([log])
+            Relation = POOL.get('party.party-party.category')
+            self.assertEqual(len(Relation.search([
+                ('party', '=', party1.id),
+                ('category', '=', customer.id),
+            ])), 1)
+
+    def test0140_merge_request_stale(self):
+        """
+        Test the retry of a request abandoned by its worker
+        """
+        MergeRequest = POOL.get('party.merge.request')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            target, party2 = self.Party.create([{
+                'name': 'Target',
+            }, {
+                'name': 'Party 2',
+            }])
+            request = MergeRequest.enqueue([party2], target)
+            now = datetime.datetime.now()
+            MergeRequest.write([request], {
+                'state': 'running',
+                'start_date': now,
+                'heartbeat': now,
+            })
+
+            # The worker is still alive
+            self.assertRaises(UserError, MergeRequest.retry, [request])
+            self.assertEqual(request.state, 'running')
+
+            MergeRequest.write([request], {
+                'heartbeat': now - MergeRequest._stale_timeout * 2,
+            })
+            MergeRequest.retry([request])
+            self.assertEqual(request.state, 'pending')
+            self.assertEqual(request.heartbeat, None)
+
+    def test0145_merge_parallel_recover(self):
+        """
+        Test the recovery of the workers of a dead parallel merge
+        """
+        Category = POOL.get('party.category')
+        MergeLog = POOL.get('party.merge.log')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            self.setup_defaults()
+            # Nothing is prepared on the other backends
+            self.assertEqual(self.Party.merge_parallel_recover(), [])
+            if backend.name() != 'postgresql':
+                return
+            Database = backend.get('Database')
+            category = Category.__table__()
+
+            def prepare(log_id, name):
+                "Prepare a worker of the log inserting the category name"
+                gid = 'party_merge-%s-%s-0' % (DB_NAME, log_id)
+                cursor = Database(DB_NAME).connect().cursor()
+                cursor.execute(*category.insert(
+                    columns=[category.name], values=[[name]]
+                ))
+                cursor.execute('PREPARE TRANSACTION %s', (gid,))
+                cursor.close()
+                return gid
+
+            # A merge whose coordinator committed the log
+            with Transaction().new_cursor() as coordinator:
+                target, party = self.Party.create([{
+                    'name': 'Target',
+                }, {
+                    'name': 'Party',
+                }])
+                log = MergeLog.start([party], target)
+                coordinator.cursor.commit()
+            committed = prepare(log.id, 'Committed')
+            # A merge whose coordinator rolled back
+            rolled_back = prepare(log.id + 1, 'Rolled back')
+            # A merge whose coordinator is still running
+            txn.cursor.execute(
+                'SELECT pg_advisory_xact_lock(%s, %s)',
+                (self.Party._merge_parallel_lock, log.id + 2)
+            )
+            running = prepare(log.id + 2, 'Running')
+
+            try:
+                self.assertEqual(
+                    self.Party.merge_parallel_recover(),
+                    [committed, rolled_back]
+                )
+                with Transaction().new_cursor() as check:
+                    check.cursor.execute(*category.select(
+                        category.name,
+                        where=category.name.in_(
+                            ['Committed', 'Rolled back', 'Running']
+                        )
+                    ))
+                    self.assertEqual(check.cursor.fetchall(), [('Committed',)])
+            finally:
+                cursor = Database(DB_NAME).connect().cursor(autocommit=True)
+                cursor.execute('ROLLBACK PREPARED %s', (running,))
+                cursor.close()
+                with Transaction().new_cursor() as cleanup:
+                    cleanup.cursor.execute(*category.delete(
+                        where=category.name == 'Committed'
+                    ))
+                    MergeLog.delete([MergeLog(log.id)])
+                    self.Party.delete([target, party])
+                    cleanup.cursor.commit()
+
+    def test0150_merge_retryable(self):
+        """
+        Test the conflicts retried and the lock timeout of the chunks
+        """
+        class DatabaseError(Exception):
+            def __init__(self, pgcode):
+                self.pgcode = pgcode
+
+        # Retried in a new transaction
+        self.assertTrue(self.Party.merge_retryable(DatabaseError('55P03')))
+        self.assertTrue(self.Party.merge_retryable(DatabaseError('40001')))
+        self.assertTrue(self.Party.merge_retryable(DatabaseError('40P01')))
+        self.assertFalse(self.Party.merge_retryable(DatabaseError('23505')))
+        self.assertFalse(self.Party.merge_retryable(ValueError()))
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            target, party = self.Party.create([{
+                'name': 'Target',
+            }, {
+                'name': 'Party',
+                'addresses': [('create', [{}, {}, {}])],
+            }])
+
+            calls = []
+            lock_retry = self.Party._merge_lock_retry
+
+            def merge_lock_retry(cls, func, log=None):
+                calls.append(func)
+                return lock_retry(func, log=log)
+            self.Party._merge_lock_retry = classmethod(merge_lock_retry)
+            try:
+                for merge_target, history, _ in self.Party.merge_in_chunks(
+                        [party], target, 2):
+                    if merge_target.table == 'party_address':
+                        self.assertTrue(calls)
+                        del calls[:]
+            finally:
+                self.Party._merge_lock_retry = lock_retry
+            self.assertEqual(len(self.Party(target.id).addresses), 3)
+
 
 def suite():
     """
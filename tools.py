@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+    tools.py
+
+    SQL helpers shared by the models of the module.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import datetime
+
+from sql import Column
+
+from trytond.transaction import Transaction
+from trytond.tools import grouped_slice
+
+__all__ = ['insert_rows', 'bulk_insert']
+
+
+def insert_rows(table, rows):
+    """Insert rows, a list of dictionaries with the same keys, into the SQL
+    table with one multi-row INSERT per slice.
+    """
+    cursor = Transaction().cursor
+
+    if not rows:
+        return
+    names = sorted(rows[0])
+    columns = [Column(table, n) for n in names]
+    # Keep the number of parameters per statement below IN_MAX
+    size = max(cursor.IN_MAX // len(columns), 1)
+    for sub_rows in grouped_slice(rows, size):
+        cursor.execute(*table.insert(
+            columns=columns,
+            values=[[r[n] for n in names] for r in sub_rows]
+        ))
+
+
+def bulk_insert(Model, vlist):
+    """Insert vlist, a list of dictionaries with the same keys, into the
+    table of Model with one multi-row INSERT per slice instead of the
+    create of the ORM, which issues one INSERT per record.
+    """
+    transaction = Transaction()
+    now = datetime.datetime.now()
+    insert_rows(Model.__table__(), [
+        dict(v, create_uid=transaction.user, create_date=now)
+        for v in vlist
+    ])